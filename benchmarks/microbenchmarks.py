@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the hot functions of ``lexmapr``.
+
+Each benchmark calls one function of ``lexmapr.pipeline_helpers`` or
+``lexmapr.pipeline_classification`` over a fixed set of inputs, built
+deterministically from the corpora in ``lexmapr/tests/test_input``, and
+reports the best time per call over ``--repeat`` rounds. Inputs are
+parameterized by sample length, and by lookup table size where the
+function takes a lookup table, so optimizations of these functions can
+be judged in isolation.
+
+Usage::
+
+    python benchmarks/microbenchmarks.py
+    python benchmarks/microbenchmarks.py -k map_term -o before.json
+    python benchmarks/microbenchmarks.py -k map_term --compare before.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lexmapr import pipeline_classification, pipeline_helpers  # noqa: E402
+from lexmapr.pipeline import Mapper  # noqa: E402
+
+TEST_INPUT = os.path.join(ROOT, "lexmapr", "tests", "test_input")
+
+# Sample descriptions, by corpus file, and the column they are in
+CORPORA = {"zheminSamples.csv": 1, "genomeTrackerMaster.csv": 1, "bccdcsample.csv": 1}
+
+# Number of inputs each benchmark calls its function over
+NUM_INPUTS = 200
+
+SAMPLE_LENGTHS = [2, 4, 8, 16, 32]
+TABLE_SIZES = [1000, 10000, 100000]
+
+
+def get_corpus_samples():
+    """Get the sample descriptions of ``CORPORA``.
+
+    :rtype: list[str]
+    """
+    ret = []
+    for file_name, column in CORPORA.items():
+        with open(os.path.join(TEST_INPUT, file_name)) as fp:
+            rows = list(csv.reader(fp))[1:]
+        ret += [row[column] for row in rows if len(row) > column and row[column].strip()]
+    return ret
+
+
+def get_vocabulary(samples):
+    """Get the distinct tokens of cleaned ``samples``, in sorted order.
+
+    :param list[str] samples: Sample descriptions
+    :rtype: list[str]
+    """
+    tokens = set()
+    for sample in samples:
+        tokens.update(pipeline_helpers.punctuation_treatment(sample.lower()).split())
+    return sorted(tokens)
+
+
+def get_samples_of_length(vocabulary, length, rng):
+    """Get ``NUM_INPUTS`` random samples of ``length`` tokens.
+
+    :param list[str] vocabulary: Tokens to make samples of
+    :param int length: Number of tokens per sample
+    :param random.Random rng: Random number generator
+    :rtype: list[str]
+    """
+    return [" ".join(rng.choice(vocabulary) for _ in range(length)) for _ in range(NUM_INPUTS)]
+
+
+def get_synthetic_lookup_table(vocabulary, size, rng):
+    """Get a lookup table of ``size`` random resource labels.
+
+    Only the keys needed by ``lexmapr.pipeline_helpers.map_term`` are
+    included. Each label has one to four tokens, and every tenth label
+    is also added as a synonym of another label.
+
+    :param list[str] vocabulary: Tokens to make labels of
+    :param int size: Number of resource labels
+    :param random.Random rng: Random number generator
+    :rtype: dict[str, dict]
+    """
+    ret = {"standard_resource_labels": {}, "standard_resource_label_bags": {},
+           "non_standard_resource_ids": {}, "synonyms": {}, "synonym_bags": {},
+           "suffixes": {"(whole)": "", "(raw)": "", "(food source)": ""}}
+    while len(ret["standard_resource_labels"]) < size:
+        label = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(1, 4)))
+        if label in ret["standard_resource_labels"]:
+            continue
+        resource_id = "bench_%07d" % len(ret["standard_resource_labels"])
+        ret["standard_resource_labels"][label] = resource_id
+        ret["standard_resource_label_bags"][pipeline_helpers.get_token_bag(label)] = resource_id
+        ret["non_standard_resource_ids"][resource_id] = label
+        if len(ret["standard_resource_labels"]) % 10 == 0:
+            synonym = " ".join(rng.choice(vocabulary) for _ in range(2))
+            ret["synonyms"][synonym] = label
+            ret["synonym_bags"][pipeline_helpers.get_token_bag(synonym)] = label
+    return ret
+
+
+def get_map_term_probes(lookup_table, vocabulary, rng):
+    """Get ``NUM_INPUTS`` terms to map to ``lookup_table``.
+
+    A quarter of the terms are resource labels, a quarter permutations
+    of resource labels, and half are random terms that mostly do not
+    map.
+
+    :param dict[str, dict] lookup_table: Lookup table to get labels of
+    :param list[str] vocabulary: Tokens to make random terms of
+    :param random.Random rng: Random number generator
+    :rtype: list[str]
+    """
+    labels = rng.sample(sorted(lookup_table["standard_resource_labels"]), NUM_INPUTS // 2)
+    ret = labels[:NUM_INPUTS // 4]
+    for label in labels[NUM_INPUTS // 4:]:
+        tokens = label.split(" ")
+        rng.shuffle(tokens)
+        ret.append(" ".join(tokens))
+    ret += get_samples_of_length(vocabulary, 2, rng)[:NUM_INPUTS - len(ret)]
+    return ret
+
+
+def get_synthetic_hierarchy(depth, num_parents):
+    """Get a lookup table of a layered resource hierarchy.
+
+    Each layer has ``num_parents`` resources, each with every resource
+    of the layer above as a parent, so resources of the bottom layer
+    have ``num_parents ** depth`` parent hierarchies.
+
+    :param int depth: Number of layers below the root resource
+    :param int num_parents: Number of parents of each resource
+    :returns: Lookup table with only ``parents``, and the id of a
+        resource of the bottom layer
+    :rtype: tuple[dict[str, dict], str]
+    """
+    parents = {}
+    layer = ["bfo_0000001"]
+    for i in range(depth):
+        next_layer = ["bench_%d_%d" % (i, j) for j in range(num_parents)]
+        for resource_id in next_layer:
+            parents[resource_id] = list(layer)
+        layer = next_layer
+    return {"parents": parents}, layer[0]
+
+
+def get_term_lists(vocabulary, size, rng):
+    """Get ``NUM_INPUTS`` lists of matched components to post-process.
+
+    Labels share tokens, so some are subsumed by others.
+
+    :param list[str] vocabulary: Tokens to make labels of
+    :param int size: Number of matched components per list
+    :param random.Random rng: Random number generator
+    :rtype: list[list[str]]
+    """
+    ret = []
+    for _ in range(NUM_INPUTS):
+        tokens = [rng.choice(vocabulary) for _ in range(size + 2)]
+        term_list = []
+        for i in range(size):
+            label = " ".join(tokens[i:i + rng.randint(1, 3)])
+            term_list.append("%s:bench_%07d" % (label, i))
+        ret.append(term_list)
+    return ret
+
+
+def get_classification_inputs(samples, mapper):
+    """Get the arguments ``classify_sample`` is called with by samples.
+
+    :param list[str] samples: Sample descriptions
+    :param lexmapr.pipeline.Mapper mapper: Mapper with classification
+        resources
+    :returns: Lists of sample, and matched components with their
+        lowercase resource ids, by sample token count group
+    :rtype: dict[str, list[tuple[str, list[str]]]]
+    """
+    ret = {"1-3": [], "4-7": [], "8+": []}
+    for original_sample in samples:
+        sample = pipeline_helpers.punctuation_treatment(original_sample.lower())
+        num_tokens = len(sample.split())
+        group = "1-3" if num_tokens < 4 else "4-7" if num_tokens < 8 else "8+"
+        if len(ret[group]) == NUM_INPUTS:
+            continue
+        matched_components = []
+        for matched_component in mapper.map_sample(original_sample)["matched_components"]:
+            label, resource_id = matched_component.rsplit(":", 1)
+            matched_components.append(label + ":" + resource_id.lower())
+        ret[group].append((sample, matched_components))
+    return ret
+
+
+def get_benchmarks():
+    """Get the benchmark of each function and set of input parameters.
+
+    :returns: Function name, input parameters and a function calling
+        it over ``NUM_INPUTS`` inputs, of each benchmark
+    :rtype: collections.abc.Iterator[tuple[str, str, collections.abc.Callable]]
+    """
+    rng = random.Random(0)
+    corpus_samples = get_corpus_samples()
+    vocabulary = get_vocabulary(corpus_samples)
+    samples_of_length = {n: get_samples_of_length(vocabulary, n, rng) for n in SAMPLE_LENGTHS}
+
+    mapper = Mapper(bucket=True)
+    lookup_tables = {"predefined": mapper.lookup_table}
+    for size in TABLE_SIZES:
+        lookup_tables[str(size)] = get_synthetic_lookup_table(vocabulary, size, rng)
+
+    for table_name, lookup_table in lookup_tables.items():
+        probes = get_map_term_probes(lookup_table, vocabulary, rng)
+        yield "map_term", "table=" + table_name, lambda probes=probes, lookup_table=lookup_table: [
+            pipeline_helpers.map_term(probe, lookup_table) for probe in probes]
+        yield ("map_term", "table=%s suffixes" % table_name,
+               lambda probes=probes, lookup_table=lookup_table: [
+                   pipeline_helpers.map_term(probe, lookup_table, consider_suffixes=True)
+                   for probe in probes])
+
+    for length in [2, 4, 8, 14, 16, 32]:
+        samples = get_samples_of_length(vocabulary, length, rng)[:NUM_INPUTS // 10]
+        for num in [1, 3, 5]:
+            yield "get_gram_chunks", "length=%d num=%d" % (length, num), \
+                lambda samples=samples, num=num: [
+                    pipeline_helpers.get_gram_chunks(sample, num) for sample in samples]
+
+    for depth, num_parents in [(4, 1), (16, 1), (4, 2), (8, 2), (4, 4)]:
+        lookup_table, term_id = get_synthetic_hierarchy(depth, num_parents)
+        yield ("get_term_parent_hierarchies", "depth=%d parents=%d" % (depth, num_parents),
+               lambda lookup_table=lookup_table, term_id=term_id: [
+                   pipeline_helpers.get_term_parent_hierarchies(term_id, lookup_table)
+                   for _ in range(NUM_INPUTS)])
+
+    for size in [1, 2, 4, 8, 16]:
+        term_lists = get_term_lists(vocabulary, size, rng)
+        yield "retain_phrase", "terms=%d" % size, lambda term_lists=term_lists: [
+            pipeline_helpers.retain_phrase(list(term_list)) for term_list in term_lists]
+
+    for length, samples in samples_of_length.items():
+        punctuated = [sample.replace(" ", rng.choice([" ", ", ", "-", " (", ") ", "/"]), 3)
+                      for sample in samples]
+        yield "punctuation_treatment", "length=%d" % length, lambda punctuated=punctuated: [
+            pipeline_helpers.punctuation_treatment(sample) for sample in punctuated]
+
+    for length, samples in samples_of_length.items():
+        yield "normalize_phrases", "length=%d" % length, lambda samples=samples: [
+            pipeline_helpers.normalize_phrases(sample, mapper.phrase_trie, [])
+            for sample in samples]
+
+    tokens = {
+        "words": rng.sample(vocabulary, NUM_INPUTS),
+        "numbers": [str(rng.randint(0, 10 ** rng.randint(1, 6))) for _ in range(NUM_INPUTS)],
+        "dates": [rng.choice(["2016", "jan", "march", "12/05/2017", "2017-06-01", "monday"])
+                  for _ in range(NUM_INPUTS)],
+    }
+    for kind, kind_tokens in tokens.items():
+        yield "is_date", "tokens=" + kind, lambda kind_tokens=kind_tokens: [
+            pipeline_helpers.is_date(token) for token in kind_tokens]
+        yield "is_number", "tokens=" + kind, lambda kind_tokens=kind_tokens: [
+            pipeline_helpers.is_number(token) for token in kind_tokens]
+
+    classification_inputs = get_classification_inputs(corpus_samples, mapper)
+    lookup_table = mapper.lookup_table
+    classification_lookup_table = mapper.classification_lookup_table
+    for group, inputs in classification_inputs.items():
+        yield "classify_sample", "length=" + group, lambda inputs=inputs: [
+            pipeline_classification.classify_sample(sample, matched_components, lookup_table,
+                                                    classification_lookup_table)
+            for sample, matched_components in inputs]
+        labels = [pipeline_classification.classify_sample(
+            sample, matched_components, lookup_table, classification_lookup_table, full=False
+        )["ifsac_final_labels"] for sample, matched_components in inputs]
+        refine_inputs = [(sample, set(sample_labels))
+                         for (sample, _), sample_labels in zip(inputs, labels)]
+        yield "refine_ifsac_final_labels", "length=" + group, lambda inputs=refine_inputs: [
+            pipeline_classification.refine_ifsac_final_labels(
+                sample, sample_labels, classification_lookup_table)
+            for sample, sample_labels in inputs]
+
+
+def time_benchmark(function, repeat):
+    """Get the best time of calling ``function`` over ``repeat`` rounds.
+
+    :param collections.abc.Callable function: Calls the benchmarked
+        function over ``NUM_INPUTS`` inputs, and returns its results
+    :param int repeat: Number of rounds
+    :returns: Microseconds per call of the benchmarked function
+    :rtype: float
+    """
+    num_calls = len(function())
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return 1e6 * min(timer.repeat(repeat, number)) / (number * num_calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run lexmapr microbenchmarks.")
+    parser.add_argument("-k", "--filter",
+                        help="Only run benchmarks with this string in their name or parameters.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of rounds to take the best time of. Defaults to 5.")
+    parser.add_argument("-o", "--output", help="Write results to this file as JSON.")
+    parser.add_argument("--compare", help="Results file of an earlier run to compare to.")
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+
+    results = {}
+    print("benchmark\tparameters\tusec_per_call")
+    for name, params, function in get_benchmarks():
+        key = "%s[%s]" % (name, params)
+        if args.filter and args.filter not in key:
+            continue
+        results[key] = round(time_benchmark(function, args.repeat), 4)
+        row = "%s\t%s\t%.3f" % (name, params, results[key])
+        if previous.get(key):
+            row += "\t(x%.2f)" % (previous[key] / results[key])
+        print(row, flush=True)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=4)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
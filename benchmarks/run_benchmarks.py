@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmarks of the ``lexmapr`` command.
+
+Each corpus in ``lexmapr/tests/test_input`` is mapped by ``bin/lexmapr``
+in a fresh process, with and without ``--bucket`` and ``--full``,
+against the predefined lookup tables and against a config of local
+test ontologies. For every case, samples mapped per second, p50 and p99
+per-sample latency, peak resident memory and startup time are measured,
+and compared against a baseline file, so regressions are flagged.
+
+Startup cases time commands that map nothing, like ``lexmapr --version``
+and importing ``lexmapr.pipeline``, so imports of slow dependencies that
+are not needed are flagged too.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py              # compare to baseline
+    python benchmarks/run_benchmarks.py --update-baseline
+    python benchmarks/run_benchmarks.py --startup-only
+
+The exit status is 1 if any metric regressed by more than
+``--tolerance``.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEXMAPR = os.path.join(ROOT, "bin", "lexmapr")
+TEST_INPUT = os.path.join(ROOT, "lexmapr", "tests", "test_input")
+TEST_ONTOLOGIES = os.path.join(ROOT, "lexmapr", "tests", "test_ontologies")
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+CORPORA = ["zheminSamples", "GRDI-UniqueSamples", "genomeTrackerMaster", "bccdcsample"]
+
+# Command-line arguments of each output mode
+MODES = {
+    "default": [],
+    "full": ["--full"],
+    "bucket": ["--full", "--bucket"],
+}
+
+# Lookup tables mapped against
+TABLES = ["predefined", "config"]
+
+# Ontologies of the ``config`` lookup tables
+CONFIG_ONTOLOGIES = ["pizza.owl", "bfo.owl"]
+
+# Python arguments of each startup case
+STARTUP_CASES = {
+    "startup/version": [LEXMAPR, "--version"],
+    "startup/help": [LEXMAPR, "--help"],
+    "startup/import": ["-c", "import lexmapr.pipeline"],
+}
+
+# Metrics compared against the baseline, and whether larger values are
+# better
+METRICS = {
+    "samples_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+    "startup_sec": False,
+}
+
+
+def percentile(values, percent):
+    """Get the ``percent`` percentile of ``values``.
+
+    Values are linearly interpolated between the closest ranks.
+
+    :param list[float] values: Non-empty list of values
+    :param float percent: Percentile, from ``0`` to ``100``
+    :rtype: float
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def run_lexmapr(args, env):
+    """Run ``bin/lexmapr`` in a new process.
+
+    :param list[str] args: Command-line arguments of ``bin/lexmapr``
+    :param dict env: Environment of the process
+    :returns: See ``run_python``
+    :rtype: tuple[float, float]
+    :raises subprocess.CalledProcessError: If ``bin/lexmapr`` fails
+    """
+    return run_python([LEXMAPR] + args, env)
+
+
+def run_python(args, env):
+    """Run Python in a new process.
+
+    :param list[str] args: Command-line arguments of Python
+    :param dict env: Environment of the process
+    :returns: Wall seconds the process ran for, and its peak resident
+        memory in MB
+    :rtype: tuple[float, float]
+    :raises subprocess.CalledProcessError: If the process fails
+    """
+    cmd = [sys.executable] + args
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.stderr.close()
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+
+    # ``ru_maxrss`` is in bytes on macOS, and KB elsewhere
+    peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return seconds, peak_rss
+
+
+def get_case_args(mode, table, config_path):
+    """Get the ``bin/lexmapr`` arguments of a benchmark case.
+
+    :param str mode: One of ``MODES``
+    :param str table: One of ``TABLES``
+    :param str config_path: Path of the ``config`` lookup tables config
+    :rtype: list[str]
+    """
+    ret = list(MODES[mode])
+    if table == "config":
+        ret += ["--config", config_path]
+    return ret
+
+
+def benchmark_case(corpus, case_args, repeat, work_dir, env):
+    """Measure the metrics of mapping a corpus.
+
+    The median of each metric over ``repeat`` runs is returned.
+    Startup time is the time taken to map an input file without
+    samples, with the same arguments.
+
+    :param str corpus: One of ``CORPORA``
+    :param list[str] case_args: See ``get_case_args``
+    :param int repeat: Number of times to map the corpus
+    :param str work_dir: Directory to write output and logs to
+    :param dict env: Environment of ``bin/lexmapr`` processes
+    :returns: Number of samples, and the value of each of ``METRICS``
+    :rtype: dict
+    """
+    input_file = os.path.join(TEST_INPUT, corpus + ".csv")
+    empty_file = os.path.join(TEST_INPUT, "empty.csv")
+    output_file = os.path.join(work_dir, "output.tsv")
+    slow_log = os.path.join(work_dir, "samples.jsonl")
+
+    runs = []
+    for _ in range(repeat):
+        startup, _ = run_lexmapr([empty_file, "-o", output_file] + case_args, env)
+        # Every sample is slower than the threshold, so its time is logged
+        seconds, peak_rss = run_lexmapr([input_file, "-o", output_file, "--slow-log", slow_log,
+                                         "--slow-threshold", "1e-9"] + case_args, env)
+        with open(slow_log) as fp:
+            latencies = [json.loads(line)["seconds"] for line in fp]
+        mapping_seconds = max(seconds - startup, sum(latencies))
+        runs.append({
+            "samples": len(latencies),
+            "samples_per_sec": len(latencies) / mapping_seconds if mapping_seconds else 0.0,
+            "p50_ms": 1000 * percentile(latencies, 50) if latencies else 0.0,
+            "p99_ms": 1000 * percentile(latencies, 99) if latencies else 0.0,
+            "peak_rss_mb": peak_rss,
+            "startup_sec": startup,
+        })
+
+    ret = {"samples": runs[0]["samples"]}
+    for metric in METRICS:
+        ret[metric] = round(statistics.median(run[metric] for run in runs), 4)
+    return ret
+
+
+def benchmark_startup(args, repeat, env):
+    """Measure the startup time and memory of a Python command.
+
+    :param list[str] args: One of ``STARTUP_CASES``
+    :param int repeat: Number of times to run the command
+    :param dict env: Environment of Python processes
+    :returns: Median ``startup_sec`` and ``peak_rss_mb``
+    :rtype: dict
+    """
+    runs = [run_python(args, env) for _ in range(repeat)]
+    return {
+        "startup_sec": round(statistics.median(seconds for seconds, _ in runs), 4),
+        "peak_rss_mb": round(statistics.median(peak_rss for _, peak_rss in runs), 4),
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Get the metrics of ``results`` that regressed from ``baseline``.
+
+    :param dict results: Metrics of each benchmark case, by case name
+    :param dict baseline: Metrics of each benchmark case, by case name
+    :param float tolerance: Fraction a metric may be worse than its
+        baseline value by before it is flagged
+    :returns: Case name, metric, baseline value and new value of each
+        regression
+    :rtype: list[tuple]
+    """
+    ret = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, larger_is_better in METRICS.items():
+            old = baseline[case].get(metric)
+            new = metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if larger_is_better else change) > tolerance:
+                ret.append((case, metric, old, new))
+    return ret
+
+
+def get_machine():
+    """Get a description of the machine benchmarks are run on.
+
+    :rtype: dict
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_results(results, baseline):
+    """Print the metrics of each benchmark case, and their change.
+
+    :param dict results: Metrics of each benchmark case, by case name
+    :param dict baseline: Metrics of each benchmark case, by case name
+    """
+    print("\t".join(["case", "samples"] + list(METRICS)))
+    for case, metrics in results.items():
+        row = [case, str(metrics.get("samples", "-"))]
+        for metric in METRICS:
+            if metric not in metrics:
+                row.append("-")
+                continue
+            cell = "%.3f" % metrics[metric]
+            old = baseline.get(case, {}).get(metric)
+            if old:
+                cell += " (%+.1f%%)" % (100 * (metrics[metric] - old) / old)
+            row.append(cell)
+        print("\t".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run end-to-end lexmapr benchmarks.")
+    parser.add_argument("--corpus", action="append", choices=CORPORA,
+                        help="Corpus to benchmark. May be repeated. Defaults to all corpora.")
+    parser.add_argument("--mode", action="append", choices=list(MODES),
+                        help="Output mode to benchmark. May be repeated. Defaults to all modes.")
+    parser.add_argument("--table", action="append", choices=TABLES,
+                        help="Lookup tables to benchmark. May be repeated. Defaults to all.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of runs of each case to take the median of. Defaults to 3.")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="Baseline file to compare to. Defaults to benchmarks/baseline.json.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction a metric may be worse than its baseline value by before "
+                             "it is flagged as a regression. Defaults to 0.25.")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Write results to the baseline file instead of comparing to it.")
+    parser.add_argument("--startup-only", action="store_true",
+                        help="Only run startup cases, which map no samples.")
+    parser.add_argument("-o", "--output", help="Write results to this file as JSON.")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    # Hash randomization changes the order samples' matches are tried in
+    env["PYTHONHASHSEED"] = "0"
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline_json = json.load(fp)
+        baseline = baseline_json["results"]
+        if not args.update_baseline and baseline_json["machine"] != get_machine():
+            print("Warning: baseline was recorded on a different machine: %s"
+                  % baseline_json["machine"], file=sys.stderr)
+
+    results = {}
+    for case, case_args in STARTUP_CASES.items():
+        print("Running " + case, file=sys.stderr)
+        results[case] = benchmark_startup(case_args, args.repeat, env)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_path = os.path.join(work_dir, "config.json")
+        with open(config_path, "w") as fp:
+            json.dump([{os.path.join(TEST_ONTOLOGIES, ontology): ""}
+                       for ontology in CONFIG_ONTOLOGIES], fp)
+
+        for table in [] if args.startup_only else args.table or TABLES:
+            # Build cached lookup tables outside of measured runs
+            run_lexmapr([os.path.join(TEST_INPUT, "empty.csv"), "-o",
+                         os.path.join(work_dir, "output.tsv")]
+                        + get_case_args("bucket", table, config_path), env)
+            for corpus in args.corpus or CORPORA:
+                for mode in args.mode or MODES:
+                    case = "%s/%s/%s" % (corpus, mode, table)
+                    print("Running " + case, file=sys.stderr)
+                    case_args = get_case_args(mode, table, config_path)
+                    results[case] = benchmark_case(corpus, case_args, args.repeat, work_dir,
+                                                   env)
+
+    print_results(results, baseline)
+
+    results_json = {"machine": get_machine(), "results": results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results_json, fp, indent=4)
+            fp.write("\n")
+
+    if args.update_baseline:
+        # Keep baseline values of cases that were not run
+        baseline.update(results)
+        with open(args.baseline, "w") as fp:
+            json.dump({"machine": get_machine(), "results": baseline}, fp, indent=4)
+            fp.write("\n")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for case, metric, old, new in regressions:
+        print("Regression: %s %s %.3f -> %.3f" % (case, metric, old, new), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
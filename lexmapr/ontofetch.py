@@ -29,6 +29,11 @@
 
 		> python ontofetch.py https://raw.githubusercontent.com/obi-ontology/obi/master/obi.owl -o test/ -r http://purl.obolibrary.org/obo/OBI_0200111,http://purl.obolibrary.org/obo/IAO_0000572
 
+	Retrieve the NCBITaxon "Bacteria" branch by streaming the ontology file,
+	rather than loading all of it into memory
+
+		> python ontofetch.py http://purl.obolibrary.org/obo/ncbitaxon.owl -o test/ -r http://purl.obolibrary.org/obo/NCBITaxon_2 -e stream
+
 	FUTURE: Get ontology version, and add to "version" field
 	
 	**************************************************************************
@@ -38,9 +43,15 @@ import json
 import sys
 import os
 import optparse
+import pathlib
+import shutil
+import tempfile
+import urllib.request
+from xml.etree.ElementTree import ParseError
 
 #from ontohelper import OntoHelper as oh
 import lexmapr.ontohelper as oh
+import lexmapr.ontostream as ontostream
 
 import rdflib
 from rdflib.plugins.sparql import prepareQuery
@@ -58,6 +69,17 @@ def stop_err(msg, exit_code = 1):
 	sys.stderr.write("%s\n" % msg)
 	sys.exit(exit_code)
 
+def get_order_key(term):
+	"""
+	Sort key ordering RDF terms as in a SPARQL ORDER BY clause: blank nodes,
+	then IRIs, then literals.
+	"""
+	if isinstance(term, rdflib.BNode):
+		return (1, term)
+	elif isinstance(term, rdflib.URIRef):
+		return (2, term)
+	return (3, term)
+
 class MyParser(optparse.OptionParser):
 	"""
 	Allows formatted help info.  From http://stackoverflow.com/questions/1857346/python-optparse-how-to-include-additional-info-in-usage-output.
@@ -84,6 +106,13 @@ class Ontology(object):
 		# LOOKUP TABLE: 'updated','preferred'
 		self.fields = self.FIELDS + self.onto_helper.SYNONYM_FIELDS
 
+		# Text and synonym annotations of entities, by entity id. See
+		# get_entity_annotations()
+		self.entity_annotations = {}
+
+		# owl:imports of the main ontology file, once it is fetched
+		self.imports = []
+
 		""" 
 		Add these PREFIXES to Sparql query window if you want to test a query there:
 
@@ -114,29 +143,6 @@ class Ontology(object):
 			""", initNs = self.onto_helper.namespace),
 
 
-			# ################################################################
-			# UI LABELS 
-			# These are annotations directly on an entity.  This is the only place
-			# that ui_label and ui_definition should really operate. Every entity
-			# in OWL file is retrieved for their rdfs:label, IAO definition etc.
-			# FUTURE: ADD SORTING OPTIONS, CUSTOM ORDER.
-			'entity_text': prepareQuery("""
-
-				SELECT DISTINCT ?label ?definition ?ui_label ?ui_definition
-				WHERE {  
-					{?datum rdf:type owl:Class} 
-					UNION {?datum rdf:type owl:NamedIndividual} 
-					UNION {?datum rdf:type rdf:Description}.
-					OPTIONAL {?datum rdfs:label ?label.} 
-					OPTIONAL {?datum IAO:0000115 ?definition.}
-					OPTIONAL {?datum GENEPIO:0000006 ?ui_label.} 
-					OPTIONAL {?datum GENEPIO:0000162 ?ui_definition.}
-				} ORDER BY ?label
-			""", initNs = self.onto_helper.namespace),
-
-
-
-
 			# ################################################################
 			# Fetch parent IDs of given entity. with respect to class-subclass
 			# relations.
@@ -181,21 +187,41 @@ class Ontology(object):
 
 		(main_ontology_file, output_file_basename) = self.onto_helper.check_ont_file(args[0], options)
 
-		# Load main ontology file into RDF graph
-		print ("Fetching and parsing " + main_ontology_file + " ...")
-
-		try:
-			# ISSUE: ontology file taken in as ascii; rdflib doesn't accept
-			# utf-8 characters so can experience conversion issues in string
-			# conversion stuff like .replace() below
-			self.onto_helper.graph.parse(main_ontology_file, format='xml')
-
-		except Exception as e:
-			#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
-			stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
-
-		# Add each ontology include file (must be in OWL RDF format)
-		self.onto_helper.do_ontology_includes(main_ontology_file)
+		# Local copy of main ontology file to read instead, and the IRI
+		# its relative IRIs resolve against.  Imports are still resolved
+		# relative to main ontology file.
+		source = None
+		if options.source:
+			base = options.base
+			if not base and main_ontology_file[0:4].lower() == 'http':
+				base = main_ontology_file
+			elif not base:
+				base = pathlib.Path(os.path.abspath(options.source)).as_uri()
+			source = (options.source, base)
+
+		if options.engine == 'stream':
+			# Load only the triples needed below into RDF graph
+			self.do_stream_ontology(main_ontology_file, options.root_uri.split(','), source)
+
+		else:
+			# Load main ontology file into RDF graph
+			print ("Fetching and parsing " + main_ontology_file + " ...")
+
+			try:
+				# ISSUE: ontology file taken in as ascii; rdflib doesn't accept
+				# utf-8 characters so can experience conversion issues in string
+				# conversion stuff like .replace() below
+				if source:
+					self.onto_helper.graph.parse(source[0], format='xml', publicID=source[1])
+				else:
+					self.onto_helper.graph.parse(main_ontology_file, format='xml')
+
+			except Exception as e:
+				#urllib2.URLError: <urlopen error [Errno 8] nodename nor servname provided, or not known>
+				stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+
+			# Add each ontology include file (must be in OWL RDF format)
+			self.imports = self.onto_helper.do_ontology_includes(main_ontology_file)
 
 		# Load self.struct with ontology metadata
 		self.onto_helper.set_ontology_metadata(self.onto_helper.queries['ontology_metadata'])
@@ -213,6 +239,161 @@ class Ontology(object):
 		self.onto_helper.do_output_tsv(self.onto_helper.struct, output_file_basename, self.fields)
 
 
+	def do_stream_ontology(self, main_ontology_file, root_ids, source=None):
+		"""
+		Alternative to parsing the main ontology file and its imports into
+		self.onto_helper.graph in full.  Files are stream-parsed twice
+		instead, so memory use is bounded by the size of the fetched
+		branches rather than of the ontology.
+
+		The 1st pass collects the rdfs:subClassOf hierarchy, the owl:imports
+		of the main file, and the owl:Ontology resources.  The 2nd pass adds
+		to the graph the triples of the root entities' descendants, and the
+		ontology metadata, that the 'tree' and 'ontology_metadata' queries
+		and get_entity_annotations() read.  These are added in the same
+		order parsing would add them, so the same specifications result.
+
+		Subclass axioms on anonymous classes and rdf:parseType="Literal"
+		annotations are not read.  As with do_ontology_includes(), imports
+		of imports are not followed.
+
+		INPUT
+			main_ontology_file:string: A filepath or URL of ontology
+			root_ids:list: Full URI ids of root entities to fetch
+			source:tuple: File path of a local copy of main_ontology_file
+				to read instead, and the IRI its relative IRIs resolve
+				against, if any
+		"""
+		namespace = self.onto_helper.namespace
+		rdf_type = str(namespace['rdf'] + 'type')
+		subclass_of = str(namespace['rdfs'] + 'subClassOf')
+		owl_imports = str(namespace['owl'] + 'imports')
+		owl_ontology = str(namespace['owl'] + 'Ontology')
+
+		entity_predicates = {rdf_type, subclass_of,
+			str(namespace['rdfs'] + 'label'),
+			str(namespace['IAO'] + '0000115'),
+			str(namespace['GENEPIO'] + '0000006'),
+			str(namespace['GENEPIO'] + '0000162'),
+			str(namespace['owl'] + 'deprecated'),
+			str(namespace['IAO'] + '0100001')}
+		for field in self.onto_helper.SYNONYM_FIELDS:
+			(prefix, name) = field.split('_', 1)
+			entity_predicates.add(str(namespace[prefix] + name))
+
+		metadata_predicates = {rdf_type, str(namespace['owl'] + 'versionIRI'),
+			str(namespace['oboInOwl'] + 'default-namespace')}
+		for name in ['title', 'description', 'license', 'date']:
+			metadata_predicates.add(str(namespace['dc'] + name))
+			metadata_predicates.add(str(namespace['terms'] + name))
+
+		# Subclass ids by parent id, and owl:Ontology ids
+		children = {}
+		ontology_ids = set()
+		imports = []
+
+		def do_scan(source):
+			for (s, p, o) in ontostream.iter_triples(*source, predicates={rdf_type, subclass_of, owl_imports}):
+				if isinstance(s, rdflib.BNode) or isinstance(o, rdflib.BNode):
+					continue
+				if p == subclass_of:
+					if not isinstance(o, rdflib.Literal):
+						children.setdefault(o, []).append(s)
+				elif p == rdf_type:
+					if o == owl_ontology:
+						ontology_ids.add(s)
+				elif source is sources[0] and o not in imports:
+					imports.append(o)
+
+		print ("Fetching and streaming " + main_ontology_file + " ...")
+
+		temp_files = []
+		try:
+			try:
+				sources = [source or self.get_stream_source(main_ontology_file, temp_files)]
+				do_scan(sources[0])
+			except Exception as e:
+				stop_err('WARNING:' + main_ontology_file + " could not be loaded!\n", e)
+
+			# Add each ontology include file (must be in OWL RDF format)
+			imports = sorted([o if isinstance(o, rdflib.Literal) else rdflib.URIRef(o) for o in imports], key=get_order_key)
+			print ("It has %s import files ..." % len(imports))
+			self.imports = [str(import_file) for import_file in imports]
+
+			for import_file in imports:
+				print (import_file)
+				if main_ontology_file[0:4] == 'http':
+					try:
+						sources.append(self.get_stream_source(import_file, temp_files))
+						do_scan(sources[-1])
+					except Exception as e:
+						print ('WARNING:' + import_file + " could not be loaded!\n", e)
+				else:
+					file_path = os.path.dirname(main_ontology_file) + '/imports/' + import_file.rsplit('/',1)[1]
+					if os.path.isfile(file_path):
+						try:
+							sources.append(self.get_stream_source(file_path, temp_files))
+							do_scan(sources[-1])
+						except ParseError as e:
+							print (file_path + " needs to be in RDF OWL format!")
+					else:
+						print ('WARNING:' + file_path + " could not be loaded!  Does its ontology include purl have a corresponding local file? \n")
+
+			# Root entities and all their descendants
+			entity_ids = set(root_ids)
+			stack = list(root_ids)
+			while stack:
+				for child_id in children.get(stack.pop(), []):
+					if child_id not in entity_ids:
+						entity_ids.add(child_id)
+						stack.append(child_id)
+			children = None
+
+			graph = self.onto_helper.graph
+			for source in sources:
+				try:
+					for (s, p, o) in ontostream.iter_triples(*source, predicates=entity_predicates | metadata_predicates):
+						if isinstance(s, rdflib.BNode) or isinstance(o, rdflib.BNode):
+							continue
+						if (s in entity_ids and p in entity_predicates) or (s in ontology_ids and p in metadata_predicates):
+							if not isinstance(o, rdflib.Literal):
+								o = rdflib.URIRef(o)
+							graph.add((rdflib.URIRef(s), rdflib.URIRef(p), o))
+				except ParseError:
+					# Reported in 1st pass
+					pass
+
+		finally:
+			for temp_file in temp_files:
+				os.remove(temp_file)
+
+
+	def get_stream_source(self, ontology_file, temp_files):
+		"""
+		Returns arguments to ontostream.iter_triples() for given ontology
+		file path or URL.  A URL is downloaded to a temporary file first, so
+		it can be streamed more than once; its path is added to temp_files.
+
+		INPUT
+			ontology_file:string: A filepath or URL of ontology
+			temp_files:list: Paths of temporary files to remove when done
+		OUTPUT
+			(path, base):tuple of file path and document IRI
+		"""
+		if ontology_file[0:4].lower() != 'http':
+			return (ontology_file, pathlib.Path(os.path.abspath(ontology_file)).as_uri())
+
+		(handle, path) = tempfile.mkstemp(suffix='.owl')
+		temp_files.append(path)
+		with os.fdopen(handle, 'wb') as output_handle:
+			with urllib.request.urlopen(str(ontology_file)) as response:
+				shutil.copyfileobj(response, output_handle)
+				# Relative IRIs resolve against URL redirected to, if any
+				base = response.geturl()
+
+		return (path, base)
+
+
 	def do_entities(self, table):
 		""" 
 			Converts table of ontology terms - each having its own row of
@@ -236,6 +417,11 @@ class Ontology(object):
 		# List of parents to process after 1st pass through table's entities.
 		parents = [] 
 
+		# Annotations of all entities in table are gathered in one pass
+		# over the graph, and joined to each entity by do_entity().
+		for myDict in table:
+			self.get_entity_annotations(str(myDict['id']))
+
 		for myDict in table:
 			self.do_entity(myDict)
 
@@ -298,31 +484,79 @@ class Ontology(object):
 		self.do_entity_synonyms(id)
 
 
-	def do_entity_text(self, id):
+	def get_entity_annotations(self, id):
 		"""
-		For given entity, all 'labels' query fields are returned (rdfs:label, IAO 
-		definition, UI label, UI definition) and added to the entity directly.
+		Returns the text and synonym annotations of given entity, gathered by
+		iterating over its triples directly rather than by SPARQL query.
+		Annotations are cached by entity id.
 
+		Text annotations match the last row of the former 'entity_text'
+		query, i.e. the greatest rdfs:label in ORDER BY order, and the last
+		IAO definition, UI label and UI definition. They are only returned
+		for owl:Class, owl:NamedIndividual or rdf:Description entities.
+
+		Synonym annotations match the rows of the 'entity_synonyms' query,
+		in SYNONYM_FIELDS order. They are only returned for owl:Class or
+		owl:NamedIndividual entities.
+
+		INPUT
+			id:string
+		OUTPUT
+			text:dict of label, definition, ui_label and ui_definition
+			synonyms:list of (synonym field, synonym) tuples
 		"""
+		if id in self.entity_annotations:
+			return self.entity_annotations[id]
+
+		graph = self.onto_helper.graph
+		namespace = self.onto_helper.namespace
 		myURI = rdflib.URIRef(self.onto_helper.get_expanded_id(id))
-		rows = self.onto_helper.graph.query(
-			self.queries['entity_text'],	
-			initBindings = {'datum': myURI} 
-		)
-		# Should only be 1 row to loop through
-		for row in rows: 
-			myDict = row.asdict()	
-			# Adds any new text items to given id's structure
-			self.onto_helper.struct['specifications'][id].update(myDict) 
+		rdf_type = namespace['rdf'] + 'type'
+		is_class = (myURI, rdf_type, namespace['owl'] + 'Class') in graph \
+			or (myURI, rdf_type, namespace['owl'] + 'NamedIndividual') in graph
+
+		text = {}
+		if is_class or (myURI, rdf_type, namespace['rdf'] + 'Description') in graph:
+			labels = list(graph.objects(myURI, namespace['rdfs'] + 'label'))
+			if labels:
+				text['label'] = sorted(labels, key=get_order_key)[-1]
+			for (field, predicate) in [
+				('definition', namespace['IAO'] + '0000115'),
+				('ui_label', namespace['GENEPIO'] + '0000006'),
+				('ui_definition', namespace['GENEPIO'] + '0000162')]:
+				values = list(graph.objects(myURI, predicate))
+				if values:
+					text[field] = values[-1]
 			# Issue: carriage returns in definition; this is taken care of in
 			# do_output_tsv()
 
+		synonyms = []
+		if is_class:
+			for field in self.onto_helper.SYNONYM_FIELDS:
+				(prefix, name) = field.split('_', 1)
+				for synonym in graph.objects(myURI, namespace[prefix] + name):
+					synonyms.append((field, synonym))
+
+		self.entity_annotations[id] = (text, synonyms)
+		return self.entity_annotations[id]
+
+
+	def do_entity_text(self, id):
+		"""
+		For given entity, all 'labels' fields are returned (rdfs:label, IAO 
+		definition, UI label, UI definition) and added to the entity directly.
+
+		"""
+		(text, synonyms) = self.get_entity_annotations(id)
+		# Adds any new text items to given id's structure
+		self.onto_helper.struct['specifications'][id].update(text) 
+
 
 	def do_entity_synonyms(self, id):
 		"""
 		Augment each entry in 'specifications' with semi-colon-delimited 
-		synonyms gathered from 'entity_synonyms' query of annotations which
-		originate in these relations 
+		synonyms gathered from annotations which originate in these 
+		relations 
 
 			oboInOwl:hasSynonym
 			oboInOwl:hasBroadSynonym
@@ -341,31 +575,25 @@ class Ontology(object):
 			for each of above fields, an array containing one or more terms
 		"""
 		
-		myURI = rdflib.URIRef(self.onto_helper.get_expanded_id(id))
-		rows = self.onto_helper.graph.query(
-			self.onto_helper.queries['entity_synonyms'], 
-			initBindings = {'datum': myURI }
-		)
+		(text, synonyms) = self.get_entity_annotations(id)
 
 		spec = self.onto_helper.struct['specifications'][id]
 
-		for row in rows:
-
-			# Specification distinguishes between these kinds of synonym
-			for field in self.onto_helper.SYNONYM_FIELDS:
+		# Specification distinguishes between these kinds of synonym
+		for (field, synonym) in synonyms:
 
-				if row[field]: 
-					# Clean up synonym phrases.  Can't split comma-delimited synonyms
-					# because a number of ontologies have phrase synonyms with commas
-					# in them.  Also chemistry expressions have tight (no space)
-					# comma separated synonyms
-					phrases = row[field].replace('\\n', ';').strip().replace('"','').split(';')
-					if phrases:
-						prefix_field = field.replace('_',':',1)
-						if prefix_field in spec:
-							spec[prefix_field] += phrases
-						else:
-							spec[prefix_field] = phrases
+			if synonym: 
+				# Clean up synonym phrases.  Can't split comma-delimited synonyms
+				# because a number of ontologies have phrase synonyms with commas
+				# in them.  Also chemistry expressions have tight (no space)
+				# comma separated synonyms
+				phrases = synonym.replace('\\n', ';').strip().replace('"','').split(';')
+				if phrases:
+					prefix_field = field.replace('_',':',1)
+					if prefix_field in spec:
+						spec[prefix_field] += phrases
+					else:
+						spec[prefix_field] = phrases
 
 
 	def get_command_line(self):
@@ -387,6 +615,12 @@ class Ontology(object):
 		
 		parser.add_option('-r', '--root', dest='root_uri', type='string', help='Comma separated list of full URI root entity ids to fetch underlying terms from. Defaults to owl#Thing.', default='http://www.w3.org/2002/07/owl#Thing')
 
+		parser.add_option('-s', '--source', dest='source', type='string', help='Path of a local copy of the ontology file or URL to read instead, e.g. one already downloaded. Imports are still resolved relative to the ontology file or URL.')
+
+		parser.add_option('-b', '--base', dest='base', type='string', help='IRI that relative IRIs in the --source file resolve against. Defaults to the ontology URL, or the --source file.')
+
+		parser.add_option('-e', '--engine', dest='engine', type='choice', choices=['graph', 'stream'], help='How to read the ontology: "graph" parses all of it into memory, "stream" stream-parses it for only the terms to fetch. Defaults to graph.', default='graph')
+
 		return parser.parse_args()
 
 
@@ -320,7 +320,9 @@ class OntoHelper(object):
 		folder relative to that file.  Otherwise they are fetched by URL.
 
 		INPUT
-
+			main_ontology_file:string: A filepath or URL of ontology
+		OUTPUT
+			imports:list: IRIs of the import files
 		"""
 		imports = self.graph.query("""
 			SELECT distinct ?import_file
@@ -357,6 +359,8 @@ class OntoHelper(object):
 				except rdflib.exceptions.ParserError as e:
 					print (file_path + " needs to be in RDF OWL format!")			
 
+		return [str(result_row.import_file) for result_row in imports]
+
 
 	def set_ontology_metadata(self, query):
 		""" 
@@ -0,0 +1,249 @@
+"""Stream RDF/XML documents as triples, without building a graph."""
+
+from urllib.parse import urldefrag, urljoin
+from xml.etree import ElementTree
+
+from rdflib import BNode, Literal
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+RDF_RDF = RDF_NS + "RDF"
+RDF_DESCRIPTION = RDF_NS + "Description"
+RDF_TYPE = RDF_NS + "type"
+RDF_LI = RDF_NS + "li"
+RDF_ABOUT = RDF_NS + "about"
+RDF_ID = RDF_NS + "ID"
+RDF_NODE_ID = RDF_NS + "nodeID"
+RDF_RESOURCE = RDF_NS + "resource"
+RDF_DATATYPE = RDF_NS + "datatype"
+RDF_PARSE_TYPE = RDF_NS + "parseType"
+
+XML_BASE = "{%s}base" % XML_NS
+XML_LANG = "{%s}lang" % XML_NS
+
+# Unqualified attributes read as RDF syntax attributes
+UNQUALIFIED_ATTRIBUTES = {
+    "about": RDF_ABOUT, "ID": RDF_ID, "type": RDF_TYPE, "resource": RDF_RESOURCE,
+    "parseType": RDF_PARSE_TYPE
+}
+NODE_ELEMENT_ATTRIBUTES = {RDF_ID, RDF_NODE_ID, RDF_ABOUT}
+PROPERTY_ELEMENT_ATTRIBUTES = {RDF_ID, RDF_RESOURCE, RDF_NODE_ID, RDF_DATATYPE}
+
+# Kinds of elements, by what their children are
+DOCUMENT, NODE, PROPERTY, COLLECTION, LITERAL = range(5)
+
+
+class _Frame:
+    """An open element of an RDF/XML document."""
+
+    __slots__ = ["kind", "base", "language", "subject", "predicate", "object", "datatype", "li"]
+
+    def __init__(self, kind, base, language):
+        self.kind = kind
+        self.base = base
+        self.language = language
+        self.subject = None
+        self.predicate = None
+        self.object = None
+        self.datatype = None
+        self.li = 0
+
+
+def absolutize(base, iri):
+    """Resolve ``iri`` against ``base`` like ``rdflib`` does.
+
+    :param str base: Base IRI
+    :param str iri: Possibly relative IRI
+    :rtype: str
+    """
+    ret = urljoin(base, iri, allow_fragments=True)
+    if iri and iri[-1] == "#" and ret[-1] != "#":
+        ret += "#"
+    return ret
+
+
+def get_name(tag):
+    """Get IRI of an ElementTree tag or attribute name.
+
+    :param str tag: ``{namespace}local`` or ``local`` name
+    :rtype: str
+    """
+    if tag[0] == "{":
+        namespace, local = tag[1:].split("}", 1)
+        return namespace + local
+    return tag
+
+
+def get_attributes(element):
+    """Get the RDF attributes of an element by IRI.
+
+    ``xml`` attributes are skipped, and unqualified RDF syntax
+    attributes are qualified.
+
+    :param xml.etree.ElementTree.Element element: RDF/XML element
+    :rtype: dict[str, str]
+    """
+    ret = {}
+    for name, value in element.attrib.items():
+        attribute = get_name(name)
+        if attribute.startswith(XML_NS) or attribute[0:3].lower() == "xml":
+            continue
+        ret[UNQUALIFIED_ATTRIBUTES.get(attribute, attribute)] = value
+    return ret
+
+
+def iter_triples(source, base, predicates=None):
+    """Iterate over the triples of an RDF/XML document.
+
+    The document is parsed incrementally, and elements are discarded
+    once read, so memory use does not grow with document size. Triples
+    are yielded in the order ``rdflib`` adds them to a graph when
+    parsing the same document.
+
+    IRIs are yielded as ``str``, blank nodes as ``rdflib.BNode`` and
+    literals as ``rdflib.Literal``. Reification of property elements
+    with ``rdf:ID``, ``rdf:parseType="Collection"`` lists, and
+    ``rdf:parseType="Literal"`` XML literals are not yielded.
+
+    :param source: Path or binary file object of RDF/XML document
+    :param str base: IRI of document, to resolve relative IRIs with
+    :param set[str] predicates: If specified, only triples with these
+        predicates are yielded
+    :rtype: collections.abc.Iterator[tuple]
+    :raises xml.etree.ElementTree.ParseError: If ``source`` is not
+        well-formed XML
+    """
+    base = urldefrag(base)[0]
+    blank_nodes = {}
+    stack = []
+    document_element = None
+
+    def is_wanted(predicate):
+        return predicates is None or predicate in predicates
+
+    for event, element in ElementTree.iterparse(source, events=("start", "end")):
+        if event == "start":
+            parent = stack[-1] if stack else None
+            parent_base = parent.base if parent else base
+            element_base = element.get(XML_BASE)
+            if element_base is None:
+                element_base = parent_base
+            else:
+                element_base = urljoin(parent_base, urldefrag(element_base)[0])
+            language = element.get(XML_LANG, parent.language if parent else None)
+            name = get_name(element.tag)
+
+            if parent is None:
+                document_element = element
+                if name == RDF_RDF:
+                    stack.append(_Frame(DOCUMENT, element_base, language))
+                    continue
+                parent_kind = DOCUMENT
+            else:
+                parent_kind = parent.kind
+
+            if parent_kind == LITERAL:
+                stack.append(_Frame(LITERAL, element_base, language))
+                continue
+
+            attributes = get_attributes(element)
+
+            if parent_kind in (DOCUMENT, PROPERTY, COLLECTION):
+                # Node element
+                frame = _Frame(NODE, element_base, language)
+                if RDF_ID in attributes:
+                    subject = absolutize(element_base, "#" + attributes[RDF_ID])
+                elif RDF_NODE_ID in attributes:
+                    subject = blank_nodes.setdefault(attributes[RDF_NODE_ID], BNode())
+                elif RDF_ABOUT in attributes:
+                    subject = absolutize(element_base, attributes[RDF_ABOUT])
+                else:
+                    subject = BNode()
+                frame.subject = subject
+
+                if name != RDF_DESCRIPTION and is_wanted(RDF_TYPE):
+                    yield subject, RDF_TYPE, absolutize(element_base, name)
+                for attribute, value in attributes.items():
+                    if attribute in NODE_ELEMENT_ATTRIBUTES:
+                        continue
+                    predicate = absolutize(element_base, attribute)
+                    if not is_wanted(predicate):
+                        continue
+                    if attribute == RDF_TYPE:
+                        yield subject, predicate, absolutize(element_base, value)
+                    else:
+                        yield subject, predicate, Literal(value, language)
+
+                if parent_kind == PROPERTY:
+                    parent.object = subject
+                stack.append(frame)
+            else:
+                # Property element, of a node element or of a
+                # ``rdf:parseType="Resource"`` property element
+                frame = _Frame(PROPERTY, element_base, language)
+                if parent.predicate is None:
+                    frame.subject = parent.subject
+                else:
+                    frame.subject = parent.object
+                if name == RDF_LI:
+                    parent.li += 1
+                    frame.predicate = "%s_%s" % (RDF_NS, parent.li)
+                else:
+                    frame.predicate = absolutize(element_base, name)
+
+                parse_type = attributes.get(RDF_PARSE_TYPE)
+                if RDF_RESOURCE in attributes:
+                    frame.object = absolutize(element_base, attributes[RDF_RESOURCE])
+                elif RDF_NODE_ID in attributes:
+                    frame.object = blank_nodes.setdefault(attributes[RDF_NODE_ID], BNode())
+                elif parse_type == "Resource":
+                    frame.object = BNode()
+                    frame.kind = NODE
+                    stack.append(frame)
+                    continue
+                elif parse_type == "Collection":
+                    frame.kind = COLLECTION
+                    stack.append(frame)
+                    continue
+                elif parse_type is not None:
+                    frame.kind = LITERAL
+                    stack.append(frame)
+                    continue
+
+                frame.datatype = attributes.get(RDF_DATATYPE)
+                if frame.datatype is not None:
+                    frame.datatype = absolutize(element_base, frame.datatype)
+                else:
+                    # Property attributes describe a blank node object
+                    for attribute, value in attributes.items():
+                        if attribute in PROPERTY_ELEMENT_ATTRIBUTES:
+                            continue
+                        if frame.object is None:
+                            frame.object = BNode()
+                        predicate = absolutize(element_base, attribute)
+                        if not is_wanted(predicate):
+                            continue
+                        if attribute == RDF_TYPE:
+                            # Resolved as in node elements, which rdflib
+                            # does not do here
+                            yield frame.object, predicate, absolutize(element_base, value)
+                        else:
+                            yield frame.object, predicate, Literal(value, language)
+                stack.append(frame)
+        else:
+            frame = stack.pop()
+            if frame.kind == PROPERTY:
+                if frame.object is None:
+                    language = None if frame.datatype is not None else frame.language
+                    frame.object = Literal(element.text or "", language, frame.datatype)
+                if is_wanted(frame.predicate):
+                    yield frame.subject, frame.predicate, frame.object
+            elif frame.kind == NODE and frame.predicate is not None:
+                # ``rdf:parseType="Resource"`` property element
+                if is_wanted(frame.predicate):
+                    yield frame.subject, frame.predicate, frame.object
+
+            # Discard top-level elements once read
+            if stack and stack[-1].kind == DOCUMENT:
+                document_element.clear()
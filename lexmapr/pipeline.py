@@ -2,114 +2,141 @@
 
 """Point-of-entry script."""
 
-from collections import OrderedDict
 import csv
-from itertools import permutations
+from functools import partial
+from itertools import chain
+import multiprocessing
 import os
 import re
 import sys
-
-from nltk.tokenize import word_tokenize
+import time
 
 import lexmapr.pipeline_resources as pipeline_resources
 from lexmapr.pipeline_classification import classify_sample
 import lexmapr.pipeline_helpers as helpers
-
-
-def run(args):
+from lexmapr.pipeline_stats import MappingStats, write_slow_sample
+from lexmapr.tokenizer import TOKENIZERS, is_plain_token, word_tokenize
+
+# Number of input rows sent to a worker process at a time, when
+# mapping samples in parallel.
+PARALLEL_CHUNK_SIZE = 64
+
+# ``Mapper`` used by ``map_row`` in the current process. See
+# ``init_worker``.
+worker_mapper = None
+
+
+class Mapper(object):
+    """Maps samples to ontology terms.
+
+    The lookup tables needed to map samples are prepared once, when
+    the ``Mapper`` is created, and reused for every sample mapped
+    afterwards. Long-running processes should create a single
+    ``Mapper`` and call ``map_sample`` or ``map_samples`` for each
+    batch of samples.
+
+    :param str config: Path to JSON file containing the IRI of
+        ontologies to fetch terms from
+    :param str profile: Pre-defined set of resources to map samples
+        with. Ignored if ``config`` is specified.
+    :param bool bucket: Classify samples into pre-defined buckets
+    :param bool no_cache: Ignore or replace online cached resources,
+        if there are any
+    :param str storage: Storage backend to compile lookup tables
+        with. See ``lexmapr.table_storage``.
+    :param bool full: Classify samples into the buckets of every
+        parent hierarchy of their matched components, as needed by
+        full output format. Ignored if ``bucket`` is not specified.
+    :param lexmapr.pipeline_stats.MappingStats stats: Records the time
+        spent in, and work done by, each stage of mapping samples, if
+        specified
+    :param str tokenizer: Tokenizer to tokenize samples and labels
+        with. See ``lexmapr.tokenizer.TOKENIZERS``.
+    :raises ValueError: If ``tokenizer`` is not in
+        ``lexmapr.tokenizer.TOKENIZERS``
     """
-    Main text mining pipeline.
-    """
-    # If the user specified a profile, we must retrieve args specified
-    # by the profile, unless they were explicitly overridden.
-    if args.profile:
-        args = pipeline_resources.get_profile_args(args)
-
-    # To contain all resources, and their variations, that samples are
-    # matched to.  Start by adding pre-defined resources from
-    # lexmapr.predefined_resources.
-    # TODO: These pre-defined resources are the remnants of early
-    #  LexMapr development.  We should eventually move to only adding
-    #  terms from online ontologies to lookup tables.
-    lookup_table = pipeline_resources.get_predefined_resources()
-
-    # Scientific names dictionary fetched from lookup tables.
-    # Todo: Move to ontology_lookup_table later
-    scientific_names_dict = pipeline_resources.get_resource_dict(
-        "foodon_ncbi_synonyms.csv")
-
-    # To contain resources fetched from online ontologies, if any.
-    # Will eventually be added to ``lookup_table``.
-    ontology_lookup_table = None
-
-    if args.config:
-        # Fetch online ontology terms specified in config file.
-        ontology_lookup_table = pipeline_resources.get_config_resources(args.config, args.no_cache)
-    elif args.profile:
-        # Fetch online ontology terms specified in profile.
-        ontology_lookup_table = pipeline_resources.get_profile_resources(args.profile)
-
-    if ontology_lookup_table:
-        # Merge ``ontology_lookup_table`` into ``lookup_table``
-        lookup_table = helpers.merge_lookup_tables(lookup_table, ontology_lookup_table)
-
-    # To contain resources used in classification.
-    classification_lookup_table = None
-    if args.bucket:
-        classification_lookup_table = pipeline_resources.get_classification_resources()
-
-    # Output file Column Headings
-    output_fields = [
-        "Sample_Id",
-        "Sample_Desc",
-        "Processed_Sample",
-        "Processed_Sample (With Scientific Name)",
-        "Matched_Components"
-    ]
-
-    if args.full:
-        output_fields += [
-            "Match_Status(Macro Level)",
-            "Match_Status(Micro Level)",
-            "Sample_Transformations"
-        ]
-    else:
-        output_fields += [
-                "Match_Status(Macro Level)"
-        ]
-
-    if args.bucket:
-        if args.full:
-            output_fields += [
-                "LexMapr Classification (Full List)",
-                "LexMapr Bucket",
-                "Third Party Bucket",
-                "Third Party Classification"
-            ]
-        else:
-            output_fields += [
-                "Third Party Classification"
-            ]
-
-    fw = open(args.output, 'w') if args.output else sys.stdout     # Main output file
-    fw.write('\t'.join(output_fields))
 
-    # Input file
-    fr = open(args.input_file, "r")
-    _, ext = os.path.splitext(args.input_file)
-    if ext == ".csv":
-        fr_reader = csv.reader(fr, delimiter=",")
-    elif ext == ".tsv":
-        fr_reader = csv.reader(fr, delimiter="\t")
-    else:
-        raise ValueError("Should not reach here")
-    # Skip header
-    next(fr_reader)
+    def __init__(self, config=None, profile=None, bucket=False, no_cache=False,
+                 storage="compiled", full=True, stats=None, tokenizer="lexmapr"):
+        self.bucket = bucket
+        self.full = full
+        self.stats = stats
+        if tokenizer not in TOKENIZERS:
+            raise ValueError("Unknown tokenizer: %s" % tokenizer)
+        self.tokenizer = tokenizer
+
+        # To contain all resources, and their variations, that samples
+        # are matched to.  Start by adding pre-defined resources from
+        # lexmapr.predefined_resources.
+        # TODO: These pre-defined resources are the remnants of early
+        #  LexMapr development.  We should eventually move to only
+        #  adding terms from online ontologies to lookup tables.
+        self.lookup_table = pipeline_resources.get_predefined_resources(storage)
+
+        # Scientific names dictionary fetched from lookup tables.
+        # Todo: Move to ontology_lookup_table later
+        self.scientific_names_dict = pipeline_resources.get_resource_dict(
+            "foodon_ncbi_synonyms.csv")
+
+        # To contain resources fetched from online ontologies, if any.
+        # Will eventually be added to ``lookup_table``.
+        ontology_lookup_table = None
+
+        if config:
+            # Fetch online ontology terms specified in config file.
+            ontology_lookup_table = pipeline_resources.get_config_resources(config, no_cache,
+                                                                            storage)
+        elif profile:
+            # Fetch online ontology terms specified in profile.
+            ontology_lookup_table = pipeline_resources.get_profile_resources(profile, storage)
+
+        if ontology_lookup_table:
+            # Merge ``ontology_lookup_table`` into ``lookup_table``
+            self.lookup_table = helpers.merge_lookup_tables(self.lookup_table,
+                                                            ontology_lookup_table)
+
+        # Token counts of suffixes, that gram chunks are mapped with.
+        self.suffix_token_counts = helpers.get_suffix_token_counts(self.lookup_table["suffixes"])
+
+        # Multi-token phrases of lexicons, that cleaned samples are
+        # normalized with.
+        self.phrase_trie = helpers.get_phrase_trie(self.lookup_table)
+
+        # To contain resources used in classification.
+        self.classification_lookup_table = None
+        if bucket:
+            self.classification_lookup_table = pipeline_resources.get_classification_resources(
+                self.tokenizer)
+
+    def map_samples(self, samples):
+        """Map each sample in ``samples``.
+
+        :param samples: Sample descriptions to map
+        :type samples: collections.abc.Iterable[str]
+        :returns: Mapping of each sample, in the same order as
+            ``samples``. See ``map_sample``.
+        :rtype: collections.abc.Iterator[dict]
+        """
+        for sample in samples:
+            yield self.map_sample(sample)
+
+    def map_sample(self, original_sample):
+        """Map ``original_sample`` to resources in the lookup tables.
+
+        :param str original_sample: Sample description to map
+        :returns: Cleaned versions of ``original_sample``, the
+            resources it was matched to, the statuses of the matching
+            and, if ``bucket`` was specified, its classification
+        :rtype: dict
+        """
+        lookup_table = self.lookup_table
+        stats = self.stats
+        map_term = helpers.map_term
+        if stats:
+            stats.count("samples")
+            map_term = stats.counted(map_term, "map_term_probes")
+            start = time.perf_counter()
 
-    # Iterate over samples for matching to ontology terms
-    for row in fr_reader:
-        sample_id = row[0].strip()
-        original_sample = " ".join(row[1:]).strip()
         cleaned_sample = ""
         cleaned_sample_scientific_name = ""
         matched_components = []
@@ -126,12 +153,18 @@ def run(args):
         sample = original_sample.lower()
         sample = helpers.punctuation_treatment(sample)
 
-        sample_tokens = word_tokenize(sample)
+        sample_tokens = word_tokenize(sample, self.tokenizer)
+        if stats:
+            stats.count("tokens", len(sample_tokens))
+
+        # Length of ``micro_status`` once each token of
+        # ``cleaned_sample`` was added
+        status_positions = []
 
         # Get ``cleaned_sample``
         for token in sample_tokens:
             # Ignore dates
-            if helpers.is_date(token) or helpers.is_number(token):
+            if helpers.is_number(token) or helpers.is_date(token):
                 continue
             # Some preprocessing
             token = helpers.preprocess(token)
@@ -144,93 +177,101 @@ def run(args):
                 sample_conversion_status[token] = lemma
             cleaned_sample = helpers.get_cleaned_sample(cleaned_sample, lemma, lookup_table)
             cleaned_sample = re.sub(' +', ' ', cleaned_sample)
-            cleaned_sample = helpers.abbreviation_normalization_phrase(cleaned_sample,
-                                                                       lookup_table, micro_status)
-            cleaned_sample = helpers.non_English_normalization_phrase(cleaned_sample, lookup_table,
-                                                                      micro_status)
+            status_positions += [len(micro_status)] *\
+                (len(cleaned_sample.split()) - len(status_positions))
             cleaned_sample_scientific_name = helpers.get_annotated_sample(
-                cleaned_sample_scientific_name, lemma, scientific_names_dict)
+                cleaned_sample_scientific_name, lemma, self.scientific_names_dict)
             cleaned_sample_scientific_name = re.sub(' +', ' ', cleaned_sample_scientific_name)
 
-        cleaned_sample = helpers.remove_duplicate_tokens(cleaned_sample)
+        cleaned_sample = helpers.normalize_phrases(cleaned_sample, self.phrase_trie,
+                                                   micro_status, status_positions)
+        cleaned_sample = helpers.remove_duplicate_tokens(cleaned_sample, self.tokenizer)
         cleaned_sample_scientific_name = helpers.remove_duplicate_tokens(
-            cleaned_sample_scientific_name)
+            cleaned_sample_scientific_name, self.tokenizer)
+
+        if stats:
+            start = stats.add_time("cleaning", start)
 
         # Attempt full term match
-        full_term_match = helpers.map_term(sample, lookup_table)
+        full_term_match = map_term(sample, lookup_table)
 
         if not full_term_match:
             # Attempt full term match with cleaned sample
-            full_term_match = helpers.map_term(cleaned_sample, lookup_table)
+            full_term_match = map_term(cleaned_sample, lookup_table)
             if full_term_match:
                 micro_status.insert(0, "Used Cleaned Sample")
 
         if not full_term_match:
             # Attempt full term match using suffixes
-            full_term_match = helpers.map_term(sample, lookup_table, consider_suffixes=True)
+            full_term_match = map_term(sample, lookup_table, consider_suffixes=True)
 
         if not full_term_match:
             # Attempt full term match with cleaned sample using suffixes
             full_term_match =\
-                helpers.map_term(cleaned_sample, lookup_table, consider_suffixes=True)
+                map_term(cleaned_sample, lookup_table, consider_suffixes=True)
             if full_term_match:
                 micro_status.insert(0, "Used Cleaned Sample")
 
+        if stats:
+            start = stats.add_time("full_term_match", start)
+
         if full_term_match:
             matched_components.append(full_term_match["term"] + ":" + full_term_match["id"])
             macro_status = "Full Term Match"
             micro_status += full_term_match["status"]
-
-            if args.bucket:
-                classification_result = classify_sample(
-                    sample, matched_components, lookup_table, classification_lookup_table
-                )
-                lexmapr_classification = classification_result["lexmapr_hierarchy_buckets"]
-                lexmapr_bucket = classification_result["lexmapr_final_buckets"]
-                third_party_bucket = classification_result["ifsac_final_buckets"]
-                third_party_classification = classification_result["ifsac_final_labels"]
         else:
             # Attempt various component matches
             component_matches = []
             covered_tokens = set()
 
-            for i in range(5, 0, -1):
-                for gram_chunk in helpers.get_gram_chunks(cleaned_sample, i):
-                    concat_gram_chunk = " ".join(gram_chunk)
-                    gram_tokens = word_tokenize(concat_gram_chunk)
-                    gram_permutations =\
-                        list(OrderedDict.fromkeys(permutations(concat_gram_chunk.split())))
-
-                    # gram_tokens covered in prior component match
-                    if set(gram_tokens) <= covered_tokens:
-                        continue
-
-                    for gram_permutation in gram_permutations:
-                        gram_permutation_str = " ".join(gram_permutation)
-                        component_match = helpers.map_term(gram_permutation_str, lookup_table)
-
-                        if not component_match:
-                            # Try again with suffixes
-                            component_match = helpers.map_term(gram_permutation_str, lookup_table,
-                                                               consider_suffixes=True)
-
-                        if component_match:
-                            component_matches.append(component_match)
-                            covered_tokens.update(gram_tokens)
-                            break
+            # Gram chunks that cannot be mapped to any resource label or
+            # synonym are skipped.
+            gram_chunks = helpers.get_candidate_gram_chunks(cleaned_sample, lookup_table,
+                                                            self.suffix_token_counts,
+                                                            tokenizer=self.tokenizer)
+            if stats:
+                stats.count("gram_chunks", len(gram_chunks))
+                start = stats.add_time("gram_chunks", start)
+
+            # Gram chunks of only plain tokens are their own tokens, so
+            # only the others are tokenized again once joined.
+            plain_tokens = {token for token in chain.from_iterable(gram_chunks)
+                            if is_plain_token(token)}
+
+            for gram_chunk in gram_chunks:
+                concat_gram_chunk = " ".join(gram_chunk)
+                if plain_tokens.issuperset(gram_chunk):
+                    gram_tokens = gram_chunk
+                else:
+                    gram_tokens = word_tokenize(concat_gram_chunk, self.tokenizer)
+
+                # gram_tokens covered in prior component match
+                if set(gram_tokens) <= covered_tokens:
+                    if stats:
+                        stats.count("gram_chunks_skipped")
+                    continue
+
+                # ``map_term`` also matches permutations of
+                # ``concat_gram_chunk``.
+                component_match = map_term(concat_gram_chunk, lookup_table)
+
+                if not component_match:
+                    # Try again with suffixes
+                    component_match = map_term(concat_gram_chunk, lookup_table,
+                                                       consider_suffixes=True)
+
+                if component_match:
+                    component_matches.append(component_match)
+                    covered_tokens.update(gram_tokens)
+
+            if stats:
+                start = stats.add_time("component_match", start)
 
             # We need should not consider component matches that are
             # ancestral to other component matches.
             ancestors = set()
             for component_match in component_matches:
-                component_match_hierarchies =\
-                    helpers.get_term_parent_hierarchies(component_match["id"], lookup_table)
-
-                for component_match_hierarchy in component_match_hierarchies:
-                    # We do not need the first element
-                    component_match_hierarchy.pop(0)
-
-                    ancestors |= set(component_match_hierarchy)
+                ancestors.update(helpers.get_term_ancestors(component_match["id"], lookup_table))
 
             for component_match in component_matches:
                 if component_match["id"] not in ancestors:
@@ -258,40 +299,280 @@ def run(args):
             if matched_components:
                 macro_status = "Component Match"
 
-            if args.bucket:
-                classification_result = classify_sample(
-                    sample, matched_components, lookup_table, classification_lookup_table
-                )
-                lexmapr_classification = classification_result["lexmapr_hierarchy_buckets"]
-                lexmapr_bucket = classification_result["lexmapr_final_buckets"]
-                third_party_bucket = classification_result["ifsac_final_buckets"]
-                third_party_classification = classification_result["ifsac_final_labels"]
+            if stats:
+                start = stats.add_time("ancestors", start)
+
+        if self.bucket:
+            classification_result = classify_sample(
+                sample, matched_components, lookup_table, self.classification_lookup_table,
+                full=self.full, stats=stats, sample_tokens=sample_tokens
+            )
+            lexmapr_classification = classification_result["lexmapr_hierarchy_buckets"]
+            lexmapr_bucket = classification_result["lexmapr_final_buckets"]
+            third_party_bucket = classification_result["ifsac_final_buckets"]
+            third_party_classification = classification_result["ifsac_final_labels"]
+
+            if stats:
+                start = stats.add_time("classification", start)
 
-        # Write to row
         matched_components = helpers.get_matched_component_standardized(matched_components)
 
-        # Get post-processed cleaned sample with embedded scientific 
+        # Get post-processed cleaned sample with embedded scientific
         # name.
         cleaned_sample_scientific_name = helpers.refine_sample_sc_name(
             sample, cleaned_sample, cleaned_sample_scientific_name,
             third_party_classification)
 
-        fw.write("\n" + sample_id + "\t" + original_sample + "\t" + cleaned_sample + "\t"
-                 + cleaned_sample_scientific_name + "\t" + str(matched_components) + "\t" 
-                 + macro_status)
-
-        if args.full:
-            fw.write("\t" + str(micro_status)+"\t" + str(sample_conversion_status))
-
-        if args.bucket:
-            if args.full:
-                fw.write("\t" + str(lexmapr_classification) + "\t" + str(lexmapr_bucket)
-                         + "\t" + str(third_party_bucket))
-            fw.write("\t" + str(third_party_classification))
-
-    fw.write('\n')
-    # Output files closed
-    if fw is not sys.stdout:
-        fw.close()
-    # Input file closed
-    fr.close()
+        if stats:
+            stats.add_time("output", start)
+
+        return {
+            "sample_desc": original_sample,
+            "cleaned_sample": cleaned_sample,
+            "cleaned_sample_scientific_name": cleaned_sample_scientific_name,
+            "matched_components": matched_components,
+            "macro_status": macro_status,
+            "micro_status": micro_status,
+            "sample_conversion_status": sample_conversion_status,
+            "lexmapr_classification": lexmapr_classification,
+            "lexmapr_bucket": lexmapr_bucket,
+            "third_party_bucket": third_party_bucket,
+            "third_party_classification": third_party_classification
+        }
+
+
+def get_output_fields(full, bucket):
+    """Get the column headings of the output file.
+
+    :param bool full: Full output format
+    :param bool bucket: Samples are classified into buckets
+    :rtype: list[str]
+    """
+    output_fields = [
+        "Sample_Id",
+        "Sample_Desc",
+        "Processed_Sample",
+        "Processed_Sample (With Scientific Name)",
+        "Matched_Components"
+    ]
+
+    if full:
+        output_fields += [
+            "Match_Status(Macro Level)",
+            "Match_Status(Micro Level)",
+            "Sample_Transformations"
+        ]
+    else:
+        output_fields += [
+                "Match_Status(Macro Level)"
+        ]
+
+    if bucket:
+        if full:
+            output_fields += [
+                "LexMapr Classification (Full List)",
+                "LexMapr Bucket",
+                "Third Party Bucket",
+                "Third Party Classification"
+            ]
+        else:
+            output_fields += [
+                "Third Party Classification"
+            ]
+
+    return output_fields
+
+
+def get_output_row(sample_id, sample_mapping, full, bucket):
+    """Get the output file row of a mapped sample.
+
+    :param str sample_id: ID of the mapped sample
+    :param dict sample_mapping: See ``Mapper.map_sample``
+    :param bool full: Full output format
+    :param bool bucket: Samples are classified into buckets
+    :returns: Tab-separated values of the row, in the same order as
+        ``get_output_fields``
+    :rtype: str
+    """
+    row = (sample_id + "\t" + sample_mapping["sample_desc"] + "\t"
+           + sample_mapping["cleaned_sample"] + "\t"
+           + sample_mapping["cleaned_sample_scientific_name"] + "\t"
+           + str(sample_mapping["matched_components"]) + "\t" + sample_mapping["macro_status"])
+
+    if full:
+        row += ("\t" + str(sample_mapping["micro_status"]) + "\t"
+                + str(sample_mapping["sample_conversion_status"]))
+
+    if bucket:
+        if full:
+            row += ("\t" + str(sample_mapping["lexmapr_classification"]) + "\t"
+                    + str(sample_mapping["lexmapr_bucket"]) + "\t"
+                    + str(sample_mapping["third_party_bucket"]))
+        row += "\t" + str(sample_mapping["third_party_classification"])
+
+    return row
+
+
+def init_worker(mapper):
+    """Initialize a worker process that maps samples in parallel.
+
+    :param Mapper mapper: Used by the worker process to map samples
+    """
+    global worker_mapper
+    worker_mapper = mapper
+
+
+def map_row(row, full, bucket):
+    """Map the sample in an input file row with ``worker_mapper``.
+
+    :param list[str] row: Input file row
+    :param bool full: Full output format
+    :param bool bucket: Samples are classified into buckets
+    :returns: Output file row for the sample. See ``get_output_row``.
+    :rtype: str
+    """
+    sample_id = row[0].strip()
+    original_sample = " ".join(row[1:]).strip()
+    sample_mapping = worker_mapper.map_sample(original_sample)
+    return get_output_row(sample_id, sample_mapping, full, bucket)
+
+
+def map_row_with_stats(row, full, bucket):
+    """Map the sample in an input file row, and get the stats of it.
+
+    :param list[str] row: Input file row
+    :param bool full: Full output format
+    :param bool bucket: Samples are classified into buckets
+    :returns: Output file row for the sample, and the
+        ``lexmapr.pipeline_stats.MappingStats`` recorded mapping it,
+        as a dictionary with the sample and its id added under
+        ``sample`` and ``sample_id``
+    :rtype: tuple[str, dict]
+    """
+    output_row = map_row(row, full, bucket)
+    sample_stats = worker_mapper.stats.pop()
+    sample_stats["sample_id"] = row[0].strip()
+    sample_stats["sample"] = " ".join(row[1:]).strip()
+    return output_row, sample_stats
+
+
+def get_worker_pool(jobs, mapper):
+    """Get a pool of ``jobs`` processes that map samples with ``mapper``.
+
+    Worker processes are forked where possible, so ``mapper`` and its
+    lookup tables are inherited instead of being copied into each
+    worker, and output matches serial mapping byte for byte.
+
+    :param int jobs: Number of worker processes
+    :param Mapper mapper: Used by worker processes to map samples
+    :rtype: multiprocessing.pool.Pool
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    return context.Pool(jobs, initializer=init_worker, initargs=(mapper,))
+
+
+def run(args):
+    """
+    Main text mining pipeline.
+    """
+    # If the user specified a profile, we must retrieve args specified
+    # by the profile, unless they were explicitly overridden.
+    if args.profile:
+        args = pipeline_resources.get_profile_args(args)
+
+    # Number of processes to map samples with. Optional, so that
+    # callers constructing ``args`` themselves need not specify it.
+    jobs = getattr(args, "jobs", None) or 1
+    storage = getattr(args, "storage", None) or "compiled"
+    # Where to report mapping stats, if anywhere. See
+    # ``lexmapr.pipeline_stats.MappingStats.report``.
+    stats_path = getattr(args, "stats", None)
+    # Where to log samples slower to map than ``slow_threshold``
+    # seconds, if anywhere. See ``lexmapr.pipeline_stats.write_slow_sample``.
+    slow_log_path = getattr(args, "slow_log", None)
+    slow_threshold = getattr(args, "slow_threshold", None) or 1.0
+    tokenizer = getattr(args, "tokenizer", None) or "lexmapr"
+
+    stats = None
+    if stats_path:
+        stats = MappingStats()
+        start = time.perf_counter()
+
+    # Stats are recorded by the mapper for the whole run, unless they
+    # are needed for each sample, or are recorded in worker processes.
+    # In that case, they are sent with each output row.
+    mapper_stats = stats
+    if slow_log_path or (stats and jobs > 1):
+        mapper_stats = MappingStats()
+
+    mapper = Mapper(config=args.config, profile=args.profile, bucket=args.bucket,
+                    no_cache=args.no_cache, storage=storage, full=bool(args.full),
+                    stats=mapper_stats, tokenizer=tokenizer)
+
+    if stats:
+        stats.add_time("setup", start)
+
+    fw = open(args.output, 'w') if args.output else sys.stdout     # Main output file
+    fw.write('\t'.join(get_output_fields(args.full, args.bucket)))
+
+    # Input file
+    fr = open(args.input_file, "r")
+    _, ext = os.path.splitext(args.input_file)
+    if ext == ".csv":
+        fr_reader = csv.reader(fr, delimiter=",")
+    elif ext == ".tsv":
+        fr_reader = csv.reader(fr, delimiter="\t")
+    else:
+        raise ValueError("Should not reach here")
+    # Skip header
+    next(fr_reader)
+
+    map_input_row = partial(map_row, full=args.full, bucket=args.bucket)
+    if mapper_stats is not stats:
+        map_input_row = partial(map_row_with_stats, full=args.full, bucket=args.bucket)
+
+    slow_log = open(slow_log_path, "w") if slow_log_path else None
+    pool = None
+    try:
+        if jobs > 1:
+            # Output rows are returned in the same order as input rows
+            pool = get_worker_pool(jobs, mapper)
+            output_rows = pool.imap(map_input_row, fr_reader, chunksize=PARALLEL_CHUNK_SIZE)
+        else:
+            init_worker(mapper)
+            output_rows = map(map_input_row, fr_reader)
+
+        # Iterate over samples for matching to ontology terms
+        for output_row in output_rows:
+            if mapper_stats is not stats:
+                output_row, sample_stats = output_row
+                if stats:
+                    stats.update(sample_stats)
+                if slow_log:
+                    write_slow_sample(slow_log, sample_stats, slow_threshold)
+            fw.write("\n" + output_row)
+
+        if pool:
+            pool.close()
+            pool.join()
+
+        if stats:
+            stats.report(stats_path)
+
+        fw.write('\n')
+    finally:
+        # Worker processes are stopped, and files closed, even if
+        # mapping fails
+        if pool:
+            pool.terminate()
+            pool.join()
+        if slow_log:
+            slow_log.close()
+        # Output files closed
+        if fw is not sys.stdout:
+            fw.close()
+        # Input file closed
+        fr.close()
@@ -1,10 +1,11 @@
 """3rd-party classification functions using ontology-based buckets."""
 
 from inflection import singularize
-from nltk import word_tokenize
+from itertools import chain
 import re
 
 import lexmapr.pipeline_helpers as helpers
+from lexmapr.tokenizer import word_tokenize
 
 
 def customize_order_of_labels(ifsac_final_labels):
@@ -57,14 +58,133 @@ def decode_multi_class_labels(ifsac_final_labels):
     return revised_final_labels_list
 
 
-def refine_ifsac_final_labels(sample, ifsac_final_labels,
-                              label_refinements):
+# Different groups/ categories of classes
+SPECIFIC_MEAT_CATEGORIES = {"pork", "chicken", "beef", "fish", "game", "poultry", "turkey"}
+MOLLUSK_CATEGORIES = {"mollusks (non-bi-valve)", "mollusks (bi-valve)"}
+SHELLFISH_CATEGORIES = {"crustaceans", "mollusks"} | MOLLUSK_CATEGORIES
+AQUATIC_ANIMAL_CATEGORIES = {"fish", "other aquatic animals"} | SHELLFISH_CATEGORIES
+POULTRY_CATEGORIES = {"other poultry", "chicken", "turkey"}
+AVIAN_CATEGORIES = {"other poultry", "game", "poultry"} | POULTRY_CATEGORIES
+ANIMAL_CATEGORIES = {"human",  "companion animal", "aquatic animals", "wild animal",
+                     "beef", "pork", "other meat", "cow", "pig"}
+ANIMAL_CATEGORIES |= AVIAN_CATEGORIES | AQUATIC_ANIMAL_CATEGORIES | {"other animal"}
+VETERINARY_CATEGORIES = AVIAN_CATEGORIES | AQUATIC_ANIMAL_CATEGORIES | {"other animal"}
+VETERINARY_CATEGORIES |= {"animal", "avian", "companion animal", "aquatic animals",
+                          "wild animal", "beef", "pork", "other meat", "cow", "pig"}
+ENVIRONMENTAL_CATEGORIES = {"environmental-water", "environmental-farm",
+                            "environmental-restaurant", "environmental-retail",
+                            "environmental-abattoir", "environmental-warehouse",
+                            "environmental-researchfacility",
+                            "environmental-pasture", "environmental-animal housing",
+                            "environmental-factory/production facility",
+                            "environmental-vehicle", "environmental-construction"}
+ROOT_UNDERGROUND_CATEGORIES = {"root/underground (roots)", "root/underground (tubers)",
+                               "root/underground (bulbs)", "root/underground (other)"}
+SEEDED_VEGETABLE_CATEGORIES = {"seeded vegetables (vine-grown)",
+                               "seeded vegetables (solanaceous)",
+                               "seeded vegetables (legumes)",
+                               "seeded vegetables (other)"}
+VEGETABLE_CATEGORIES = {"fungi", "sprouts", "root/underground", "seeded vegetables", "herbs",
+                        "vegetable row crops (flower)", "vegetable row crops (stem)",
+                        "vegetable row crops (leafy)"}
+VEGETABLE_CATEGORIES |= ROOT_UNDERGROUND_CATEGORIES | SEEDED_VEGETABLE_CATEGORIES
+FRUIT_CATEGORIES = {"melon fruit", "pome fruit", "stone fruit", "sub-tropical fruit",
+                    "small fruit", "tropical fruit"}
+PLANT_CATEGORIES = {"oils", "vegetables", "fruits", "grains", "beans", "nuts",
+                    "seeds"}
+PLANT_CATEGORIES |= VEGETABLE_CATEGORIES | FRUIT_CATEGORIES
+OTHER_PLANT_FOOD_CATEGORY = {"other (food additive)", "dietary supplement",
+                             "other (sweetener)", "other (flavoring and seasoning",
+                             "other (confectionary)"}
+OTHER_ANIMAL_FOOD_CATEGORY = {"meat", "other meat", "beef", "pork"}
+PLANT_FOOD_CATEGORIES = PLANT_CATEGORIES | OTHER_PLANT_FOOD_CATEGORY
+FOOD_CATEGORIES = ANIMAL_CATEGORIES | PLANT_CATEGORIES | OTHER_ANIMAL_FOOD_CATEGORY \
+    | OTHER_PLANT_FOOD_CATEGORY | {"plant", "animal"}
+MULTI_INGREDIENT_EXCLUSIONS = {
+    'clinical/research', 'veterinary clinical/research', 'animal feed', 'human',
+    'environmental'
+}
+FOOD_ANATOMICAL_PARTS = {'heart', 'liver', 'lung', 'leg', 'shell-on', 'shell', 'soft shell',
+                         'tail', 'hlso', 'shellon', 'beef', 'pork', 'meat', 'porcine',
+                         'shell on'}
+BODY_PART_FOR_FOOD_ANIMAL_CATEGORIES = \
+    AQUATIC_ANIMAL_CATEGORIES | SHELLFISH_CATEGORIES | POULTRY_CATEGORIES | {"cow"}
+DISAMBIGUATION_WORDS = {'ground', 'scraps', 'cut', 'smoke', 'moon', 'plain'}
+
+
+def get_refinement_rules(label_refinements, tokenizer="lexmapr"):
+    """Compile the label refinement rules of IFSAC labels.
+
+    :param dict[str, str] label_refinements: Labels mapped to refined
+        IFSAC labels
+    :param str tokenizer: Tokenizer to tokenize labels with. See
+        ``lexmapr.tokenizer.TOKENIZERS``.
+    :returns: Token set, ``\\b``-delimited pattern and refined label of
+        each label in ``label_refinements``, in order, the positions
+        of the rules indexed by one of their tokens, and a single
+        pattern matching wherever any rule pattern matches. Positions
+        of rules without tokens are indexed under ``None``.
+    :rtype: tuple[list[tuple[frozenset[str], re.Pattern, str]],
+        dict[str, list[int]], re.Pattern]
+    """
+    refinement_rules = []
+    refinement_index = {}
+    for i, (label, refined_label) in enumerate(label_refinements.items()):
+        label_tokens = frozenset(word_tokenize(label, tokenizer))
+        refinement_rules.append((label_tokens, re.compile(r"\b"+label+r"\b"), refined_label))
+        refinement_index.setdefault(min(label_tokens, default=None), []).append(i)
+    refinement_pattern = re.compile("|".join(r"\b"+label+r"\b" for label in label_refinements))
+    return refinement_rules, refinement_index, refinement_pattern
+
+
+def get_refined_label(sample, sample_tokens_set, classification_lookup_table):
+    """Get the refined label of the first refinement rule ``sample``
+    satisfies.
+
+    A rule is satisfied if all its label tokens are in
+    ``sample_tokens_set``, or its label pattern is in ``sample``.
+
+    :param str sample: Sample with treated punctuation
+    :param set[str] sample_tokens_set: Tokens of ``sample``
+    :param dict classification_lookup_table: See
+        ``lexmapr.pipeline_resources.get_classification_resources``
+    :returns: Refined label of first satisfied rule, or ``None`` if no
+        rule is satisfied
+    :rtype: str or None
+    """
+    refinement_rules = classification_lookup_table["ifsac_refinement_rules"]
+    refinement_index = classification_lookup_table["ifsac_refinement_index"]
+    refinement_pattern = classification_lookup_table["ifsac_refinement_pattern"]
+
+    # Position of the first rule satisfied by tokens
+    first = len(refinement_rules)
+    for token in chain(sample_tokens_set, [None]):
+        for i in refinement_index.get(token, []):
+            if i < first and refinement_rules[i][0] <= sample_tokens_set:
+                first = i
+
+    # Earlier rules can only be satisfied by their patterns
+    if refinement_pattern.search(sample):
+        for i in range(first):
+            if refinement_rules[i][1].search(sample):
+                first = i
+                break
+
+    if first < len(refinement_rules):
+        return refinement_rules[first][2]
+    return None
+
+
+def refine_ifsac_final_labels(sample, ifsac_final_labels, classification_lookup_table,
+                              sample_tokens=None):
     """Gets refined final labels after application of customized rules.
 
     :param str sample: sample
     :param set ifsac_final_labels: the final labels set
-    :param dict label_refinements: the dictionary of label refinement 
-        resource
+    :param dict classification_lookup_table: See
+        ``lexmapr.pipeline_resources.get_classification_resources``
+    :param list[str] sample_tokens: Tokens of ``sample`` after
+        punctuation treatment, if already tokenized
     :return set of refined final labels
     :rtype: set
     """
@@ -73,54 +193,13 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
     # results.
     ret = set(ifsac_final_labels)
     sample = helpers.punctuation_treatment(sample)
-    sample_tokens = word_tokenize(sample)
+    if sample_tokens is None:
+        sample_tokens = word_tokenize(sample)
     sample_tokens_set = set(sample_tokens)
 
-    for label, refined_label in label_refinements.items():
-        label_tokens = word_tokenize(label)
-        if not (set(label_tokens) - set(sample_tokens)) or re.search(r"\b"+label+r"\b", sample):
-            ret.add(refined_label)
-            break
-
-    # Defines different groups/ categories of classes
-    specific_meat_categories = {"pork", "chicken", "beef", "fish", "game", "poultry", "turkey"}
-    mollusk_categories = {"mollusks (non-bi-valve)", "mollusks (bi-valve)"}
-    shellfish_categories = {"crustaceans", "mollusks"} | mollusk_categories
-    aquatic_animal_categories = {"fish", "other aquatic animals"} | shellfish_categories
-    poultry_categories = {"other poultry", "chicken", "turkey"}
-    avian_categories = {"other poultry", "game", "poultry"} | poultry_categories
-    animal_categories = {"human",  "companion animal", "aquatic animals", "wild animal",
-                         "beef", "pork", "other meat", "cow", "pig"}
-    animal_categories |= avian_categories | aquatic_animal_categories | {"other animal"}
-    veterinary_categories = avian_categories | aquatic_animal_categories | {"other animal"}
-    veterinary_categories |= {"animal", "avian", "companion animal", "aquatic animals", 
-                              "wild animal", "beef", "pork", "other meat", "cow", "pig"}
-    environmental_categories = {"environmental-water", "environmental-farm",
-                                "environmental-restaurant", "environmental-retail",
-                                "environmental-abattoir", "environmental-warehouse",
-                                "environmental-researchfacility",
-                                "environmental-pasture", "environmental-animal housing",
-                                "environmental-factory/production facility",
-                                "environmental-vehicle", "environmental-construction"}
-    root_underground_categories = {"root/underground (roots)", "root/underground (tubers)",
-                                   "root/underground (bulbs)", "root/underground (other)"}
-    seeded_vegetable_categories = {"seeded vegetables (vine-grown)",
-                                   "seeded vegetables (solanaceous)", 
-                                   "seeded vegetables (legumes)",
-                                   "seeded vegetables (other)"}
-    vegetable_categories = {"fungi", "sprouts", "root/underground", "seeded vegetables", "herbs",
-                            "vegetable row crops (flower)", "vegetable row crops (stem)",
-                            "vegetable row crops (leafy)"}
-    vegetable_categories |= root_underground_categories | seeded_vegetable_categories
-    fruit_categories = {"melon fruit", "pome fruit", "stone fruit", "sub-tropical fruit",
-                        "small fruit", "tropical fruit"}
-    plant_categories = {"oils", "vegetables", "fruits", "grains", "beans", "nuts",
-                        "seeds"}
-    plant_categories |= vegetable_categories | fruit_categories
-    other_plant_food_category = {"other (food additive)", "dietary supplement", 
-                                 "other (sweetener)", "other (flavoring and seasoning", 
-                                 "other (confectionary)"}
-    other_animal_food_category = {"meat", "other meat", "beef", "pork"}
+    refined_label = get_refined_label(sample, sample_tokens_set, classification_lookup_table)
+    if refined_label is not None:
+        ret.add(refined_label)
 
     # Customized rules for refinement of class labels
     # Deals with "animal feed" class
@@ -129,7 +208,7 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
 
     # Deals with "clinical/research" class
     if "clinical/research" in ret \
-            and ret.intersection(plant_categories | other_plant_food_category) \
+            and ret.intersection(PLANT_FOOD_CATEGORIES) \
             and not ("swab" in sample or "clinical" in sample):
         ret.remove("clinical/research")
     if "clinical/research" in ret and "swab sub" in sample:
@@ -141,13 +220,13 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
     if "clinical/research" in ret and "environmental" in ret \
             and not ("tissue" in sample or "biological" in sample):
         ret.remove("clinical/research")
-    if "clinical/research" in ret and ret.intersection(environmental_categories):
+    if "clinical/research" in ret and ret.intersection(ENVIRONMENTAL_CATEGORIES):
         ret.remove("clinical/research")
-    if "clinical/research" in ret and (ret.intersection(plant_categories)
-                                       or ret.intersection(animal_categories)):
+    if "clinical/research" in ret and (ret.intersection(PLANT_CATEGORIES)
+                                       or ret.intersection(ANIMAL_CATEGORIES)):
         if "shell" in sample or "shell on" in sample or "shellon" in sample:
             ret.remove("clinical/research")
-    if "clinical/research" in ret and ret.intersection(veterinary_categories):
+    if "clinical/research" in ret and ret.intersection(VETERINARY_CATEGORIES):
         ret.remove("clinical/research")
         ret.add("veterinary clinical/research")
     if "veterinary clinical/research" in ret and "animal" in ret:
@@ -213,53 +292,53 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
         ret.add("pig")
     if "meat" in ret and ("veterinary clinical/research" in ret or "engineering  seafood" in ret):
         ret.remove("meat")
-    if ret.intersection(specific_meat_categories) and "meat" in ret:
+    if ret.intersection(SPECIFIC_MEAT_CATEGORIES) and "meat" in ret:
         ret.remove("meat")
 
     # Deals with cases when clinical/research is there and meats are 
     # there.
-    if not ret.intersection(animal_categories) and "other meat" in ret \
+    if not ret.intersection(ANIMAL_CATEGORIES) and "other meat" in ret \
             and ("veterinary clinical/research" in ret or "clinical/research" in ret):
         ret.remove("other meat")
         ret.add("other animal")
-    if not ret.intersection(animal_categories) and "meat" in ret \
+    if not ret.intersection(ANIMAL_CATEGORIES) and "meat" in ret \
             and ("veterinary clinical/research" in ret or "clinical/research" in ret):
         ret.remove("meat")
         if "liver" not in sample:
             ret.add("other animal")
-    if not ret.intersection(animal_categories) and ("veterinary clinical/research" in ret):
+    if not ret.intersection(ANIMAL_CATEGORIES) and ("veterinary clinical/research" in ret):
         ret.add("other animal")
 
     # Retains the specific (more granular) animal classes
-    if "mollusks" in ret and ret.intersection(mollusk_categories):
+    if "mollusks" in ret and ret.intersection(MOLLUSK_CATEGORIES):
         ret.remove("mollusks")
-    if "shellfish" in ret and ret.intersection(shellfish_categories):
+    if "shellfish" in ret and ret.intersection(SHELLFISH_CATEGORIES):
         ret.remove("shellfish")
-    if "aquatic animals" in ret and ret.intersection(aquatic_animal_categories):
+    if "aquatic animals" in ret and ret.intersection(AQUATIC_ANIMAL_CATEGORIES):
         ret.remove("aquatic animals")
-    if "poultry" in ret and ret.intersection(poultry_categories):
+    if "poultry" in ret and ret.intersection(POULTRY_CATEGORIES):
         ret.remove("poultry")
-    if "other animal" in ret and ret.intersection(avian_categories):
+    if "other animal" in ret and ret.intersection(AVIAN_CATEGORIES):
         ret.remove("other animal")
-    if "animal" in ret and ret.intersection(animal_categories):
+    if "animal" in ret and ret.intersection(ANIMAL_CATEGORIES):
         ret.remove("animal")
-    if "engineered seafood" in ret and ret.intersection(aquatic_animal_categories):
-        ret = ret - ret.intersection(aquatic_animal_categories)
+    if "engineered seafood" in ret and ret.intersection(AQUATIC_ANIMAL_CATEGORIES):
+        ret = ret - ret.intersection(AQUATIC_ANIMAL_CATEGORIES)
     if "engineered seafood" in ret and "aquatic animals" in ret:
         ret.remove("aquatic animals")
     if ("engineered seafood" in ret or "companion animal" in ret) and "other animal" in ret:
         ret.remove("other animal")
 
     # Retains the specific (more granular) plant classes
-    if "root/underground" in ret and ret.intersection(root_underground_categories):
+    if "root/underground" in ret and ret.intersection(ROOT_UNDERGROUND_CATEGORIES):
         ret.remove("root/underground")
-    if "seeded vegetables" in ret and ret.intersection(seeded_vegetable_categories):
+    if "seeded vegetables" in ret and ret.intersection(SEEDED_VEGETABLE_CATEGORIES):
         ret.remove("seeded vegetables")
-    if "vegetables" in ret and ret.intersection(vegetable_categories):
+    if "vegetables" in ret and ret.intersection(VEGETABLE_CATEGORIES):
         ret.remove("vegetables")
-    if "fruits" in ret and ret.intersection(fruit_categories):
+    if "fruits" in ret and ret.intersection(FRUIT_CATEGORIES):
         ret.remove("fruits")
-    if "plant" in ret and ret.intersection(plant_categories):
+    if "plant" in ret and ret.intersection(PLANT_CATEGORIES):
         ret.remove("plant")
 
     # Deals with "nut", and "seeds", and "environment-water" and "fish" 
@@ -270,7 +349,7 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
         ret.remove("environment-water")
 
     # Retains the specific (more granular) environmental classes
-    if "environmental" in ret and ret.intersection(environmental_categories):
+    if "environmental" in ret and ret.intersection(ENVIRONMENTAL_CATEGORIES):
         ret.remove("environmental")
     if ("environmental-animal housing" in ret or "environmental-abattoir" in ret
             or "environmental-farm" in ret) \
@@ -278,21 +357,17 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
         ret.remove("environmental-factory/production facility")
     if "environmental-abattoir" in ret and "environmental-factory/production facility" in ret:
         ret.remove("environmental-factory/production facility")
-    exclusions = {
-        'clinical/research', 'veterinary clinical/research', 'animal feed', 'human',
-        'environmental'
-    }
 
     # Assigns multi-ingredient to the cases where multiple food 
     # ingredients have been tagged.
-    if not (ret.intersection(exclusions) or ret.intersection(environmental_categories)) \
+    if not (ret.intersection(MULTI_INGREDIENT_EXCLUSIONS) or ret.intersection(ENVIRONMENTAL_CATEGORIES)) \
             and len(ret) >= 3:
         ret.add("multi-ingredient")   # To be revisted and revised as per evaluation
 
     # Deals with some specific cases
     if "other meat" in ret and "other animal" in ret:
         ret.remove("other animal")
-    if "meat" in ret and ret.intersection(animal_categories):
+    if "meat" in ret and ret.intersection(ANIMAL_CATEGORIES):
         if len(ret) == 3 and "multi-ingredient" in ret:
             ret.remove("multi-ingredient")
             ret.remove("meat")
@@ -301,9 +376,7 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
 
     # Retains the specific (more granular) classes and removing the 
     # general "food" class.
-    if "food" in ret and ret.intersection(animal_categories | plant_categories 
-                                          | other_animal_food_category | other_plant_food_category 
-                                          | {"plant", "animal"}):
+    if "food" in ret and ret.intersection(FOOD_CATEGORIES):
         ret.remove("food")
     if "food" in ret and ("dairy" in ret or "environmental" in ret or "clinical/research" in ret 
                           or "veterinary clinical/research" in ret):
@@ -321,28 +394,22 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
     if "eggs" in ret and "veterinary clinical/research" in ret:
         ret.remove("veterinary clinical/research")
     if "environmental" in ret \
-            and ("multi-ingredient" in ret or ret.intersection(plant_categories)) \
+            and ("multi-ingredient" in ret or ret.intersection(PLANT_CATEGORIES)) \
             and not ("swab" in sample or "environmental" in sample):
         ret.remove("environmental")
 
     # Deals with body parts that are food for specific animal 
     # categories and not clinical/research.
-    food_anatomical_parts = {'heart', 'liver', 'lung', 'leg', 'shell-on', 'shell', 'soft shell',
-                             'tail', 'hlso', 'shellon', 'beef', 'pork', 'meat', 'porcine',
-                             'shell on'}
-    body_part_for_food_animal_categories = \
-        aquatic_animal_categories | shellfish_categories | poultry_categories | {"cow"}
     if "veterinary clinical/research" in ret \
-            and ret.intersection(body_part_for_food_animal_categories) \
-            and sample_tokens_set.intersection(food_anatomical_parts) and "swab" not in sample:
+            and ret.intersection(BODY_PART_FOR_FOOD_ANIMAL_CATEGORIES) \
+            and sample_tokens_set.intersection(FOOD_ANATOMICAL_PARTS) and "swab" not in sample:
         ret.remove("veterinary clinical/research")
 
     # Deals with very specific disambiguation tokens
-    disambiguation_words = {'ground', 'scraps', 'cut', 'smoke', 'moon', 'plain'}
     if "environmental" in ret \
-            and (ret.intersection(animal_categories) or ret.intersection(plant_categories) 
+            and (ret.intersection(ANIMAL_CATEGORIES) or ret.intersection(PLANT_CATEGORIES) 
                  or "dairy" in ret) \
-            and sample_tokens_set.intersection(disambiguation_words):
+            and sample_tokens_set.intersection(DISAMBIGUATION_WORDS):
         ret.remove("environmental")
 
     # Retains the general class (only animal feed)
@@ -360,8 +427,17 @@ def refine_ifsac_final_labels(sample, ifsac_final_labels,
     return list(ret)
 
 
-def classify_sample_helper(sample_hierarchy, buckets):
-    """TODO..."""
+def classify_sample_helper(sample_hierarchy, bucket_labels):
+    """Get the buckets in a parent hierarchy.
+
+    :param list[str] sample_hierarchy: See
+        ``lexmapr.pipeline_helpers.get_term_parent_hierarchies``
+    :param dict[str, str] bucket_labels: Bucket ids mapped to bucket
+        labels
+    :returns: 1-based levels in ``sample_hierarchy`` mapped to the
+        ``{bucket_id: bucket_label}`` bucket at that level
+    :rtype: dict[int, dict[str, str]]
+    """
     sample_hierarchy_classification = {}
 
     for i in range(len(sample_hierarchy)):
@@ -369,20 +445,128 @@ def classify_sample_helper(sample_hierarchy, buckets):
         # 1-based indexing of parent hierarchy
         parent_level = i+1
 
-        for bucket_label, bucket_id in buckets.items():
-            if bucket_id == parent_id:
-                sample_hierarchy_classification[parent_level] = {bucket_id: bucket_label}
+        if parent_id in bucket_labels:
+            sample_hierarchy_classification[parent_level] = {parent_id: bucket_labels[parent_id]}
 
     return sample_hierarchy_classification
 
 
-def classify_sample(sample, matched_terms_with_ids, lookup_table, classification_lookup_table):
-    """TODO..."""
+def get_nearest_buckets(hierarchies, bucket_labels):
+    """Get the nearest bucket in each parent hierarchy of a resource.
+
+    :param list[list[str]] hierarchies: See
+        ``lexmapr.pipeline_helpers.get_term_parent_hierarchies``
+    :param dict[str, str] bucket_labels: Bucket ids mapped to bucket
+        labels
+    :returns: Id, label and 1-based level of the lowest-level bucket
+        in each of ``hierarchies``, without repeated buckets
+    :rtype: list[list]
+    """
+    nearest_buckets = []
+    for hierarchy in hierarchies:
+        hierarchy_buckets = classify_sample_helper(hierarchy, bucket_labels)
+        if hierarchy_buckets:
+            nearest_bucket_level = min(hierarchy_buckets.keys())
+            [(bucket_id, bucket_label)] = hierarchy_buckets[nearest_bucket_level].items()
+            if not any(b[:2] == [bucket_id, bucket_label] for b in nearest_buckets):
+                nearest_buckets.append([bucket_id, bucket_label, nearest_bucket_level])
+    return nearest_buckets
+
+
+def get_term_nearest_buckets(term_id, lookup_table, bucket_labels, nearest_buckets_key):
+    """Get the nearest bucket in each parent hierarchy of a resource.
+
+    Precomputed in ``lookup_table`` for resources with parents.
+
+    :param str term_id: ID of some resource cached in ``lookup_table``
+    :param dict[str, dict] lookup_table: See
+        ``lexmapr.pipeline_resources.create_lookup_table_skeleton``
+    :param dict[str, str] bucket_labels: Bucket ids mapped to bucket
+        labels
+    :param str nearest_buckets_key: Key of the ``lookup_table``
+        section with the nearest buckets in ``bucket_labels``
+    :returns: See ``get_nearest_buckets``
+    :rtype: list[list]
+    """
+    if term_id in lookup_table[nearest_buckets_key]:
+        return lookup_table[nearest_buckets_key][term_id]
+    return get_nearest_buckets(helpers.get_term_parent_hierarchies(term_id, lookup_table),
+                               bucket_labels)
+
+
+def get_default_bucket_tokens(default_buckets, tokenizer="lexmapr"):
+    """Get the singularized tokens of default IFSAC buckets.
+
+    :param dict[str, str] default_buckets: Default buckets mapped to
+        IFSAC labels
+    :param str tokenizer: Tokenizer to tokenize buckets with. See
+        ``lexmapr.tokenizer.TOKENIZERS``.
+    :returns: Singularized token set and IFSAC label of each bucket in
+        ``default_buckets``, in order, and the positions of the buckets
+        containing each token. Positions of buckets without tokens are
+        indexed under ``None``.
+    :rtype: tuple[list[tuple[frozenset[str], str]], dict[str, list[int]]]
+    """
+    default_bucket_tokens = []
+    default_bucket_index = {}
+    for i, (bucket, label) in enumerate(default_buckets.items()):
+        bucket_tokens = frozenset(singularize(token) for token in word_tokenize(bucket, tokenizer))
+        default_bucket_tokens.append((bucket_tokens, label))
+        for token in bucket_tokens or [None]:
+            default_bucket_index.setdefault(token, []).append(i)
+    return default_bucket_tokens, default_bucket_index
+
+
+def get_default_classification(sample, classification_lookup_table, sample_tokens=None):
+    """Classify sample into a default IFSAC label.
+
+    Uses the last default bucket whose singularized tokens are all in
+    ``sample``. Only buckets sharing a token with ``sample``, or
+    without tokens, are considered.
+
+    :param str sample: Sample to classify
+    :param dict classification_lookup_table: See
+        ``lexmapr.pipeline_resources.get_classification_resources``
+    :param list[str] sample_tokens: Tokens of ``sample``, if already
+        tokenized
+    :returns: IFSAC label of default bucket, or empty string if
+        ``sample`` is in no default bucket
+    :rtype: str
+    """
+    default_bucket_tokens = classification_lookup_table["ifsac_default_tokens"]
+    default_bucket_index = classification_lookup_table["ifsac_default_index"]
+
+    if sample_tokens is None:
+        sample_tokens = word_tokenize(sample)
+    sample_tokens = {singularize(token) for token in sample_tokens}
+
+    candidates = set(default_bucket_index.get(None, []))
+    for token in sample_tokens:
+        candidates.update(default_bucket_index.get(token, []))
+
+    for i in sorted(candidates, reverse=True):
+        bucket_tokens, label = default_bucket_tokens[i]
+        if bucket_tokens <= sample_tokens:
+            return label
+    return ""
+
+
+def classify_sample(sample, matched_terms_with_ids, lookup_table, classification_lookup_table,
+                    full=True, stats=None, sample_tokens=None):
+    """TODO...
+
+    Unless ``full`` is specified, the parent hierarchies of matched
+    terms are not enumerated, and ``lexmapr_hierarchy_buckets`` is
+    empty. The number of hierarchies enumerated is counted in
+    ``stats``, a ``lexmapr.pipeline_stats.MappingStats``, if specified.
 
-    # LexMapr and IFSAC buckets mapped to the parental hierarchies of
-    # each element in ``matched_term_with_ids``.
+    ``sample_tokens`` are the tokens of ``sample`` after punctuation
+    treatment. ``sample`` is tokenized if they are not specified.
+    """
+
+    # LexMapr buckets mapped to the parental hierarchies of each
+    # element in ``matched_term_with_ids``.
     lexmapr_hierarchy_buckets = []
-    ifsac_hierarchy_buckets = []
     # Lowest-level mapping for each element in ``matched_terms_with_ids``.
     lexmapr_final_buckets = []
     ifsac_final_buckets = []
@@ -393,62 +577,50 @@ def classify_sample(sample, matched_terms_with_ids, lookup_table, classification
     if matched_terms_with_ids:
         for matched_term_with_id in matched_terms_with_ids:
             [_, term_id] = matched_term_with_id.split(":", 1)
-            matched_term_hierarchies = helpers.get_term_parent_hierarchies(term_id, lookup_table)
-
-            for matched_term_hierarchy in matched_term_hierarchies:
-                lexmapr_hierarchy_bucket = \
-                    classify_sample_helper(matched_term_hierarchy,
-                                           classification_lookup_table["buckets_lexmapr"])
 
-                if lexmapr_hierarchy_bucket:
-                    lexmapr_hierarchy_buckets.append(lexmapr_hierarchy_bucket)
-
-                    lexmapr_final_bucket_level = min(lexmapr_hierarchy_bucket.keys())
-                    lexmapr_final_bucket = lexmapr_hierarchy_bucket[lexmapr_final_bucket_level]
-                    if lexmapr_final_bucket not in lexmapr_final_buckets:
-                        lexmapr_final_buckets.append(lexmapr_final_bucket)
-
-                ifsac_hierarchy_bucket = \
-                    classify_sample_helper(matched_term_hierarchy,
-                                           classification_lookup_table["buckets_ifsactop"])
-
-                if ifsac_hierarchy_bucket:
-                    ifsac_hierarchy_buckets.append(ifsac_hierarchy_bucket)
-
-                    ifsac_final_bucket_level = min(ifsac_hierarchy_bucket.keys())
-                    ifsac_final_bucket = \
-                        ifsac_hierarchy_bucket[ifsac_final_bucket_level]
-                    if ifsac_final_bucket not in ifsac_final_buckets:
-                        ifsac_final_buckets.append(ifsac_final_bucket)
-
-                        # ``ifsac_final_bucket`` has is a one-item
-                        # dictionary of the following format:
-                        # ``{bucket_id:bucket_label}``.
-                        ifsac_final_bucket_id = list(ifsac_final_bucket.keys())[0]
-
-                        ifsac_final_label = \
-                            classification_lookup_table["ifsac_labels"][ifsac_final_bucket_id]
-                        ifsac_final_labels.append(ifsac_final_label)
+            if full:
+                matched_term_hierarchies =\
+                    helpers.get_term_parent_hierarchies(term_id, lookup_table)
+                if stats:
+                    stats.count("hierarchy_paths", len(matched_term_hierarchies))
+                bucket_labels = classification_lookup_table["bucket_labels_lexmapr"]
+                for matched_term_hierarchy in matched_term_hierarchies:
+                    lexmapr_hierarchy_bucket = \
+                        classify_sample_helper(matched_term_hierarchy, bucket_labels)
+                    if lexmapr_hierarchy_bucket:
+                        lexmapr_hierarchy_buckets.append(lexmapr_hierarchy_bucket)
+
+            lexmapr_nearest_buckets = get_term_nearest_buckets(
+                term_id, lookup_table, classification_lookup_table["bucket_labels_lexmapr"],
+                "nearest_buckets_lexmapr")
+            for bucket_id, bucket_label, _ in lexmapr_nearest_buckets:
+                lexmapr_final_bucket = {bucket_id: bucket_label}
+                if lexmapr_final_bucket not in lexmapr_final_buckets:
+                    lexmapr_final_buckets.append(lexmapr_final_bucket)
+
+            ifsac_nearest_buckets = get_term_nearest_buckets(
+                term_id, lookup_table, classification_lookup_table["bucket_labels_ifsactop"],
+                "nearest_buckets_ifsactop")
+            for bucket_id, bucket_label, _ in ifsac_nearest_buckets:
+                ifsac_final_bucket = {bucket_id: bucket_label}
+                if ifsac_final_bucket not in ifsac_final_buckets:
+                    ifsac_final_buckets.append(ifsac_final_bucket)
+
+                    ifsac_final_label = classification_lookup_table["ifsac_labels"][bucket_id]
+                    ifsac_final_labels.append(ifsac_final_label)
 
     if ifsac_final_labels:
         ifsac_final_labels = sorted(decode_multi_class_labels(ifsac_final_labels))
 
     if not ifsac_final_labels or set(ifsac_final_labels) == {"food"}:
         # Attempt to find a classification using ifsac_default
-        default_classification = ""
-        sample_tokens = word_tokenize(sample)
-        sample_tokens = list(map(lambda token: singularize(token), sample_tokens))
-        for bucket, label in classification_lookup_table["ifsac_default"].items():
-            bucket_tokens = word_tokenize(bucket)
-            bucket_tokens = list(map(lambda token: singularize(token), bucket_tokens))
-            if not (set(bucket_tokens) - set(sample_tokens)):
-                default_classification = label
+        default_classification = get_default_classification(sample, classification_lookup_table,
+                                                            sample_tokens)
         if default_classification:
             ifsac_final_buckets.append("Default classification")
             ifsac_final_labels.append(default_classification)
-    ifsac_final_labels = \
-        refine_ifsac_final_labels(sample, ifsac_final_labels,
-                                  classification_lookup_table["ifsac_refinement"])
+    ifsac_final_labels = refine_ifsac_final_labels(sample, ifsac_final_labels,
+                                                   classification_lookup_table, sample_tokens)
     ifsac_final_labels = customize_order_of_labels(ifsac_final_labels)
 
     return {
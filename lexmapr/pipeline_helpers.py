@@ -1,14 +1,50 @@
 """Helper functions for lexmapr.pipeline.run."""
 
-from collections import OrderedDict
-from itertools import combinations
+from collections import ChainMap, Counter, OrderedDict
+from collections.abc import Mapping
+from itertools import chain, combinations, product
 import re
+import unicodedata
 
-from dateutil.parser import parse
+from dateutil.parser import parse, parserinfo
 import inflection
-from nltk.tokenize import word_tokenize
-from nltk.tokenize.treebank import TreebankWordDetokenizer
-from nltk import pos_tag
+
+from lexmapr.tokenizer import detokenize, word_tokenize
+
+# Tokens made of only ASCII letters, possibly ending in periods like
+# words at the end of sentences, or of only digits, which can be
+# classified as dates or numbers without ``dateutil`` or exceptions
+LETTERS_REGEX = re.compile(r"([a-zA-Z]+)\.*")
+DIGITS_REGEX = re.compile("[0-9]+")
+
+# Words ``dateutil.parser.parse`` knows. Any other word of only letters
+# is not a date.
+DATE_WORDS = {
+    word.lower()
+    for words in (parserinfo.JUMP, parserinfo.PERTAIN, parserinfo.UTCZONE)
+    for word in words
+} | {
+    word.lower()
+    for words in (parserinfo.WEEKDAYS, parserinfo.MONTHS, parserinfo.HMS, parserinfo.AMPM)
+    for synonyms in words
+    for word in synonyms
+}
+
+# Words of only letters ``float`` accepts
+NUMBER_WORDS = {"nan", "inf", "infinity"}
+
+# Lookup table sections indexing resource label and synonym token bags
+# by token, and whether the bags they index are resource labels. See
+# ``get_token_index``.
+TOKEN_INDEX_KEYS = [("label_bag_index", True), ("synonym_bag_index", False)]
+
+# Lookup table lexicons multi-token phrases are normalized with, in the
+# order they are applied, and the micro status prefix of each
+PHRASE_LEXICONS = [
+    ("spelling_mistakes", "Spelling Correction Treatment: "),
+    ("abbreviations", "Abbreviation-Acronym Treatment: "),
+    ("non_english_words", "Non English Language Words Treatment: "),
+]
 
 
 def singularize_token(token, lookup_table, micro_status):
@@ -72,23 +108,6 @@ def abbreviation_normalization_token(
     return token
 
 
-def abbreviation_normalization_phrase(
-        phrase, lookup_table, micro_status):
-    """Normalizes phrase (multi-token) for abbreviation, if in resource.
-
-    :param str phrase: input phrase to be normalized
-    :param dict lookup_table: lookup table of resources
-    :param str micro_status: micro level status of rule/treatment
-    :return: normalized phrase for abbreviation (if applicable)
-    :rtype: str
-    """
-
-    if phrase in lookup_table["abbreviations"]:
-        phrase = lookup_table["abbreviations"][phrase]
-        micro_status.append("Abbreviation-Acronym Treatment: " + phrase)
-    return phrase
-
-
 def non_English_normalization_token(
         token, lookup_table, micro_status):
     """Normalizes token for non-English usage, if in resource.
@@ -107,22 +126,93 @@ def non_English_normalization_token(
     return token
 
 
-def non_English_normalization_phrase(
-        phrase, lookup_table, micro_status):
-    """Normalizes phrase (multi-token) for non-English usage.
+def get_phrase_trie(lookup_table):
+    """Get a token trie of the multi-token phrases of lexicons.
 
-    :param str phrase: input phrase to be normalized
-    :param dict lookup_table: lookup table of resources
-    :param str micro_status: micro level status of rule/treatment
-    :return: normalized phrase for abbreviation (if applicable)
+    Every multi-token phrase of the ``PHRASE_LEXICONS`` of
+    ``lookup_table`` is added to the trie, with the phrase it is
+    normalized to by each lexicon in turn, like single tokens are
+    normalized by ``spelling_correction``,
+    ``abbreviation_normalization_token`` and
+    ``non_English_normalization_token``.
+
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :returns: Nested dictionaries of phrase tokens. The dictionary of
+        the last token of a phrase maps ``None`` to the normalized
+        phrase, and the micro statuses of normalizing it.
+    :rtype: dict
+    """
+    phrase_trie = {}
+    for lexicon, _ in PHRASE_LEXICONS:
+        for phrase in lookup_table[lexicon]:
+            phrase_tokens = phrase.split(" ")
+            if len(phrase_tokens) < 2:
+                continue
+            node = phrase_trie
+            for token in phrase_tokens:
+                node = node.setdefault(token, {})
+            if None in node:
+                continue
+
+            normalized_phrase = phrase
+            statuses = []
+            for normalizing_lexicon, status in PHRASE_LEXICONS:
+                if normalized_phrase in lookup_table[normalizing_lexicon]:
+                    normalized_phrase = lookup_table[normalizing_lexicon][normalized_phrase]
+                    statuses.append(status + normalized_phrase)
+            node[None] = (normalized_phrase, statuses)
+    return phrase_trie
+
+
+def normalize_phrases(sample, phrase_trie, micro_status, status_positions=None):
+    """Normalize the multi-token phrases of ``sample``.
+
+    ``sample`` is scanned once, from left to right. At each token, the
+    longest phrase of ``phrase_trie`` starting there is replaced by its
+    normalized phrase, and scanning continues after it.
+
+    :param str sample: Cleaned sample, with tokens separated by single
+        spaces
+    :param dict phrase_trie: See ``get_phrase_trie``
+    :param list[str] micro_status: Micro statuses of ``sample``, which
+        the statuses of normalized phrases are added to
+    :param list[int] status_positions: Length of ``micro_status`` once
+        each token of ``sample`` was cleaned. If specified, the
+        statuses of a normalized phrase are inserted after those of
+        its last token, instead of after all statuses.
+    :returns: ``sample``, with its phrases normalized
     :rtype: str
     """
-
-    if phrase in lookup_table["non_english_words"]:
-        phrase = lookup_table["non_english_words"][phrase]
-        micro_status.append("Non English Language Words Treatment: "
-                            + phrase)
-    return phrase
+    tokens = sample.split(" ")
+    ret = []
+    # Number of statuses inserted into ``micro_status`` so far
+    inserted_status_count = 0
+    i = 0
+    while i < len(tokens):
+        match = None
+        node = phrase_trie
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                break
+            if None in node:
+                match = (j + 1, node[None])
+
+        if match:
+            i, (normalized_phrase, statuses) = match
+            if normalized_phrase:
+                ret.append(normalized_phrase)
+            if status_positions is None:
+                micro_status.extend(statuses)
+            else:
+                position = status_positions[i - 1] + inserted_status_count
+                micro_status[position:position] = statuses
+                inserted_status_count += len(statuses)
+        else:
+            ret.append(tokens[i])
+            i += 1
+    return " ".join(ret)
 
 
 def get_cleaned_sample(input_sample, token, lookup_table):
@@ -147,10 +237,12 @@ def get_cleaned_sample(input_sample, token, lookup_table):
     return cleaned_sample
 
 
-def remove_duplicate_tokens(input_string):
+def remove_duplicate_tokens(input_string, tokenizer="lexmapr"):
     """Removes duplicate tokens from input string, unless permitted
 
     :param input_string:
+    :param str tokenizer: Tokenizer to join tokens with. See
+        ``lexmapr.tokenizer.TOKENIZERS``.
     :return: output string without duplicate tokens unless allowed
     :rtype: str
     """
@@ -160,7 +252,7 @@ def remove_duplicate_tokens(input_string):
     for token in new_phrase_list:
         if token not in refined_phrase_list:
             refined_phrase_list.append(token)
-    refined_string = TreebankWordDetokenizer().detokenize(refined_phrase_list)
+    refined_string = detokenize(refined_phrase_list, tokenizer)
     refined_string = refined_string.strip()
 
     # Permitted duplicate tokens restored (for more such tokens, in
@@ -202,6 +294,10 @@ def is_number(inputstring):
     :return:
     :rtype: bool
     """
+    if DIGITS_REGEX.fullmatch(inputstring):
+        return True
+    if LETTERS_REGEX.fullmatch(inputstring):
+        return inputstring.lower() in NUMBER_WORDS
 
     try:
         float(inputstring)
@@ -209,7 +305,6 @@ def is_number(inputstring):
     except ValueError:
         pass
     try:
-        import unicodedata
         unicodedata.numeric(inputstring)
         return True
     except (TypeError, ValueError):
@@ -224,6 +319,11 @@ def is_date(inputstring):
     :return:
     :rtype: bool
     """
+    # Words unknown to ``dateutil`` are most tokens, and cannot be dates
+    letters_match = LETTERS_REGEX.fullmatch(inputstring)
+    if letters_match and letters_match.group(1).lower() not in DATE_WORDS:
+        return False
+
     try:
         parse(inputstring)
         return True
@@ -249,7 +349,7 @@ def ngrams(input, gram_value):
     return output
 
 
-def get_gram_chunks(input, num):
+def get_gram_chunks(input, num, tokenizer="lexmapr"):
     """Make ``num``-gram chunks from ``input``.
 
     If ``input`` contains less than 15 tokens, returns all
@@ -258,11 +358,13 @@ def get_gram_chunks(input, num):
 
     :param str input: Value to get ``num``-gram chunks of
     :param int num: Size of gram chunks to return
+    :param str tokenizer: Tokenizer to tokenize ``input`` with. See
+        ``lexmapr.tokenizer.TOKENIZERS``.
     :return: ``num``-gram chunks of ``input``
     :rtype: list[tuple[str]]
     """
     # List of tokens from input
-    input_tokens = word_tokenize(input)
+    input_tokens = word_tokenize(input, tokenizer)
     # input_tokens has less than 15 tokens
     if len(input_tokens) < 15:
         # Return all num-token combinations of input_tokens
@@ -273,6 +375,154 @@ def get_gram_chunks(input, num):
         return ngrams(input, num)
 
 
+def get_token_index(lookup_table, suffixes):
+    """Get indexes of resource label token bags and synonyms by token.
+
+    Each standardized resource label and synonym token bag in
+    ``lookup_table`` is indexed under a single one of its tokens: the
+    token shared by the fewest other bags and synonyms. A sample must
+    contain that token for the bag or synonym to be mapped in it.
+
+    Suffixes are added to gram chunks before mapping them, so token
+    bags are indexed under a token that is not part of any suffix, if
+    possible. Otherwise, they are indexed under all their tokens.
+
+    The indexes are stored in lookup tables, under the keys of
+    ``TOKEN_INDEX_KEYS``.
+
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :param collections.abc.Iterable[str] suffixes: Suffixes gram chunks
+        are mapped with
+    :returns: Tokens, mapped to the resource label token bags indexed
+        under them, and tokens, mapped to the synonym token bags
+        indexed under them
+    :rtype: tuple[dict[str, list[str]], dict[str, list[str]]]
+    """
+    label_bags = list(lookup_table["standard_resource_label_bags"])
+    synonym_bags = list(lookup_table["synonym_bags"])
+
+    token_frequencies = Counter()
+    for bag in chain(label_bags, synonym_bags):
+        token_frequencies.update(set(bag.split(" ")))
+
+    suffix_tokens = set()
+    for suffix in suffixes:
+        suffix_tokens.update(suffix.split(" "))
+
+    token_indexes = []
+    for bags, is_label_bag in [(label_bags, True), (synonym_bags, False)]:
+        token_index = {}
+        for bag in bags:
+            bag_tokens = bag.split(" ")
+            if is_label_bag:
+                index_tokens = [t for t in bag_tokens if t not in suffix_tokens]
+            else:
+                index_tokens = bag_tokens
+            if index_tokens:
+                index_tokens = [min(index_tokens, key=lambda t: token_frequencies[t])]
+            else:
+                # Every token may be part of a suffix
+                index_tokens = bag_tokens
+            for token in set(index_tokens):
+                token_index.setdefault(token, []).append(bag)
+        token_indexes.append(token_index)
+    return tuple(token_indexes)
+
+
+def get_suffix_token_counts(suffixes):
+    """Get the token counts of suffixes.
+
+    :param collections.abc.Iterable[str] suffixes: See
+        ``create_lookup_table_skeleton``
+    :rtype: list[collections.Counter]
+    """
+    return [Counter(suffix.split(" ")) for suffix in suffixes]
+
+
+def get_candidate_gram_chunks(input, lookup_table, suffix_token_counts=None, max_num=5,
+                              tokenizer="lexmapr"):
+    """Make gram chunks from ``input`` that may map to some resource.
+
+    Returns the same gram chunks as ``get_gram_chunks`` would for
+    ``num`` values from ``max_num`` down to 1, and in the same order,
+    but without the chunks that no resource label or synonym in
+    ``lookup_table`` could be mapped to.
+
+    If ``input`` contains less than 15 tokens, the resource label
+    token bags and synonyms sharing tokens with ``input`` are looked
+    up in the token indexes of ``lookup_table``, and only token
+    combinations matching those bags--with or without a suffix--and
+    synonyms are returned. See ``get_token_index``.
+
+    :param str input: Value to get gram chunks of
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :param list[collections.Counter] suffix_token_counts: Token counts
+        of the suffixes of ``lookup_table``, if already computed. See
+        ``get_suffix_token_counts``.
+    :param int max_num: Size of largest gram chunks to return
+    :param str tokenizer: Tokenizer to tokenize ``input`` with. See
+        ``lexmapr.tokenizer.TOKENIZERS``.
+    :return: Gram chunks of ``input``, largest first
+    :rtype: list[tuple[str]]
+    """
+    input_tokens = word_tokenize(input, tokenizer)
+    if len(input_tokens) >= 15:
+        return [tuple(gram_chunk) for num in range(max_num, 0, -1)
+                for gram_chunk in ngrams(input, num)]
+
+    input_token_counts = Counter(input_tokens)
+    if suffix_token_counts is None:
+        suffix_token_counts = get_suffix_token_counts(lookup_table["suffixes"])
+
+    # Token counts of gram chunks that may map to some resource
+    candidates = []
+    visited_bags = set()
+    for token in input_token_counts:
+        for key, is_label_bag in TOKEN_INDEX_KEYS:
+            for bag in lookup_table[key].get(token, []):
+                if (bag, is_label_bag) in visited_bags:
+                    continue
+                visited_bags.add((bag, is_label_bag))
+
+                bag_token_counts = Counter(bag.split(" "))
+                # Tokens in bag, but not in ``input``
+                missing_token_counts = bag_token_counts - input_token_counts
+                if not missing_token_counts:
+                    candidates.append(bag_token_counts)
+                if not is_label_bag:
+                    continue
+                # Gram chunks from ``input`` may be missing a suffix
+                for suffix_counts in suffix_token_counts:
+                    if suffix_counts - bag_token_counts:
+                        continue
+                    if missing_token_counts - suffix_counts:
+                        continue
+                    candidate = bag_token_counts - suffix_counts
+                    if candidate:
+                        candidates.append(candidate)
+
+    # Positions in ``input_tokens`` of each token
+    token_positions = {}
+    for i, token in enumerate(input_tokens):
+        token_positions.setdefault(token, []).append(i)
+
+    # Positions of all gram chunks with the token counts of candidates
+    gram_chunk_positions = set()
+    for candidate in candidates:
+        if sum(candidate.values()) > max_num:
+            continue
+        position_combinations = [combinations(token_positions[token], count)
+                                 for token, count in candidate.items()]
+        for positions in product(*position_combinations):
+            gram_chunk_positions.add(tuple(sorted(chain.from_iterable(positions))))
+
+    # Order of ``get_gram_chunks`` output
+    gram_chunk_positions = sorted(gram_chunk_positions, key=lambda p: (-len(p), p))
+    return [tuple(input_tokens[i] for i in positions) for positions in gram_chunk_positions]
+
+
 def preprocess(token):
     """Removes characters in token that are irrelevant to run.
 
@@ -372,16 +622,39 @@ def retain_phrase(term_list):
     return returned_set_final
 
 
+class TokenIndexChainMap(ChainMap):
+    """Chained token indexes of lookup tables.
+
+    Unlike ``ChainMap``, the bags indexed under a token in each
+    mapping are concatenated, instead of only returning those of the
+    first mapping containing the token. See ``get_token_index``.
+    """
+
+    def __getitem__(self, key):
+        bag_lists = [mapping[key] for mapping in self.maps if key in mapping]
+        if not bag_lists:
+            raise KeyError(key)
+        return list(chain.from_iterable(bag_lists))
+
+
 def merge_lookup_tables(lookup_table_one, lookup_table_two):
     """Merges lookup tables.
 
     Lookup tables, in the context of this pipeline, are dictionaries.
     They have the same keys, but can have different values. The values
-    are also dictionaries.
+    are also dictionaries, or read-only mappings if the lookup table
+    was compiled. See ``lexmapr.table_storage``.
 
     If their is a conflict between identical keys during merging,
     priority is given to lookup_table_two.
 
+    Values from lookup_table_one that are not dictionaries cannot be
+    modified, and are instead chained with the values from
+    lookup_table_two.
+
+    The bags indexed under a token in the token indexes of both lookup
+    tables are concatenated instead. See ``get_token_index``.
+
     :param dict lookup_table_one: lookup table
     :param dict lookup_table_two: lookup table
     :return: lookup table with the combined values for each key from
@@ -399,15 +672,27 @@ def merge_lookup_tables(lookup_table_one, lookup_table_two):
     lookup_table_keys = lookup_table_one.keys()
 
     for key in lookup_table_keys:
-        if type(lookup_table_one[key]) is not dict:
+        if not isinstance(lookup_table_one[key], Mapping):
             raise ValueError("lookup_table_one values are not all dictionaries")
-        if type(lookup_table_two[key]) is not dict:
+        if not isinstance(lookup_table_two[key], Mapping):
             raise ValueError("lookup_table_two values are not all dictionaries")
 
+    # Token indexes list the bags of both lookup tables
+    token_index_keys = {key for key, _ in TOKEN_INDEX_KEYS}
+
     # Merge values from lookup_table_two into lookup_table_one
     for key in lookup_table_keys:
+        if type(lookup_table_one[key]) is not dict:
+            # Iterates in the same order as a merged dictionary
+            chain_map_class = TokenIndexChainMap if key in token_index_keys else ChainMap
+            lookup_table_one[key] = chain_map_class(lookup_table_two[key], lookup_table_one[key])
+            continue
         for nested_key in lookup_table_two[key]:
-            lookup_table_one[key][nested_key] = lookup_table_two[key][nested_key]
+            if key in token_index_keys:
+                lookup_table_one[key][nested_key] =\
+                    lookup_table_two[key][nested_key] + lookup_table_one[key].get(nested_key, [])
+            else:
+                lookup_table_one[key][nested_key] = lookup_table_two[key][nested_key]
 
     return lookup_table_one
 
@@ -448,11 +733,46 @@ def get_term_parent_hierarchies(term_id, lookup_table):
     return hierarchies
 
 
+def get_term_ancestors(term_id, lookup_table):
+    """Get the ancestors of a resource.
+
+    Precomputed in ``lookup_table`` for resources with parents.
+
+    :param str term_id: ID of some resource cached in ``lookup_table``
+    :param dict[str, dict] lookup_table: See
+        ``lexmapr.pipeline_resources.create_lookup_table_skeleton``
+    :returns: IDs in the parent hierarchies of resource with id value
+        of ``term_id``, excluding ``term_id`` itself
+    :rtype: list[str]
+    """
+    if term_id in lookup_table["ancestors"]:
+        return lookup_table["ancestors"][term_id]
+
+    hierarchies = get_term_parent_hierarchies(term_id, lookup_table)
+    return [ancestor for hierarchy in hierarchies for ancestor in hierarchy[1:]]
+
+
+def get_token_bag(term):
+    """Get a key shared by all permutations of the tokens in ``term``.
+
+    Tokens are separated by single spaces, like in standardized
+    resource labels. Other whitespace is kept, so that terms with
+    leading, trailing or repeated spaces do not match any label.
+
+    :param str term: Standardized resource label, or some term to
+        match to one
+    :returns: Tokens of ``term`` in sorted order, separated by spaces
+    :rtype: str
+    """
+    return " ".join(sorted(term.split(" ")))
+
+
 def map_term(term, lookup_table, consider_suffixes=False):
     """Map ``term`` to some resource in ``lookup_table``.
 
-    Attempts to map to any resource term, or permutation a resource
-    term. Will attempt to map synonyms in case of failure.
+    Attempts to map to any resource term, or permutation of a resource
+    term's tokens. Will attempt to map synonyms, or permutations of
+    their tokens, in case of failure.
 
     If a mapping is found, returns a dictionary detailing the mapped
     resource label, mapped resource ontology ID and a status detailing
@@ -480,9 +800,15 @@ def map_term(term, lookup_table, consider_suffixes=False):
             return mapping
 
     # No mapping yet
+    synonym = None
     if term in lookup_table["synonyms"]:
         synonym = lookup_table["synonyms"][term]
+    else:
+        term_bag = get_token_bag(term)
+        if term_bag in lookup_table["synonym_bags"]:
+            synonym = lookup_table["synonym_bags"][term_bag]
 
+    if synonym is not None:
         if consider_suffixes:
             # Try mapping synonym with suffixes
             for suffix in lookup_table["suffixes"]:
@@ -510,6 +836,7 @@ def _map_term_helper(term, lookup_table):
     :return:
     """
     # Map ``term`` to ``lookup_table`` resource or resource permutation
+    term_bag = get_token_bag(term)
     if term in lookup_table["standard_resource_labels"]:
         term_id = lookup_table["standard_resource_labels"][term]
         return {
@@ -517,8 +844,8 @@ def _map_term_helper(term, lookup_table):
             "id": term_id,
             "status": ["A Direct Match"]
         }
-    elif term in lookup_table["standard_resource_label_permutations"]:
-        term_id = lookup_table["standard_resource_label_permutations"][term]
+    elif term_bag in lookup_table["standard_resource_label_bags"]:
+        term_id = lookup_table["standard_resource_label_bags"][term_bag]
         return {
             "term": lookup_table["non_standard_resource_ids"][term_id],
             "id": term_id,
@@ -585,6 +912,8 @@ def get_head_noun(text_segment):
     :return: The nouns in the text segment
     :rtype: list
     """
+    from nltk import pos_tag
+
     # Check if noun (=NN)
     def is_noun(pos): return pos[:2] == 'NN'
     # Tokenise text and keep only nouns
@@ -1,17 +1,35 @@
 """Cache and load binary resources."""
 
-from collections import OrderedDict
 import csv
-from itertools import permutations
+from functools import lru_cache, partial
+import hashlib
 import json
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
 
-from nltk import word_tokenize
-
+from lexmapr import __version__
 from lexmapr.definitions import ROOT
-from lexmapr.ontofetch import Ontology
-from lexmapr.pipeline_helpers import punctuation_treatment
+from lexmapr.pipeline_classification import (get_default_bucket_tokens, get_nearest_buckets,
+                                              get_refinement_rules)
+from lexmapr.pipeline_helpers import (get_term_parent_hierarchies, get_token_bag,
+                                      get_token_index, punctuation_treatment)
+import lexmapr.table_storage as table_storage
+
+# Version of fetched ontologies cache entries. Changing it invalidates
+# all entries.
+FETCH_CACHE_VERSION = 2
+
+# Number of resources per chunk of ``add_ancestors_to_lookup_table``
+# work done in a separate process
+ANCESTORS_CHUNK_SIZE = 5000
+
+# Lookup table keys added to by ``add_fetched_ontology_to_lookup_table``
+LOOKUP_TABLE_FRAGMENT_KEYS = ["non_standard_resource_ids", "standard_resource_labels",
+                              "standard_resource_label_bags", "synonyms", "synonym_bags",
+                              "parents"]
 
 
 def get_profile_args(args):
@@ -35,54 +53,60 @@ def get_profile_args(args):
     return args
 
 
-def get_profile_resources(profile):
+def get_profile_resources(profile, storage="compiled"):
     """Get lookup table of resources specified by ``profile``.
 
-    :rtype:  dict[str, dict]
+    :param str profile: Profile name
+    :param str storage: Storage backend to compile the lookup table
+        with. See ``lexmapr.table_storage``.
+    :rtype:  dict[str, collections.abc.Mapping]
     """
     ontology_lookup_table_path =\
         os.path.join(ROOT, "resources", "profiles", profile, profile + "_table.json")
 
-    with open(ontology_lookup_table_path) as fp:
-        ontology_lookup_table = json.load(fp)
-
-    return ontology_lookup_table
+    return load_lookup_table(ontology_lookup_table_path, storage)
 
 
-def get_predefined_resources():
+def get_predefined_resources(storage="compiled"):
     """Get lookup table of ``lexmapr.predefined_resources``.
 
     Retrieves from disk if possible. Otherwise, creates from scratch
     and adds to disk.
 
-    :rtype: dict[str, dict]
+    :param str storage: Storage backend to compile the lookup table
+        with. See ``lexmapr.table_storage``.
+    :rtype: dict[str, collections.abc.Mapping]
     """
     lookup_table_path = os.path.join(ROOT, "resources", "lookup_table.json")
 
     if os.path.exists(lookup_table_path):
-        with open(lookup_table_path) as fp:
-            lookup_table = json.load(fp)
+        lookup_table = load_lookup_table(lookup_table_path, storage)
     else:
         lookup_table = create_lookup_table_skeleton()
         lookup_table = add_predefined_resources_to_lookup_table(lookup_table)
-        with open(lookup_table_path, "w") as fp:
-            json.dump(lookup_table, fp)
+        lookup_table = dump_lookup_table(lookup_table, lookup_table_path, storage)
 
     return lookup_table
 
 
-def get_config_resources(path, no_cache):
+def get_config_resources(path, no_cache, storage="compiled"):
     """Get lookup table with resources specified by config file.
 
     These are resources fetched from online ontologies.
 
     Retrieves from cache if possible. Otherwise, creates from scratch
-    and adds to cache.
+    and adds to cache. Ontologies are only parsed again if they changed
+    since they were last fetched, and their terms are only added to a
+    lookup table fragment again if they or LexMapr changed, even if
+    ``no_cache`` is specified. See ``fetch_ontology`` and
+    ``get_lookup_table_fragment``.
 
     :param str path: Config file path
     :param bool no_cache: If ``True``, does not attempt to retrieve
         from cache
-    :rtype: dict[str, dict]
+    :param str storage: Storage backend to compile the lookup table
+        with. See ``lexmapr.table_storage``.
+    :rtype: dict[str, collections.abc.Mapping]
     """
     # Make fetched_ontologies folder if it does not already exist
     fetched_ontologies_dir_path = os.path.join(ROOT, "resources", "fetched_ontologies")
@@ -94,14 +118,25 @@ def get_config_resources(path, no_cache):
     if not os.path.isdir(ontology_lookup_tables_dir_path):
         os.makedirs(ontology_lookup_tables_dir_path)
 
+    # Make fetched_ontologies_cache folder if it does not already exist
+    fetched_ontologies_cache_dir_path =\
+        os.path.join(ROOT, "resources", "fetched_ontologies_cache")
+    if not os.path.isdir(fetched_ontologies_cache_dir_path):
+        os.makedirs(fetched_ontologies_cache_dir_path)
+
+    # Make ontology_lookup_fragments folder if it does not already exist
+    ontology_lookup_fragments_dir_path =\
+        os.path.join(ROOT, "resources", "ontology_lookup_fragments")
+    if not os.path.isdir(ontology_lookup_fragments_dir_path):
+        os.makedirs(ontology_lookup_fragments_dir_path)
+
     config_file_name = os.path.splitext(os.path.basename(path))[0]
     ontology_lookup_table_path = os.path.join(ontology_lookup_tables_dir_path,
                                               "lookup_%s.json" % config_file_name)
 
     if os.path.exists(ontology_lookup_table_path) and not no_cache:
         # Retrieve lookup table for fetched ontology from cache
-        with open(ontology_lookup_table_path) as file:
-            ontology_lookup_table = json.load(file)
+        ontology_lookup_table = load_lookup_table(ontology_lookup_table_path, storage)
     else:
         # Generate new ontology lookup table
         with open(path) as file:
@@ -109,44 +144,333 @@ def get_config_resources(path, no_cache):
 
         ontology_lookup_table = create_lookup_table_skeleton()
 
-        # Iterate over config_json backwards
-        for json_object in reversed(config_json):
-            (ontology_iri, root_entity_iri), = json_object.items()
-
-            # Arguments for ontofetch.py
-            if root_entity_iri == "":
-                sys.argv = ["", ontology_iri, "-o", fetched_ontologies_dir_path + "/"]
-            else:
-                sys.argv = ["", ontology_iri, "-o", fetched_ontologies_dir_path + "/", "-r",
-                            root_entity_iri]
-
-            # Call ontofetch.py
-            ontofetch = Ontology()
-            ontofetch.__main__()
-
-            # Load fetched_ontology from JSON, and add the appropriate
-            # terms to ``ontology_lookup_table.``
-            ontology_file_name = os.path.basename(ontology_iri).rsplit('.', 1)[0]
-            fetched_ontology_path = os.path.join(fetched_ontologies_dir_path,
-                                                 "%s.json" % ontology_file_name)
-            with open(fetched_ontology_path) as file:
-                fetched_ontology = json.load(file)
-            ontology_lookup_table =\
-                add_fetched_ontology_to_lookup_table(ontology_lookup_table, fetched_ontology)
+        # Config entries are fetched concurrently, each into its own
+        # folder, so ontologies listed more than once do not clash.
+        fetch_dir_path = tempfile.mkdtemp(dir=fetched_ontologies_dir_path)
+        try:
+            with get_process_executor(len(config_json)) as executor:
+                futures = []
+                for i, json_object in enumerate(config_json):
+                    ontology_iri, root_entity_iri, engine = get_config_entry(json_object)
+                    entry_dir_path = os.path.join(fetch_dir_path, str(i))
+                    os.mkdir(entry_dir_path)
+                    futures.append(executor.submit(get_lookup_table_fragment, ontology_iri,
+                                                   root_entity_iri, entry_dir_path,
+                                                   fetched_ontologies_cache_dir_path,
+                                                   ontology_lookup_fragments_dir_path, engine))
+
+            # Iterate over fetched ontologies backwards
+            for future in reversed(futures):
+                fetched_ontology_path, fragment_path = future.result()
+
+                # Add the terms of fetched_ontology to
+                # ``ontology_lookup_table.``
+                with open(fragment_path) as file:
+                    fragment = json.load(file)
+                ontology_lookup_table =\
+                    add_fragment_to_lookup_table(ontology_lookup_table, fragment)
+
+                # Move fetched ontology files to fetched_ontologies
+                # folder, in the same order they were fetched in
+                # before.
+                fetched_ontology_basename = os.path.splitext(fetched_ontology_path)[0]
+                for extension in [".json", ".tsv"]:
+                    os.replace(fetched_ontology_basename + extension, os.path.join(
+                        fetched_ontologies_dir_path,
+                        os.path.basename(fetched_ontology_basename) + extension))
+        finally:
+            shutil.rmtree(fetch_dir_path, ignore_errors=True)
+
+        ontology_lookup_table = add_ancestors_to_lookup_table(ontology_lookup_table)
+        ontology_lookup_table = add_token_index_to_lookup_table(ontology_lookup_table)
 
         # Add ontology_lookup_table to cache
-        with open(ontology_lookup_table_path, "w") as file:
-            json.dump(ontology_lookup_table, file)
+        ontology_lookup_table = dump_lookup_table(ontology_lookup_table,
+                                                  ontology_lookup_table_path, storage)
 
     return ontology_lookup_table
 
 
-def get_classification_resources():
+def get_config_entry(json_object):
+    """Get ontology, root entity and fetch engine of config file entry.
+
+    Entries map an ontology path or URL to either the IRI of the root
+    entity to fetch terms under, or to an object with ``root`` and
+    ``engine`` keys. ``engine`` defaults to ``"graph"``. See
+    ``fetch_ontology``.
+
+    :param dict json_object: Config file entry
+    :returns: Ontology path or URL, root entity IRI and engine
+    :rtype: tuple[str, str, str]
+    """
+    (ontology_iri, root_entity_iri), = json_object.items()
+    engine = "graph"
+    if isinstance(root_entity_iri, dict):
+        engine = root_entity_iri.get("engine", engine)
+        root_entity_iri = root_entity_iri.get("root", "")
+    return ontology_iri, root_entity_iri, engine
+
+
+def get_ontology_hash(ontology_path, root_entity_iri, engine="graph"):
+    """Get hash of an ontology file, and how its terms are fetched.
+
+    Ontologies imported by the ontology file are not hashed, so
+    ``fetch_ontology`` does not cache the terms of ontologies with
+    imports.
+
+    :param str ontology_path: Path of ontology. Online ontologies are
+        downloaded first, so the hashed file is the one parsed. See
+        ``download_ontology``.
+    :param str root_entity_iri: IRI of entity whose subclasses are
+        fetched, or empty string to fetch all terms
+    :param str engine: ``lexmapr.ontofetch`` engine terms are fetched
+        with
+    :returns: Hex digest, or ``None`` if the ontology file cannot be
+        read
+    :rtype: str or None
+    """
+    ontology_hash = hashlib.sha256()
+    ontology_hash.update(
+        ("%s\n%s\n%s\n" % (FETCH_CACHE_VERSION, root_entity_iri, engine)).encode("utf-8"))
+    try:
+        with open(ontology_path, "rb") as fp:
+            for chunk in iter(partial(fp.read, 1 << 20), b""):
+                ontology_hash.update(chunk)
+    except (OSError, ValueError):
+        return None
+    return ontology_hash.hexdigest()
+
+
+def download_ontology(ontology_iri, output_dir_path):
+    """Download an online ontology file.
+
+    :param str ontology_iri: URL of ontology
+    :param str output_dir_path: Folder to download ontology to
+    :returns: Path of downloaded ontology, and the URL its relative
+        IRIs resolve against, which differs from ``ontology_iri`` if it
+        was redirected
+    :rtype: tuple[str, str]
+    """
+    # Slow to import, and only needed for online ontologies
+    import urllib.request
+
+    fd, ontology_path = tempfile.mkstemp(suffix=".owl", dir=output_dir_path)
+    try:
+        with os.fdopen(fd, "wb") as fp, urllib.request.urlopen(ontology_iri) as response:
+            shutil.copyfileobj(response, fp)
+            base_iri = response.geturl()
+    except BaseException:
+        os.remove(ontology_path)
+        raise
+    return ontology_path, base_iri
+
+
+def fetch_ontology(ontology_iri, root_entity_iri, output_dir_path, cache_dir_path=None,
+                   engine="graph"):
+    """Fetch ontology terms with ``lexmapr.ontofetch``.
+
+    If ``cache_dir_path`` is specified, fetched terms are cached there
+    by ``get_ontology_hash``, and later fetches of the same ontology
+    file and root are copied from the cache instead of parsing the
+    ontology again. Terms of ontologies with ``owl:imports`` are not
+    cached, as the imported ontologies may change without the ontology
+    file changing.
+
+    Online ontologies are downloaded once, and the downloaded file is
+    both hashed and parsed.
+
+    :param str ontology_iri: Path or URL of ontology
+    :param str root_entity_iri: IRI of entity whose subclasses are
+        fetched, or empty string to fetch all terms
+    :param str output_dir_path: Folder to write fetched ontology to, as
+        JSON and TSV
+    :param str cache_dir_path: Folder to cache fetched ontologies in
+    :param str engine: ``"graph"`` to parse the whole ontology into
+        memory, or ``"stream"`` to stream-parse it for only the fetched
+        terms
+    :returns: Path of fetched ontology JSON, and the
+        ``get_ontology_hash`` it is cached by, or ``None`` if it is not
+        cached
+    :rtype: tuple[str, str or None]
+    """
+    ontology_file_name = os.path.basename(ontology_iri).rsplit('.', 1)[0]
+    fetched_ontology_basename = os.path.join(output_dir_path, ontology_file_name)
+
+    ontology_path, base_iri = ontology_iri, None
+    if ontology_iri[0:4].lower() == "http":
+        try:
+            ontology_path, base_iri = download_ontology(ontology_iri, output_dir_path)
+        except (OSError, ValueError):
+            # Reported by ``lexmapr.ontofetch`` below
+            pass
+
+    try:
+        ontology_hash = None
+        if cache_dir_path and ontology_path[0:4].lower() != "http":
+            ontology_hash = get_ontology_hash(ontology_path, root_entity_iri, engine)
+        cache_basename = os.path.join(cache_dir_path, ontology_hash) if ontology_hash else None
+
+        # The JSON is cached last, so its presence marks a complete entry
+        if cache_basename and os.path.exists(cache_basename + ".json"):
+            print("Using cached terms of " + ontology_iri + " ...")
+            for extension in [".tsv", ".json"]:
+                shutil.copyfile(cache_basename + extension,
+                                fetched_ontology_basename + extension)
+            return fetched_ontology_basename + ".json", ontology_hash
+
+        # Arguments for ontofetch.py
+        sys.argv = ["", ontology_iri, "-o", output_dir_path + "/", "-e", engine]
+        if root_entity_iri != "":
+            sys.argv += ["-r", root_entity_iri]
+        if base_iri:
+            sys.argv += ["-s", ontology_path, "-b", base_iri]
+
+        # Call ontofetch.py. Imported here, as it imports rdflib, which is
+        # slow to import and only needed when ontologies are fetched.
+        from lexmapr.ontofetch import Ontology
+        ontofetch = Ontology()
+        ontofetch.__main__()
+    finally:
+        if base_iri:
+            os.remove(ontology_path)
+
+    if ontofetch.imports:
+        # Imported ontologies are not hashed
+        return fetched_ontology_basename + ".json", None
+
+    if cache_basename:
+        for extension in [".tsv", ".json"]:
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir_path)
+            os.close(fd)
+            shutil.copyfile(fetched_ontology_basename + extension, tmp_path)
+            os.replace(tmp_path, cache_basename + extension)
+
+    return fetched_ontology_basename + ".json", ontology_hash
+
+
+def get_lookup_table_fragment(ontology_iri, root_entity_iri, output_dir_path, cache_dir_path,
+                              fragments_dir_path, engine="graph"):
+    """Fetch ontology terms, and get their lookup table fragment.
+
+    Fragments hold the terms of one fetched ontology, as added to an
+    empty lookup table by ``add_fetched_ontology_to_lookup_table``.
+    They are cached in ``fragments_dir_path`` by ``get_ontology_hash``
+    and LexMapr version, so they are only created again when the
+    ontology, its config file entry or LexMapr changes. Like fetched
+    terms, fragments of ontologies with imports are not cached. See
+    ``add_fragment_to_lookup_table`` and ``fetch_ontology``.
+
+    :param str ontology_iri: Path or URL of ontology
+    :param str root_entity_iri: IRI of entity whose subclasses are
+        fetched, or empty string to fetch all terms
+    :param str output_dir_path: Folder to write fetched ontology to, as
+        JSON and TSV
+    :param str cache_dir_path: Folder to cache fetched ontologies in
+    :param str fragments_dir_path: Folder to cache fragments in
+    :param str engine: See ``fetch_ontology``
+    :returns: Paths of fetched ontology JSON and fragment JSON
+    :rtype: tuple[str, str]
+    """
+    fetched_ontology_path, ontology_hash = fetch_ontology(
+        ontology_iri, root_entity_iri, output_dir_path, cache_dir_path, engine)
+
+    if ontology_hash:
+        fragment_path = os.path.join(fragments_dir_path,
+                                     "%s_%s.json" % (ontology_hash, __version__))
+        if os.path.exists(fragment_path):
+            return fetched_ontology_path, fragment_path
+    else:
+        fragment_path = os.path.join(output_dir_path, "fragment.json")
+
+    with open(fetched_ontology_path) as fp:
+        fetched_ontology = json.load(fp)
+    fragment = add_fetched_ontology_to_lookup_table(
+        {key: {} for key in LOOKUP_TABLE_FRAGMENT_KEYS}, fetched_ontology)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fragment_path))
+    with os.fdopen(fd, "w") as fp:
+        json.dump(fragment, fp)
+    os.replace(tmp_path, fragment_path)
+
+    return fetched_ontology_path, fragment_path
+
+
+def get_process_executor(num_tasks, initializer=None, initargs=()):
+    """Get an executor that runs tasks in separate processes.
+
+    Exceptions raised by tasks, including ``SystemExit`` from
+    ``lexmapr.ontofetch`` errors, are re-raised by the futures of the
+    executor.
+
+    :param int num_tasks: Number of tasks to run
+    :param initializer: Called with ``initargs`` at the start of each
+        worker process
+    :param tuple initargs: Arguments of ``initializer``
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    # Slow to import, and only needed to fetch ontologies or compute
+    # ancestors in parallel
+    from concurrent.futures import ProcessPoolExecutor
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    max_workers = max(1, min(num_tasks, os.cpu_count() or 1))
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                               initializer=initializer, initargs=initargs)
+
+
+def get_classification_resources(tokenizer="lexmapr"):
     """Get lookup table with resources used in bucket classification.
 
     Retrieves from disk if possible. Otherwise, creates from scratch
     and adds to disk.
 
+    Bucket labels are also indexed by bucket id, under the
+    ``bucket_labels_lexmapr`` and ``bucket_labels_ifsactop`` keys, and
+    ``ifsac_default`` buckets are tokenized under the
+    ``ifsac_default_tokens`` and ``ifsac_default_index`` keys. See
+    ``lexmapr.pipeline_classification.get_default_bucket_tokens``.
+    ``ifsac_refinement`` rules are compiled under the
+    ``ifsac_refinement_rules``, ``ifsac_refinement_index`` and
+    ``ifsac_refinement_pattern`` keys. See
+    ``lexmapr.pipeline_classification.get_refinement_rules``. These are
+    not added to disk.
+
+    :param str tokenizer: Tokenizer to tokenize buckets and rules
+        with. See ``lexmapr.tokenizer.TOKENIZERS``.
+    :rtype: dict[str, dict]
+    """
+    classification_lookup_table = load_classification_lookup_table()
+
+    bucket_labels_lexmapr, bucket_labels_ifsactop = get_bucket_labels(classification_lookup_table)
+    classification_lookup_table["bucket_labels_lexmapr"] = bucket_labels_lexmapr
+    classification_lookup_table["bucket_labels_ifsactop"] = bucket_labels_ifsactop
+
+    # Singularized tokens of ``ifsac_default`` buckets, and their index
+    default_bucket_tokens, default_bucket_index =\
+        get_default_bucket_tokens(classification_lookup_table["ifsac_default"], tokenizer)
+    classification_lookup_table["ifsac_default_tokens"] = default_bucket_tokens
+    classification_lookup_table["ifsac_default_index"] = default_bucket_index
+
+    # Compiled ``ifsac_refinement`` rules, their index and pattern
+    refinement_rules, refinement_index, refinement_pattern =\
+        get_refinement_rules(classification_lookup_table["ifsac_refinement"], tokenizer)
+    classification_lookup_table["ifsac_refinement_rules"] = refinement_rules
+    classification_lookup_table["ifsac_refinement_index"] = refinement_index
+    classification_lookup_table["ifsac_refinement_pattern"] = refinement_pattern
+
+    return classification_lookup_table
+
+
+def load_classification_lookup_table():
+    """Get lookup table of the classification resources on disk.
+
+    Retrieves from disk if possible. Otherwise, creates from scratch
+    and adds to disk. Unlike ``get_classification_resources``, nothing
+    is derived from the resources.
+
     :rtype: dict[str, dict]
     """
     classification_lookup_table_path =\
@@ -165,6 +489,121 @@ def get_classification_resources():
     return classification_lookup_table
 
 
+def get_bucket_labels(classification_lookup_table):
+    """Get the labels of LexMapr and IFSAC top-level buckets by id.
+
+    If several labels share an id, the last one is used.
+
+    :param dict[str, dict] classification_lookup_table: See
+        ``load_classification_lookup_table``
+    :returns: LexMapr and IFSAC top-level bucket ids, mapped to bucket
+        labels
+    :rtype: tuple[dict[str, str], dict[str, str]]
+    """
+    return ({v: k for k, v in classification_lookup_table["buckets_lexmapr"].items()},
+            {v: k for k, v in classification_lookup_table["buckets_ifsactop"].items()})
+
+
+def get_buckets_hashes(classification_lookup_table):
+    """Get hashes of the buckets nearest buckets are found in.
+
+    :param dict[str, dict] classification_lookup_table: See
+        ``load_classification_lookup_table``
+    :returns: Hex digests of ``buckets_lexmapr`` and
+        ``buckets_ifsactop``, by the key of the lookup table section
+        with their nearest buckets
+    :rtype: dict[str, str]
+    """
+    ret = {}
+    for buckets_key in ["buckets_lexmapr", "buckets_ifsactop"]:
+        buckets = list(classification_lookup_table[buckets_key].items())
+        ret["nearest_" + buckets_key] =\
+            hashlib.sha256(json.dumps(buckets).encode("utf-8")).hexdigest()
+    return ret
+
+
+@lru_cache(maxsize=None)
+def get_current_buckets_hashes():
+    """Get hashes of the buckets in the classification resources on disk.
+
+    These are computed once per process, as every lookup table loaded
+    is checked against them. See ``has_outdated_nearest_buckets``.
+
+    :returns: See ``get_buckets_hashes``
+    :rtype: dict[str, str]
+    """
+    return get_buckets_hashes(load_classification_lookup_table())
+
+
+def load_lookup_table(lookup_table_path, storage="compiled"):
+    """Load a lookup table cached as JSON.
+
+    Loads the compiled version of the cache instead, if it is at least
+    as recent. Otherwise, the cache is upgraded if outdated, and
+    compiled for future runs. See ``lexmapr.table_storage``.
+
+    :param str lookup_table_path: Path of JSON lookup table
+    :param str storage: Storage backend to compile the lookup table
+        with
+    :rtype: dict[str, collections.abc.Mapping]
+    """
+    compiled_lookup_table_path = table_storage.get_compiled_path(lookup_table_path, storage)
+    try:
+        if os.path.getmtime(compiled_lookup_table_path) >= os.path.getmtime(lookup_table_path):
+            lookup_table = table_storage.load(compiled_lookup_table_path, storage)
+            if not is_outdated_lookup_table(lookup_table):
+                return lookup_table
+    except (OSError, table_storage.LookupTableFileError):
+        # Missing, outdated or corrupted compiled lookup table
+        pass
+
+    with open(lookup_table_path) as fp:
+        lookup_table = json.load(fp)
+    if is_outdated_lookup_table(lookup_table):
+        lookup_table = upgrade_lookup_table(lookup_table)
+
+    return compile_lookup_table(lookup_table, compiled_lookup_table_path, storage)
+
+
+def dump_lookup_table(lookup_table, lookup_table_path, storage="compiled"):
+    """Cache a lookup table as JSON, and compile it.
+
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :param str lookup_table_path: Path of JSON lookup table
+    :param str storage: Storage backend to compile ``lookup_table``
+        with
+    :returns: Compiled ``lookup_table``, if it could be written to disk
+    :rtype: dict[str, collections.abc.Mapping]
+    """
+    with open(lookup_table_path, "w") as fp:
+        json.dump(lookup_table, fp)
+
+    compiled_lookup_table_path = table_storage.get_compiled_path(lookup_table_path, storage)
+    return compile_lookup_table(lookup_table, compiled_lookup_table_path, storage)
+
+
+def compile_lookup_table(lookup_table, compiled_lookup_table_path, storage="compiled"):
+    """Compile a lookup table, and load the compiled version.
+
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :param str compiled_lookup_table_path: Path to compile
+        ``lookup_table`` to
+    :param str storage: Storage backend to compile ``lookup_table``
+        with
+    :returns: Compiled ``lookup_table``, or ``lookup_table`` itself if
+        it could not be written to disk
+    :rtype: dict[str, collections.abc.Mapping]
+    """
+    try:
+        table_storage.dump(lookup_table, compiled_lookup_table_path, storage)
+    except (OSError, table_storage.LookupTableFileError):
+        # Read-only installation
+        return lookup_table
+    return table_storage.load(compiled_lookup_table_path, storage)
+
+
 def create_lookup_table_skeleton():
     """Generate an empty lookup table.
 
@@ -176,15 +615,42 @@ def create_lookup_table_skeleton():
         "non_standard_resource_ids": {},
         # standardized_ontology_resource_label:ontology_resource_id
         "standard_resource_labels": {},
-        # Keys are some permutation of a standardized ontology resource
+        # Keys are the sorted tokens of a standardized ontology resource
         # label, and values are the corresponding ontology resource id.
-        "standard_resource_label_permutations": {},
+        # All permutations of a label share the same key. See
+        # ``lexmapr.pipeline_helpers.get_token_bag``.
+        "standard_resource_label_bags": {},
         # Keys are some synonym of an ontology resource, and values are
         # the corresponding standardized ontology resource label.
         "synonyms": {},
+        # Keys are the sorted tokens of a synonym, and values are the
+        # corresponding standardized ontology resource label. All
+        # permutations of a synonym share the same key.
+        "synonym_bags": {},
+        # Keys are tokens, and values are arrays of the resource label
+        # and synonym token bags that can only be mapped in samples
+        # with that token. See
+        # ``lexmapr.pipeline_helpers.get_token_index``.
+        "label_bag_index": {},
+        "synonym_bag_index": {},
         # Keys are some ontology resource id, and values are an array
         # of immediate ontology parent ids.
         "parents": {},
+        # Keys are some ontology resource id with parents, and values
+        # are an array of the ids in its parent hierarchies. See
+        # ``lexmapr.pipeline_helpers.get_term_parent_hierarchies``.
+        "ancestors": {},
+        # Keys are some ontology resource id with parents, and values
+        # are an array of the nearest buckets in its parent
+        # hierarchies. See
+        # ``lexmapr.pipeline_classification.get_nearest_buckets``.
+        "nearest_buckets_lexmapr": {},
+        "nearest_buckets_ifsactop": {},
+        # Keys are ``nearest_buckets_lexmapr`` and
+        # ``nearest_buckets_ifsactop``, and values are hashes of the
+        # buckets they were found in. Nearest buckets are found again
+        # when the buckets change. See ``get_buckets_hashes``.
+        "buckets_hashes": {},
         "abbreviations": {},
         "non_english_words": {},
         "spelling_mistakes": {},
@@ -199,6 +665,97 @@ def create_lookup_table_skeleton():
         }
 
 
+def is_outdated_lookup_table(lookup_table):
+    """Determine whether a lookup table was cached by older LexMapr.
+
+    Lookup tables with the nearest buckets of buckets that since
+    changed are also outdated. See ``has_outdated_nearest_buckets``.
+
+    :param dict lookup_table: See create_lookup_table_skeleton for the
+        expected format of this parameter
+    :rtype: bool
+    """
+    if lookup_table.keys() != create_lookup_table_skeleton().keys():
+        return True
+    return has_outdated_nearest_buckets(lookup_table)
+
+
+def has_outdated_nearest_buckets(lookup_table):
+    """Determine whether buckets changed since nearest buckets were found.
+
+    :param dict lookup_table: See create_lookup_table_skeleton for the
+        expected format of this parameter
+    :rtype: bool
+    """
+    if not lookup_table["parents"]:
+        # No resource has nearest buckets
+        return False
+    return dict(lookup_table.get("buckets_hashes", {})) != get_current_buckets_hashes()
+
+
+def upgrade_lookup_table(lookup_table):
+    """Convert a lookup table cached by older LexMapr.
+
+    Sections no longer in ``create_lookup_table_skeleton`` are
+    removed, and missing sections are derived from the others.
+
+    :param lookup_table: See create_lookup_table_skeleton for the
+                         expected format of this parameter
+    :type lookup_table: dict
+    :return: Modified ``lookup_table``
+    :rtype: dict
+    """
+    # Permutations of resource labels are matched with token bags
+    lookup_table.pop("standard_resource_label_permutations", None)
+    if "standard_resource_label_bags" not in lookup_table:
+        lookup_table["standard_resource_label_bags"] = {
+            get_token_bag(k): v
+            for k, v in lookup_table["standard_resource_labels"].items()
+        }
+
+    # Permutations of synonyms are matched with token bags
+    if "synonym_bags" not in lookup_table:
+        lookup_table["synonym_bags"] = get_synonym_bags(lookup_table["synonyms"])
+
+    if "ancestors" not in lookup_table or has_outdated_nearest_buckets(lookup_table):
+        lookup_table = add_ancestors_to_lookup_table(lookup_table)
+
+    if "label_bag_index" not in lookup_table or "synonym_bag_index" not in lookup_table:
+        lookup_table = add_token_index_to_lookup_table(lookup_table)
+
+    # Keep the section order of ``create_lookup_table_skeleton``
+    return {k: lookup_table[k] for k in create_lookup_table_skeleton()}
+
+
+def get_synonym_bags(synonyms):
+    """Get the synonyms of a lookup table by token bag.
+
+    :param dict[str, str] synonyms: See ``create_lookup_table_skeleton``
+    :returns: Resource labels, by the token bag of their synonyms. See
+        ``lexmapr.pipeline_helpers.get_token_bag``.
+    :rtype: dict[str, str]
+    """
+    return {get_token_bag(k): v for k, v in synonyms.items()}
+
+
+def add_token_index_to_lookup_table(lookup_table):
+    """Add the token indexes of resource labels and synonyms.
+
+    Samples are mapped with the predefined suffixes, even if
+    ``lookup_table`` has none, so bags are indexed accordingly. See
+    ``lexmapr.pipeline_helpers.get_token_index``.
+
+    :param dict[str, dict] lookup_table: See
+        ``create_lookup_table_skeleton``
+    :return: Modified ``lookup_table``
+    :rtype: dict[str, dict]
+    """
+    suffixes = get_resource_dict("suffixes.csv")
+    lookup_table["label_bag_index"], lookup_table["synonym_bag_index"] =\
+        get_token_index(lookup_table, suffixes)
+    return lookup_table
+
+
 def add_predefined_resources_to_lookup_table(lookup_table):
     """Add elements from lexmapr.predefined_resources to lookup table.
 
@@ -226,6 +783,7 @@ def add_predefined_resources_to_lookup_table(lookup_table):
         punctuation_treatment(k): punctuation_treatment(v)
         for k, v in lookup_table["synonyms"].items()
     }
+    lookup_table["synonym_bags"] = get_synonym_bags(lookup_table["synonyms"])
 
     lookup_table["non_standard_resource_ids"] = get_resource_dict("CombinedResourceTerms.csv")
 
@@ -234,17 +792,12 @@ def add_predefined_resources_to_lookup_table(lookup_table):
         for k, v in lookup_table["non_standard_resource_ids"].items()
     }
 
-    for label in lookup_table["standard_resource_labels"]:
-        resource_id = lookup_table["standard_resource_labels"][label]
-        label_tokens = word_tokenize(label)
-        # To limit performance overhead, we ignore resource labels with
-        # more than 7 tokens, as permutating too many tokens can be
-        # costly. We also ignore NCBI taxon terms, as there are
-        # ~160000 such terms.
-        if len(label_tokens) <7 and "ncbitaxon" not in resource_id:
-            label_permutations = get_resource_label_permutations(label)
-            for permutation in label_permutations:
-                lookup_table["standard_resource_label_permutations"][permutation] = resource_id
+    lookup_table["standard_resource_label_bags"] = {
+        get_token_bag(k): v
+        for k, v in lookup_table["standard_resource_labels"].items()
+    }
+
+    lookup_table = add_token_index_to_lookup_table(lookup_table)
     return lookup_table
 
 
@@ -286,25 +839,37 @@ def get_resource_dict(resource_file_name):
     return ret
 
 
-def get_resource_label_permutations(resource_label):
-    """Get permutations of some term.
+def add_fragment_to_lookup_table(lookup_table, fragment):
+    """Add a lookup table fragment to lookup_table.
 
-    :param resource_label: Name of some resource
-    :type resource_label: str
-    :return: All permutations of resource_label
-    :rtype: list
+    The result is the same as adding the fetched ontology of
+    ``fragment`` with ``add_fetched_ontology_to_lookup_table``:
+    resources, labels and synonyms overwrite those already in
+    ``lookup_table``, and parents are concatenated.
+
+    :param dict lookup_table: See create_lookup_table_skeleton for the
+        expected format of this parameter
+    :param dict fragment: See ``get_lookup_table_fragment``
+    :return: Modified ``lookup_table``
+    :rtype: dict
     """
-    # List of tuples, where each tuple is a different permutation of
-    # tokens from label
-    permutations_set = list(OrderedDict.fromkeys(permutations(resource_label.split())))
-    # Return value
-    ret = []
-    # Generate a string from each tuple, and add it to ret
-    for permutation_tuple in permutations_set:
-        permutation_string = " ".join(permutation_tuple)
-        ret = ret + [permutation_string]
+    # Fragments cached by older LexMapr have no synonym bags
+    if "synonym_bags" not in fragment:
+        fragment["synonym_bags"] = get_synonym_bags(fragment["synonyms"])
+
+    for key in LOOKUP_TABLE_FRAGMENT_KEYS:
+        if key != "parents":
+            lookup_table[key].update(fragment[key])
+
+    for resource_id, parent_ids in fragment["parents"].items():
+        if resource_id in lookup_table["parents"]:
+            resource_parent_ids = lookup_table["parents"][resource_id]
+            # Prevent duplicates
+            resource_parent_ids += [p for p in parent_ids if p not in resource_parent_ids]
+        else:
+            lookup_table["parents"][resource_id] = list(parent_ids)
 
-    return ret
+    return lookup_table
 
 
 def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
@@ -337,15 +902,9 @@ def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
             resource_label = punctuation_treatment(resource_label)
             lookup_table["standard_resource_labels"][resource_label] = resource_id
 
-            # List of tokens in resource_label
-            resource_tokens = word_tokenize(resource_label)
-            # Add permutations if there are less than seven tokens.
-            # Permutating more tokens than this can lead to performance
-            # issues.
-            if len(resource_tokens) < 7:
-                permutations = get_resource_label_permutations(resource_label)
-                for permutation in permutations:
-                    lookup_table["standard_resource_label_permutations"][permutation] = resource_id
+            # Matches any permutation of the label's tokens
+            resource_label_bag = get_token_bag(resource_label)
+            lookup_table["standard_resource_label_bags"][resource_label_bag] = resource_id
 
             if "oboInOwl:hasSynonym" in resource:
                 synonyms = resource["oboInOwl:hasSynonym"]
@@ -354,6 +913,7 @@ def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
                     synonym = punctuation_treatment(synonym.lower())
 
                     lookup_table["synonyms"][synonym] = resource_label
+                    lookup_table["synonym_bags"][get_token_bag(synonym)] = resource_label
 
             if "oboInOwl:hasNarrowSynonym" in resource:
                 synonyms = resource["oboInOwl:hasNarrowSynonym"]
@@ -362,6 +922,7 @@ def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
                     synonym = punctuation_treatment(synonym.lower())
 
                     lookup_table["synonyms"][synonym] = resource_label
+                    lookup_table["synonym_bags"][get_token_bag(synonym)] = resource_label
 
             if "oboInOwl:hasExactSynonym" in resource:
                 synonyms = resource["oboInOwl:hasExactSynonym"]
@@ -370,6 +931,7 @@ def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
                     synonym = punctuation_treatment(synonym.lower())
 
                     lookup_table["synonyms"][synonym] = resource_label
+                    lookup_table["synonym_bags"][get_token_bag(synonym)] = resource_label
 
             if "parent_id" in resource:
                 # Standardize parent_id
@@ -408,6 +970,121 @@ def add_fetched_ontology_to_lookup_table(lookup_table, fetched_ontology):
     return lookup_table
 
 
+def add_ancestors_to_lookup_table(lookup_table):
+    """Add the ancestors and nearest buckets of resources to lookup table.
+
+    These are precomputed from the parent hierarchies of each resource
+    with parents, so they need not be enumerated while mapping.
+
+    :param lookup_table: See create_lookup_table_skeleton for the
+                         expected format of this parameter
+    :type lookup_table: dict
+    :return: Modified ``lookup_table``
+    :rtype: dict
+    """
+    lookup_table["ancestors"] = {}
+    lookup_table["nearest_buckets_lexmapr"] = {}
+    lookup_table["nearest_buckets_ifsactop"] = {}
+    lookup_table["buckets_hashes"] = {}
+    if not lookup_table["parents"]:
+        return lookup_table
+
+    classification_lookup_table = load_classification_lookup_table()
+    bucket_labels = get_bucket_labels(classification_lookup_table)
+    lookup_table["buckets_hashes"] = get_buckets_hashes(classification_lookup_table)
+
+    # Large tables are done in chunks, across processes if there are
+    # several CPUs. Chunks are added in order, so resources keep the
+    # order of ``lookup_table["parents"]``.
+    resource_ids = list(lookup_table["parents"])
+    chunks = [resource_ids[i:i+ANCESTORS_CHUNK_SIZE]
+              for i in range(0, len(resource_ids), ANCESTORS_CHUNK_SIZE)]
+    if len(chunks) > 1 and (os.cpu_count() or 1) > 1:
+        parents_lookup_table = {"parents": lookup_table["parents"]}
+        with get_process_executor(len(chunks), init_ancestors_worker,
+                                  (parents_lookup_table, bucket_labels)) as executor:
+            chunk_ancestors = executor.map(get_ancestors_chunk, chunks)
+            for chunk, ancestors in zip(chunks, chunk_ancestors):
+                add_resource_ancestors_to_lookup_table(lookup_table, chunk, ancestors)
+    else:
+        ancestors = get_resource_ancestors(resource_ids, lookup_table, *bucket_labels)
+        add_resource_ancestors_to_lookup_table(lookup_table, resource_ids, ancestors)
+
+    return lookup_table
+
+
+def get_resource_ancestors(resource_ids, lookup_table, bucket_labels_lexmapr,
+                           bucket_labels_ifsactop):
+    """Get the ancestors and nearest buckets of resources with parents.
+
+    :param list[str] resource_ids: IDs of resources in
+        ``lookup_table["parents"]``
+    :param dict lookup_table: See create_lookup_table_skeleton for the
+        expected format of this parameter. Only ``parents`` is used.
+    :param dict[str, str] bucket_labels_lexmapr: LexMapr bucket ids
+        mapped to bucket labels
+    :param dict[str, str] bucket_labels_ifsactop: IFSAC top-level
+        bucket ids mapped to bucket labels
+    :returns: Ancestors, nearest LexMapr buckets and nearest IFSAC
+        top-level buckets of each resource, in ``resource_ids`` order
+    :rtype: list[tuple[list, list, list]]
+    """
+    ret = []
+    for resource_id in resource_ids:
+        hierarchies = get_term_parent_hierarchies(resource_id, lookup_table)
+
+        # The first element of each hierarchy is ``resource_id``
+        ancestors = dict.fromkeys(a for hierarchy in hierarchies for a in hierarchy[1:])
+        ret.append((list(ancestors),
+                    get_nearest_buckets(hierarchies, bucket_labels_lexmapr),
+                    get_nearest_buckets(hierarchies, bucket_labels_ifsactop)))
+    return ret
+
+
+def add_resource_ancestors_to_lookup_table(lookup_table, resource_ids, resource_ancestors):
+    """Add output of ``get_resource_ancestors`` to lookup table.
+
+    :param dict lookup_table: See create_lookup_table_skeleton for the
+        expected format of this parameter
+    :param list[str] resource_ids: IDs passed to
+        ``get_resource_ancestors``
+    :param list[tuple[list, list, list]] resource_ancestors: Output of
+        ``get_resource_ancestors``
+    """
+    for resource_id, (ancestors, nearest_buckets_lexmapr, nearest_buckets_ifsactop)\
+            in zip(resource_ids, resource_ancestors):
+        lookup_table["ancestors"][resource_id] = ancestors
+        lookup_table["nearest_buckets_lexmapr"][resource_id] = nearest_buckets_lexmapr
+        lookup_table["nearest_buckets_ifsactop"][resource_id] = nearest_buckets_ifsactop
+
+
+# ``get_resource_ancestors`` arguments shared by the chunks done in a
+# worker process of ``add_ancestors_to_lookup_table``
+ancestors_worker_args = None
+
+
+def init_ancestors_worker(lookup_table, bucket_labels):
+    """Initialize a worker process of ``add_ancestors_to_lookup_table``.
+
+    :param dict lookup_table: Lookup table with ``parents``
+    :param tuple[dict, dict] bucket_labels: LexMapr and IFSAC top-level
+        bucket ids mapped to bucket labels
+    """
+    global ancestors_worker_args
+    ancestors_worker_args = (lookup_table,) + tuple(bucket_labels)
+
+
+def get_ancestors_chunk(resource_ids):
+    """Get ``get_resource_ancestors`` output in a worker process.
+
+    See ``init_ancestors_worker``.
+
+    :param list[str] resource_ids: IDs of resources with parents
+    :rtype: list[tuple[list, list, list]]
+    """
+    return get_resource_ancestors(resource_ids, *ancestors_worker_args)
+
+
 def add_classification_resources_to_lookup_table(classification_lookup_table):
     """Add classification elements to lookup table.
 
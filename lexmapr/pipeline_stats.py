@@ -0,0 +1,151 @@
+"""Timings and counters of the work done by lexmapr.pipeline.run."""
+
+from collections import Counter
+import json
+import sys
+import time
+
+# Stages of ``lexmapr.pipeline.run``, in the order they are reported
+STAGES = ["setup", "cleaning", "full_term_match", "gram_chunks", "component_match",
+          "ancestors", "classification", "output"]
+
+# Counters of ``lexmapr.pipeline.run`` work, in the order they are
+# reported
+COUNTERS = ["samples", "tokens", "map_term_probes", "gram_chunks", "gram_chunks_skipped",
+            "hierarchy_paths"]
+
+
+class MappingStats(object):
+    """Wall time spent in, and work done by, stages of mapping samples.
+
+    Stages are timed by passing the time they started at to
+    ``add_time``, which returns the time the next stage starts at.
+    """
+
+    def __init__(self):
+        self.timings = Counter()
+        self.counters = Counter()
+
+    def add_time(self, stage, start):
+        """Add the time elapsed since ``start`` to ``stage``.
+
+        :param str stage: One of ``STAGES``
+        :param float start: ``time.perf_counter`` value ``stage``
+            started at
+        :returns: Current ``time.perf_counter`` value
+        :rtype: float
+        """
+        now = time.perf_counter()
+        self.timings[stage] += now - start
+        return now
+
+    def count(self, counter, n=1):
+        """Add ``n`` to ``counter``.
+
+        :param str counter: One of ``COUNTERS``
+        :param int n: Amount of work done
+        """
+        self.counters[counter] += n
+
+    def counted(self, function, counter):
+        """Get ``function``, counting its calls in ``counter``.
+
+        :param collections.abc.Callable function: Function to count
+            calls of
+        :param str counter: One of ``COUNTERS``
+        :rtype: collections.abc.Callable
+        """
+        def wrapper(*args, **kwargs):
+            self.counters[counter] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    def update(self, stats_dict):
+        """Add timings and counters of other stats to these.
+
+        :param dict stats_dict: See ``as_dict``
+        """
+        self.timings.update(stats_dict["timings"])
+        self.counters.update(stats_dict["counters"])
+
+    def as_dict(self):
+        """Get timings and counters, in reported order.
+
+        :returns: Seconds spent in each stage under ``timings``, and
+            the value of each counter under ``counters``
+        :rtype: dict[str, dict]
+        """
+        return {
+            "timings": {stage: self.timings[stage] for stage in STAGES},
+            "counters": {counter: self.counters[counter] for counter in COUNTERS}
+        }
+
+    def pop(self):
+        """Get timings and counters, and reset them.
+
+        :returns: See ``as_dict``
+        :rtype: dict[str, dict]
+        """
+        ret = self.as_dict()
+        self.timings.clear()
+        self.counters.clear()
+        return ret
+
+    def report(self, path="-"):
+        """Report timings and counters.
+
+        :param str path: File to write timings and counters to as
+            JSON, or ``"-"`` to print them to standard error
+        """
+        stats_dict = self.as_dict()
+        if path != "-":
+            with open(path, "w") as fp:
+                json.dump(stats_dict, fp, indent=4)
+                fp.write("\n")
+            return
+
+        total = sum(stats_dict["timings"].values())
+        lines = ["Stage\tSeconds\t%"]
+        for stage, seconds in stats_dict["timings"].items():
+            percent = 100 * seconds / total if total else 0
+            lines.append("%s\t%.3f\t%.1f" % (stage, seconds, percent))
+        lines.append("total\t%.3f\t100.0" % total)
+        lines.append("")
+        lines.append("Counter\tValue")
+        for counter, value in stats_dict["counters"].items():
+            lines.append("%s\t%d" % (counter, value))
+        sys.stderr.write("\n".join(lines) + "\n")
+
+
+def write_slow_sample(fp, sample_stats, threshold):
+    """Write the stats of a sample slower to map than ``threshold``.
+
+    Samples are written as lines of JSON, with their id, description,
+    token count, candidate gram chunk count, ``map_term`` probe count,
+    and time spent in each stage, so they can be mapped again as
+    regression cases.
+
+    :param fp: Text file object of slow sample log
+    :param dict sample_stats: Stats recorded mapping sample. See
+        ``lexmapr.pipeline.map_row_with_stats``.
+    :param float threshold: Seconds a sample must take to be written
+    :returns: Whether the sample was written
+    :rtype: bool
+    """
+    seconds = sum(sample_stats["timings"].values())
+    if seconds < threshold:
+        return False
+
+    counters = sample_stats["counters"]
+    fp.write(json.dumps({
+        "sample_id": sample_stats["sample_id"],
+        "sample": sample_stats["sample"],
+        "seconds": seconds,
+        "tokens": counters["tokens"],
+        "gram_chunks": counters["gram_chunks"],
+        "map_term_probes": counters["map_term_probes"],
+        "timings": {stage: t for stage, t in sample_stats["timings"].items() if stage != "setup"}
+    }) + "\n")
+    # Keep log current while long runs stall on slow samples
+    fp.flush()
+    return True
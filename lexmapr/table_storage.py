@@ -0,0 +1,483 @@
+"""Compiled, memory-mapped lookup tables.
+
+Lookup tables are cached as JSON, which must be parsed in full before
+any sample is mapped. This module compiles them into files that are
+queried one section and entry at a time instead. Two storage backends
+are supported:
+
+* ``compiled``: binary files that are memory-mapped
+* ``sqlite``: indexed SQLite databases, with recently read entries
+  cached in memory. Memory use stays bounded, at the cost of slower
+  lookups.
+
+Layout of ``compiled`` files, with all integers little-endian:
+
+* Header: magic bytes, format version, CRC-32 checksum of everything
+  after the header, and the number of sections. The checksum is
+  verified once, when the file is compiled, not every time it is
+  loaded.
+* Directory: for each section, its name, offset, number of hash slots
+  and number of entries
+* Sections: an open-addressing hash table of entry numbers, the
+  offsets of entries in insertion order, and the entries themselves.
+  Each entry is a key, followed by a tagged value.
+"""
+
+from collections.abc import Mapping
+from functools import lru_cache
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+
+# Identifies compiled lookup table files
+MAGIC = b"LEXMAPRT"
+# Incremented whenever the layout of compiled lookup tables changes
+VERSION = 1
+# Extension of lookup table files compiled by each storage backend
+STORAGE_EXTENSIONS = {"compiled": ".lxt", "sqlite": ".sqlite"}
+# Maximum number of entries cached in memory for each section of
+# SQLite lookup tables.
+SQLITE_CACHE_SIZE = 4096
+
+_HEADER = struct.Struct("<8sIII")
+_DIRECTORY_ENTRY = struct.Struct("<QII")
+_UINT8 = struct.Struct("<B")
+_UINT16 = struct.Struct("<H")
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("<Q")
+
+# Tags of encoded values
+_STR_TAG = 0
+_STR_LIST_TAG = 1
+_JSON_TAG = 2
+
+
+class LookupTableFileError(Exception):
+    """Raised when a compiled lookup table cannot be loaded or written."""
+
+
+class LookupTableFile(object):
+    """Memory-mapped compiled lookup table file.
+
+    :param str path: Path of compiled lookup table
+    :param bool verify: Compare the checksum in the header of ``path``
+        to its contents. This reads the whole file, so it is only done
+        when ``path`` is compiled. See ``dump``.
+    :raises LookupTableFileError: if ``path`` is not a compiled lookup
+        table of the current version, or fails verification
+    """
+
+    def __init__(self, path, verify=False):
+        self.path = path
+
+        with open(path, "rb") as fp:
+            try:
+                self.buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise LookupTableFileError("%s is empty" % path)
+
+        if len(self.buffer) < _HEADER.size:
+            raise LookupTableFileError("%s is truncated" % path)
+        magic, version, checksum, section_count = _HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise LookupTableFileError("%s is not a compiled lookup table" % path)
+        if version != VERSION:
+            raise LookupTableFileError("%s has unsupported version %d" % (path, version))
+        if verify:
+            with memoryview(self.buffer) as view, view[_HEADER.size:] as body:
+                if zlib.crc32(body) != checksum:
+                    raise LookupTableFileError("%s has an invalid checksum" % path)
+
+        # Section names, mapped to sections
+        self.sections = {}
+        offset = _HEADER.size
+        for _ in range(section_count):
+            name_length, = _UINT16.unpack_from(self.buffer, offset)
+            offset += _UINT16.size
+            name = self.buffer[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            section_offset, slot_count, entry_count =\
+                _DIRECTORY_ENTRY.unpack_from(self.buffer, offset)
+            offset += _DIRECTORY_ENTRY.size
+            self.sections[name] =\
+                LookupTableSection(self, name, section_offset, slot_count, entry_count)
+
+    def __reduce__(self):
+        # Memory maps cannot be pickled, so map the file again instead.
+        # It was already verified, if needed.
+        return self.__class__, (self.path,)
+
+
+class LookupTableSection(Mapping):
+    """Read-only lookup table section in a compiled lookup table file.
+
+    Entries are decoded when accessed. Iteration follows the order
+    entries were added to the section before compiling.
+
+    :param LookupTableFile file: File containing section
+    :param str name: Name of section
+    :param int offset: Offset of section in ``file``
+    :param int slot_count: Number of slots in the section's hash table
+    :param int entry_count: Number of entries in the section
+    """
+
+    def __init__(self, file, name, offset, slot_count, entry_count):
+        self.file = file
+        self.name = name
+        self.buffer = file.buffer
+        self.slot_count = slot_count
+        self.entry_count = entry_count
+        self.slots_offset = offset
+        self.entry_offsets_offset = offset + slot_count * _UINT32.size
+
+    def _get_entry_offset(self, entry_number):
+        return _UINT64.unpack_from(self.buffer,
+                                   self.entry_offsets_offset + entry_number * _UINT64.size)[0]
+
+    def _decode_key(self, entry_offset):
+        key_length, = _UINT32.unpack_from(self.buffer, entry_offset)
+        key_offset = entry_offset + _UINT32.size
+        return self.buffer[key_offset:key_offset + key_length].decode("utf-8")
+
+    def _find_value_offset(self, key):
+        """Get the offset of the value of ``key``, or ``-1``."""
+        if not isinstance(key, str):
+            return -1
+        key_bytes = key.encode("utf-8")
+        mask = self.slot_count - 1
+        slot = zlib.crc32(key_bytes) & mask
+        while True:
+            entry_number, = _UINT32.unpack_from(self.buffer,
+                                                self.slots_offset + slot * _UINT32.size)
+            if not entry_number:
+                return -1
+            entry_offset = self._get_entry_offset(entry_number - 1)
+            key_length, = _UINT32.unpack_from(self.buffer, entry_offset)
+            key_offset = entry_offset + _UINT32.size
+            if key_length == len(key_bytes) and\
+                    self.buffer[key_offset:key_offset + key_length] == key_bytes:
+                return key_offset + key_length
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key):
+        value_offset = self._find_value_offset(key)
+        if value_offset < 0:
+            raise KeyError(key)
+        return _decode_value(self.buffer, value_offset)
+
+    def __contains__(self, key):
+        return self._find_value_offset(key) >= 0
+
+    def __iter__(self):
+        for entry_number in range(self.entry_count):
+            yield self._decode_key(self._get_entry_offset(entry_number))
+
+    def __len__(self):
+        return self.entry_count
+
+    def __reduce__(self):
+        return _get_section, (self.file, self.name)
+
+    def __repr__(self):
+        return "%s(%d entries)" % (self.__class__.__name__, self.entry_count)
+
+
+def _get_section(file, name):
+    return file.sections[name]
+
+
+class SQLiteLookupTableFile(object):
+    """SQLite lookup table file.
+
+    :param str path: Path of SQLite lookup table
+    :raises LookupTableFileError: if ``path`` is not a SQLite lookup
+        table of the current version
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        # Process ``_connection`` was opened in
+        self._connection_pid = None
+
+        try:
+            version, = self.connection.execute("PRAGMA user_version").fetchone()
+            rows = self.connection.execute(
+                "SELECT name, entry_count FROM sections ORDER BY position").fetchall()
+        except sqlite3.Error as e:
+            raise LookupTableFileError("%s is not a SQLite lookup table: %s" % (path, e))
+        if version != VERSION:
+            raise LookupTableFileError("%s has unsupported version %d" % (path, version))
+
+        # Section names, mapped to sections
+        self.sections = {name: SQLiteLookupTableSection(self, name, entry_count)
+                         for name, entry_count in rows}
+
+    @property
+    def connection(self):
+        """Read-only connection to the SQLite lookup table.
+
+        SQLite connections must not be used across forks, so each
+        process opens its own connection.
+
+        :rtype: sqlite3.Connection
+        """
+        if self._connection_pid != os.getpid():
+            # ``urllib.request`` imports ``ssl`` and ``http``, which are
+            # slow to import and otherwise unused
+            from urllib.request import pathname2url
+            uri = "file:%s?mode=ro" % pathname2url(os.path.abspath(self.path))
+            try:
+                self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            except sqlite3.Error as e:
+                raise LookupTableFileError("%s cannot be opened: %s" % (self.path, e))
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def __reduce__(self):
+        return self.__class__, (self.path,)
+
+
+class SQLiteLookupTableSection(Mapping):
+    """Read-only lookup table section in a SQLite lookup table file.
+
+    Up to ``SQLITE_CACHE_SIZE`` recently read entries are cached in
+    memory. Iteration follows the order entries were added to the
+    section before compiling.
+
+    :param SQLiteLookupTableFile file: File containing section
+    :param str name: Name of section
+    :param int entry_count: Number of entries in the section
+    """
+
+    def __init__(self, file, name, entry_count):
+        self.file = file
+        self.name = name
+        self.entry_count = entry_count
+        self._get_encoded_value = lru_cache(maxsize=SQLITE_CACHE_SIZE)(self._query_encoded_value)
+
+    def _query_encoded_value(self, key):
+        """Get the JSON-encoded value of ``key``, or ``None``."""
+        row = self.file.connection.execute(
+            "SELECT value FROM entries WHERE section = ? AND key = ?", (self.name, key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def __getitem__(self, key):
+        encoded_value = self._get_encoded_value(key) if isinstance(key, str) else None
+        if encoded_value is None:
+            raise KeyError(key)
+        return json.loads(encoded_value)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._get_encoded_value(key) is not None
+
+    def __iter__(self):
+        cursor = self.file.connection.execute(
+            "SELECT key FROM entries WHERE section = ? ORDER BY position", (self.name,))
+        for key, in cursor:
+            yield key
+
+    def __len__(self):
+        return self.entry_count
+
+    def __reduce__(self):
+        return _get_section, (self.file, self.name)
+
+    def __repr__(self):
+        return "%s(%d entries)" % (self.__class__.__name__, self.entry_count)
+
+
+def get_compiled_path(lookup_table_path, storage="compiled"):
+    """Get the path of the compiled version of a JSON lookup table.
+
+    :param str lookup_table_path: Path of JSON lookup table
+    :param str storage: Storage backend. See ``STORAGE_EXTENSIONS``.
+    :rtype: str
+    """
+    return os.path.splitext(lookup_table_path)[0] + STORAGE_EXTENSIONS[storage]
+
+
+def load(path, storage="compiled"):
+    """Load a compiled lookup table.
+
+    Sections are memory-mapped or queried from SQLite, not read into
+    memory.
+
+    :param str path: Path of compiled lookup table
+    :param str storage: Storage backend ``path`` was compiled with
+    :returns: Lookup table, with read-only sections. See
+        ``lexmapr.pipeline_resources.create_lookup_table_skeleton``.
+    :rtype: dict[str, collections.abc.Mapping]
+    :raises LookupTableFileError: if ``path`` is not a lookup table
+        compiled by the current version of ``storage``
+    """
+    if storage == "sqlite":
+        return dict(SQLiteLookupTableFile(path).sections)
+    return dict(LookupTableFile(path).sections)
+
+
+def dump(lookup_table, path, storage="compiled"):
+    """Compile ``lookup_table`` into a file at ``path``.
+
+    ``path`` is replaced atomically, so concurrent runs never load a
+    partially written file. Compiled files are verified before
+    replacing ``path``, so loading them need not verify them again.
+
+    :param dict[str, dict] lookup_table: See
+        ``lexmapr.pipeline_resources.create_lookup_table_skeleton``
+    :param str path: Path of compiled lookup table
+    :param str storage: Storage backend to compile ``lookup_table``
+        with
+    :raises LookupTableFileError: if SQLite cannot write to ``path``,
+        or the compiled file fails verification
+    """
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    if os.path.exists(temp_path):
+        # Left behind by an interrupted run
+        os.remove(temp_path)
+    if storage == "sqlite":
+        try:
+            _dump_sqlite(lookup_table, temp_path)
+        except sqlite3.Error as e:
+            raise LookupTableFileError("%s cannot be written: %s" % (path, e))
+    else:
+        _dump_compiled(lookup_table, temp_path)
+        try:
+            LookupTableFile(temp_path, verify=True).buffer.close()
+        except LookupTableFileError:
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+
+
+def _dump_compiled(lookup_table, path):
+    directory = bytearray()
+    sections = bytearray()
+    # Sections start after the header and directory
+    sections_offset = _HEADER.size
+    for name in lookup_table:
+        sections_offset +=\
+            _UINT16.size + len(name.encode("utf-8")) + _DIRECTORY_ENTRY.size
+
+    for name, section in lookup_table.items():
+        section_offset = sections_offset + len(sections)
+        encoded_section, slot_count = _encode_section(section, section_offset)
+        sections += encoded_section
+
+        name_bytes = name.encode("utf-8")
+        directory += _UINT16.pack(len(name_bytes)) + name_bytes
+        directory += _DIRECTORY_ENTRY.pack(section_offset, slot_count, len(section))
+
+    body = directory + sections
+    header = _HEADER.pack(MAGIC, VERSION, zlib.crc32(body), len(lookup_table))
+
+    with open(path, "wb") as fp:
+        fp.write(header)
+        fp.write(body)
+
+
+def _encode_section(section, section_offset):
+    """Encode a lookup table section.
+
+    :param dict section: Lookup table section
+    :param int section_offset: Offset of the section in its file
+    :returns: Encoded section, and the number of slots in its hash
+        table
+    :rtype: tuple[bytearray, int]
+    """
+    # Power of two, with at least half of slots empty
+    slot_count = 1
+    while slot_count < 2 * len(section) + 1:
+        slot_count *= 2
+    mask = slot_count - 1
+
+    slots = [0] * slot_count
+    entry_offsets = []
+    entries = bytearray()
+    entries_offset = section_offset + (slot_count * _UINT32.size
+                                       + len(section) * _UINT64.size)
+    for entry_number, (key, value) in enumerate(section.items()):
+        key_bytes = key.encode("utf-8")
+
+        slot = zlib.crc32(key_bytes) & mask
+        while slots[slot]:
+            slot = (slot + 1) & mask
+        slots[slot] = entry_number + 1
+
+        entry_offsets.append(entries_offset + len(entries))
+        entries += _UINT32.pack(len(key_bytes)) + key_bytes
+        entries += _encode_value(value)
+
+    encoded_section = bytearray(struct.pack("<%dI" % slot_count, *slots))
+    encoded_section += struct.pack("<%dQ" % len(entry_offsets), *entry_offsets)
+    encoded_section += entries
+    return encoded_section, slot_count
+
+
+def _encode_str(value):
+    value_bytes = value.encode("utf-8")
+    return _UINT32.pack(len(value_bytes)) + value_bytes
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        return _UINT8.pack(_STR_TAG) + _encode_str(value)
+    elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return (_UINT8.pack(_STR_LIST_TAG) + _UINT32.pack(len(value))
+                + b"".join(_encode_str(v) for v in value))
+    else:
+        return _UINT8.pack(_JSON_TAG) + _encode_str(json.dumps(value))
+
+
+def _decode_str(buffer, offset):
+    """Decode a string, and get the offset after it."""
+    length, = _UINT32.unpack_from(buffer, offset)
+    offset += _UINT32.size
+    return buffer[offset:offset + length].decode("utf-8"), offset + length
+
+
+def _decode_value(buffer, offset):
+    tag, = _UINT8.unpack_from(buffer, offset)
+    offset += _UINT8.size
+    if tag == _STR_TAG:
+        return _decode_str(buffer, offset)[0]
+    elif tag == _STR_LIST_TAG:
+        length, = _UINT32.unpack_from(buffer, offset)
+        offset += _UINT32.size
+        value = []
+        for _ in range(length):
+            item, offset = _decode_str(buffer, offset)
+            value.append(item)
+        return value
+    else:
+        return json.loads(_decode_str(buffer, offset)[0])
+
+
+def _dump_sqlite(lookup_table, path):
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript("""
+            CREATE TABLE sections (
+                name TEXT PRIMARY KEY, position INTEGER, entry_count INTEGER
+            );
+            CREATE TABLE entries (
+                section TEXT, position INTEGER, key TEXT, value TEXT,
+                PRIMARY KEY (section, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX entries_by_position ON entries (section, position);
+        """)
+        connection.execute("PRAGMA user_version = %d" % VERSION)
+        for section_position, (name, section) in enumerate(lookup_table.items()):
+            connection.execute("INSERT INTO sections VALUES (?, ?, ?)",
+                               (name, section_position, len(section)))
+            connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?)",
+                ((name, position, key, json.dumps(value))
+                 for position, (key, value) in enumerate(section.items())))
+        connection.commit()
+    finally:
+        connection.close()
@@ -7,16 +7,44 @@ Requires environmental variable ``PYTHONHASHSEED=0`` for tests to pass.
 
 import argparse
 import glob
+import io
 import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import pickle
 import shutil
+import subprocess
+import sys
 import tempfile
+import unicodedata
 import unittest
+from unittest import mock
+
+import dateutil.parser
+import nltk.tokenize
+import rdflib
 
 from lexmapr.definitions import ROOT
+import lexmapr.ontofetch as ontofetch
+import lexmapr.ontostream as ontostream
 import lexmapr.pipeline as pipeline
+import lexmapr.pipeline_classification as pipeline_classification
 import lexmapr.pipeline_resources as pipeline_resources
 import lexmapr.pipeline_helpers as pipeline_helpers
+import lexmapr.pipeline_stats as pipeline_stats
+import lexmapr.table_storage as table_storage
+import lexmapr.tokenizer as tokenizer
+
+
+# RDF/XML ontology, with the elements of its rdf:RDF element left out
+ONTOLOGY_TEMPLATE = """<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"
+         xmlns:owl="http://www.w3.org/2002/07/owl#">
+%s
+</rdf:RDF>
+"""
 
 
 class TestPipelineHelpers(unittest.TestCase):
@@ -46,6 +74,93 @@ class TestPipelineHelpers(unittest.TestCase):
         self.assertFalse(pipeline_helpers.is_date(""))
         # Non-empty string
         self.assertFalse(pipeline_helpers.is_date("foo"))
+        # Textual month and weekday
+        self.assertTrue(pipeline_helpers.is_date("March"))
+        self.assertTrue(pipeline_helpers.is_date("mon"))
+
+    def test_is_date_and_is_number_conformance(self):
+        """Tests is_date and is_number classify tokens like dateutil and
+        float do, for every token in the test corpora."""
+        def is_date(token):
+            try:
+                dateutil.parser.parse(token)
+                return True
+            except (ValueError, OverflowError):
+                return False
+
+        def is_number(token):
+            try:
+                float(token)
+                return True
+            except ValueError:
+                pass
+            try:
+                unicodedata.numeric(token)
+                return True
+            except (TypeError, ValueError):
+                return False
+
+        tokens = {"", "a", "Jan", "NaN", "inf", "1e5", "\u00bd", "\u0663", "12th", "3pm"}
+        for input_path in glob.glob(os.path.join(ROOT, "tests", "test_input", "*.[ct]sv")):
+            with open(input_path) as fp:
+                for line in fp:
+                    sample = pipeline_helpers.punctuation_treatment(line.lower())
+                    tokens.update(pipeline.word_tokenize(sample))
+                    tokens.update(line.split())
+
+        for token in sorted(tokens):
+            self.assertEqual(is_date(token), pipeline_helpers.is_date(token), token)
+            self.assertEqual(is_number(token), pipeline_helpers.is_number(token), token)
+
+    def test_word_tokenize(self):
+        """Tests word_tokenize."""
+        self.assertEqual(["chicken", "breast"], tokenizer.word_tokenize("chicken breast"))
+        # Final period
+        self.assertEqual(["e.coli", "0.5", "mg", "."], tokenizer.word_tokenize("e.coli 0.5 mg."))
+        # Symbols
+        self.assertEqual(["mac", "&", "cheese"], tokenizer.word_tokenize("mac&cheese"))
+        # Tokenized by nltk
+        self.assertEqual(["can", "not", "?"], tokenizer.word_tokenize("cannot?"))
+        with mock.patch("lexmapr.tokenizer.nltk_word_tokenize") as mock_nltk_word_tokenize:
+            tokenizer.word_tokenize("chicken breast.")
+            mock_nltk_word_tokenize.assert_not_called()
+            tokenizer.word_tokenize("\"chicken\" breast")
+            mock_nltk_word_tokenize.assert_called_once()
+
+    def test_is_plain_token(self):
+        """Tests is_plain_token."""
+        plain_tokens = ["chicken", "e.coli", "0.5", "a+b", "\u00e9"]
+        for token in plain_tokens:
+            self.assertTrue(tokenizer.is_plain_token(token), token)
+        for token in ["food.", ".5", "&", "mac&cheese", "cannot", "o'brien", ""]:
+            self.assertFalse(tokenizer.is_plain_token(token), token)
+        # Plain tokens joined by spaces are tokenized into themselves
+        self.assertEqual(plain_tokens, tokenizer.word_tokenize(" ".join(plain_tokens)))
+
+    def test_word_tokenize_conformance(self):
+        """Tests word_tokenize tokenizes the test corpora, and resource
+        labels, like nltk.word_tokenize."""
+        texts = []
+        for input_path in glob.glob(os.path.join(ROOT, "tests", "test_input", "*.[ct]sv")):
+            with open(input_path) as fp:
+                for line in fp:
+                    texts += [line, pipeline_helpers.punctuation_treatment(line.lower())]
+        lookup_table = pipeline_resources.get_predefined_resources()
+        texts += list(lookup_table["standard_resource_labels"])
+        texts += list(lookup_table["synonyms"])
+
+        for text in texts:
+            self.assertEqual(nltk.tokenize.word_tokenize(text), tokenizer.word_tokenize(text),
+                             text)
+
+    def test_detokenize(self):
+        """Tests detokenize joins tokens like nltk's Treebank
+        detokenizer."""
+        detokenizer = nltk.tokenize.treebank.TreebankWordDetokenizer()
+        for tokens in [["chicken", "breast"], ["{gallus", "gallus}"], ["", "e.coli", ""], [""],
+                       ["can", "not"], ["o'brien", "(raw)"], ["meat", "."], []]:
+            self.assertEqual(detokenizer.detokenize(tokens), tokenizer.detokenize(tokens),
+                             tokens)
 
     def test_ngrams(self):
         """Tests ngrams."""
@@ -108,14 +223,211 @@ class TestPipelineHelpers(unittest.TestCase):
         # "'", "," and "."
         self.assertEqual(pipeline_helpers.preprocess("cow's, . "), "cow,")
 
-    def test_get_resource_label_permutations(self):
-        self.assertCountEqual(pipeline_resources.get_resource_label_permutations(""), [""])
-        self.assertCountEqual(pipeline_resources.get_resource_label_permutations("a"), ["a"])
-        self.assertCountEqual(pipeline_resources.get_resource_label_permutations("a b"),
-                              ["a b", "b a"])
+    def test_normalize_phrases(self):
+        """Tests normalize_phrases."""
+        lookup_table = {
+            "spelling_mistakes": {"tako yaki": "takoyaki", "vt c": "vit c"},
+            "abbreviations": {"vit c": "vitamin c", "vit c tab": "vitamin c tablet", "f": "x"},
+            "non_english_words": {"aloo chole": "potato and chick peas"},
+        }
+        phrase_trie = pipeline_helpers.get_phrase_trie(lookup_table)
+        # Phrases are normalized anywhere in samples, longest first
+        micro_status = []
+        self.assertEqual("raw potato and chick peas with vitamin c tablet",
+                         pipeline_helpers.normalize_phrases("raw aloo chole with vit c tab",
+                                                            phrase_trie, micro_status))
+        self.assertEqual(["Non English Language Words Treatment: potato and chick peas",
+                          "Abbreviation-Acronym Treatment: vitamin c tablet"], micro_status)
+        # Phrases are normalized by each lexicon in turn
+        micro_status = []
+        self.assertEqual("vitamin c takoyaki", pipeline_helpers.normalize_phrases(
+            "vt c tako yaki", phrase_trie, micro_status))
+        self.assertEqual(["Spelling Correction Treatment: vit c",
+                          "Abbreviation-Acronym Treatment: vitamin c",
+                          "Spelling Correction Treatment: takoyaki"], micro_status)
+        # Single tokens and partial phrases are not normalized
+        micro_status = []
+        self.assertEqual("f vit aloo", pipeline_helpers.normalize_phrases(
+            "f vit aloo", phrase_trie, micro_status))
+        self.assertEqual([], micro_status)
+
+    def test_get_token_bag(self):
+        self.assertEqual(pipeline_helpers.get_token_bag(""), "")
+        self.assertEqual(pipeline_helpers.get_token_bag("a"), "a")
+        self.assertEqual(pipeline_helpers.get_token_bag("a b"), "a b")
+        self.assertEqual(pipeline_helpers.get_token_bag("b a"), "a b")
+        self.assertEqual(pipeline_helpers.get_token_bag("b a b"), "a b b")
+        self.assertNotEqual(pipeline_helpers.get_token_bag(" a b"), "a b")
+        self.assertNotEqual(pipeline_helpers.get_token_bag("b  a"), "a b")
+
+        self.assertEqual(pipeline_helpers.get_token_bag("a (b)"),
+                         pipeline_helpers.get_token_bag("(b) a"))
+
+    def test_map_term_permutations(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        lookup_table["non_standard_resource_ids"] = {"foo_1": "Fiat Object Part"}
+        lookup_table["standard_resource_labels"] = {"fiat object part": "foo_1"}
+        lookup_table["standard_resource_label_bags"] = {"fiat object part": "foo_1"}
+
+        self.assertEqual({"term": "Fiat Object Part", "id": "foo_1", "status": ["A Direct Match"]},
+                         pipeline_helpers.map_term("fiat object part", lookup_table))
+        for permutation in ["fiat part object", "object fiat part", "part object fiat"]:
+            self.assertEqual({"term": "Fiat Object Part", "id": "foo_1",
+                              "status": ["Permutation of Tokens in Resource Term"]},
+                             pipeline_helpers.map_term(permutation, lookup_table))
+        self.assertIsNone(pipeline_helpers.map_term("fiat object", lookup_table))
+
+    def test_map_term_synonym_permutations(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        lookup_table["non_standard_resource_ids"] = {"foo_1": "Fiat Object Part"}
+        lookup_table["standard_resource_labels"] = {"fiat object part": "foo_1"}
+        lookup_table["standard_resource_label_bags"] = {"fiat object part": "foo_1"}
+        lookup_table["synonyms"] = {"part of fiat": "fiat object part"}
+        lookup_table["synonym_bags"] = pipeline_resources.get_synonym_bags(
+            lookup_table["synonyms"])
+
+        for permutation in ["part of fiat", "fiat part of", "of fiat part"]:
+            self.assertEqual({"term": "Fiat Object Part", "id": "foo_1",
+                              "status": ["Synonym Usage", "A Direct Match"]},
+                             pipeline_helpers.map_term(permutation, lookup_table))
+        self.assertIsNone(pipeline_helpers.map_term("part of", lookup_table))
+
+        # Permuted synonyms are candidate gram chunks
+        lookup_table = pipeline_resources.add_token_index_to_lookup_table(lookup_table)
+        self.assertIn(("fiat", "part", "of"), pipeline_helpers.get_candidate_gram_chunks(
+            "fiat part of", lookup_table))
+
+    def test_get_candidate_gram_chunks(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        lookup_table["standard_resource_label_bags"] = {
+            "fiat object part": "foo_1", "chicken food product": "foo_2", "egg": "foo_3",
+            "food product": "foo_4"
+        }
+        lookup_table["non_standard_resource_ids"] = {
+            "foo_1": "fiat object part", "foo_2": "chicken food product", "foo_3": "egg",
+            "foo_4": "food product"
+        }
+        lookup_table["synonyms"] = {"hen": "chicken"}
+        lookup_table["synonym_bags"] = {"hen": "chicken"}
+        lookup_table["suffixes"] = {"food product": "", "product": ""}
+        lookup_table["label_bag_index"], lookup_table["synonym_bag_index"] =\
+            pipeline_helpers.get_token_index(lookup_table, lookup_table["suffixes"])
+
+        sample = "part of fiat hen egg object chicken"
+        all_gram_chunks = []
+        for i in range(5, 0, -1):
+            all_gram_chunks += pipeline_helpers.get_gram_chunks(sample, i)
+        mappable_gram_chunks = [
+            c for c in all_gram_chunks
+            if pipeline_helpers.map_term(" ".join(c), lookup_table)
+            or pipeline_helpers.map_term(" ".join(c), lookup_table, consider_suffixes=True)
+        ]
+        candidate_gram_chunks = pipeline_helpers.get_candidate_gram_chunks(sample, lookup_table)
+
+        self.assertEqual([("part", "fiat", "object"), ("hen",), ("egg",), ("chicken",)],
+                         candidate_gram_chunks)
+        self.assertEqual(mappable_gram_chunks, candidate_gram_chunks)
+
+    def test_add_ancestors_to_lookup_table(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        lookup_table["parents"] = {"foo_1": ["foo_2", "foo_3"], "foo_2": ["foo_4"],
+                                   "foo_3": ["foo_4"]}
+        lookup_table = pipeline_resources.add_ancestors_to_lookup_table(lookup_table)
+
+        self.assertEqual(["foo_2", "foo_4", "foo_3"], lookup_table["ancestors"]["foo_1"])
+        self.assertEqual(["foo_4"], pipeline_helpers.get_term_ancestors("foo_2", lookup_table))
+        self.assertEqual([], pipeline_helpers.get_term_ancestors("foo_4", lookup_table))
+
+        hierarchies = pipeline_helpers.get_term_parent_hierarchies("foo_1", lookup_table)
+        self.assertEqual([["foo_4", "b", 3], ["foo_3", "c", 2]],
+                         pipeline_classification.get_nearest_buckets(
+                             hierarchies, {"foo_4": "b", "foo_3": "c"}))
+
+    def test_add_ancestors_to_lookup_table_in_chunks(self):
+        parents = {"foo_1": ["foo_2", "foo_3"], "foo_2": ["foo_4"], "foo_3": ["foo_4"],
+                   "foo_5": ["bfo_0000001"], "foo_4": ["foo_5"]}
+        lookup_tables = []
+        for chunk_size in [len(parents), 2]:
+            lookup_table = pipeline_resources.create_lookup_table_skeleton()
+            lookup_table["parents"] = parents
+            with mock.patch.object(pipeline_resources, "ANCESTORS_CHUNK_SIZE", chunk_size),\
+                    mock.patch("os.cpu_count", return_value=2):
+                lookup_tables.append(
+                    pipeline_resources.add_ancestors_to_lookup_table(lookup_table))
+
+        for key in ["ancestors", "nearest_buckets_lexmapr", "nearest_buckets_ifsactop"]:
+            self.assertEqual(list(lookup_tables[0][key].items()),
+                             list(lookup_tables[1][key].items()))
+
+    def test_upgrade_lookup_table_nearest_buckets(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        lookup_table["parents"] = {"foo_1": ["foo_2"], "foo_2": ["foo_3"]}
+
+        classification_lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        classification_lookup_table["buckets_lexmapr"] = {"b": "foo_3"}
+        get_current_buckets_hashes = pipeline_resources.get_current_buckets_hashes
+        get_current_buckets_hashes.cache_clear()
+        self.addCleanup(get_current_buckets_hashes.cache_clear)
+        with mock.patch.object(pipeline_resources, "load_classification_lookup_table",
+                               return_value=classification_lookup_table) as mock_load,\
+                mock.patch.object(pipeline_resources, "get_classification_resources",
+                                  side_effect=AssertionError):
+            lookup_table = pipeline_resources.add_ancestors_to_lookup_table(lookup_table)
+            self.assertEqual([["foo_3", "b", 3]], lookup_table["nearest_buckets_lexmapr"]["foo_1"])
+            self.assertFalse(pipeline_resources.is_outdated_lookup_table(lookup_table))
+
+            # Buckets are hashed once per process
+            self.assertFalse(pipeline_resources.is_outdated_lookup_table(lookup_table))
+            self.assertEqual(2, mock_load.call_count)
+
+            # Nearest buckets are found again when buckets change
+            classification_lookup_table["buckets_lexmapr"] = {"b": "foo_3", "c": "foo_2"}
+            get_current_buckets_hashes.cache_clear()
+            self.assertTrue(pipeline_resources.is_outdated_lookup_table(lookup_table))
+            lookup_table = pipeline_resources.upgrade_lookup_table(lookup_table)
+            self.assertFalse(pipeline_resources.is_outdated_lookup_table(lookup_table))
+            self.assertEqual([["foo_2", "c", 2]],
+                             lookup_table["nearest_buckets_lexmapr"]["foo_1"])
+
+    def test_get_default_classification(self):
+        default_bucket_tokens, default_bucket_index =\
+            pipeline_classification.get_default_bucket_tokens(
+                {"": "any", "eggs": "egg", "raw chickens": "chicken"})
+        classification_lookup_table = {"ifsac_default_tokens": default_bucket_tokens,
+                                       "ifsac_default_index": default_bucket_index}
+
+        for sample, expected_label in [("chicken raw", "chicken"), ("raw egg", "egg"),
+                                       ("chicken", "any"), ("", "any")]:
+            self.assertEqual(expected_label, pipeline_classification.get_default_classification(
+                sample, classification_lookup_table))
+
+    def test_get_refined_label(self):
+        refinement_rules, refinement_index, refinement_pattern =\
+            pipeline_classification.get_refinement_rules(
+                {"raw egg": "eggs", "fish (cod)": "fish", "salmon": "other fish",
+                 "chicken": "poultry"})
+        classification_lookup_table = {"ifsac_refinement_rules": refinement_rules,
+                                       "ifsac_refinement_index": refinement_index,
+                                       "ifsac_refinement_pattern": refinement_pattern}
+
+        for sample, expected_label in [("egg raw chicken", "eggs"), ("chicken fish cod", "fish"),
+                                       ("salmon chicken", "other fish"), ("beef", None)]:
+            self.assertEqual(expected_label, pipeline_classification.get_refined_label(
+                sample, set(sample.split(" ")), classification_lookup_table))
+
+    def test_upgrade_lookup_table(self):
+        lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        del lookup_table["standard_resource_label_bags"]
+        lookup_table["standard_resource_labels"] = {"object aggregate": "bfo_0000027"}
+        lookup_table["standard_resource_label_permutations"] = {
+            "object aggregate": "bfo_0000027", "aggregate object": "bfo_0000027"
+        }
+        self.assertTrue(pipeline_resources.is_outdated_lookup_table(lookup_table))
 
-        self.assertCountEqual(pipeline_resources.get_resource_label_permutations("a (b)"),
-                              ["a (b)", "(b) a"])
+        lookup_table = pipeline_resources.upgrade_lookup_table(lookup_table)
+        self.assertFalse(pipeline_resources.is_outdated_lookup_table(lookup_table))
+        self.assertDictEqual({"aggregate object": "bfo_0000027"},
+                             lookup_table["standard_resource_label_bags"])
 
     def test_punctuationTreatment(self):
         """Tests punctuationTreatment."""
@@ -480,6 +792,248 @@ class TestPipeline(unittest.TestCase):
                 print(failure)
             raise AssertionError
 
+    def test_pipeline_with_jobs(self):
+        """Compares parallel pipeline.run outputs to expected outputs."""
+        for expected_output_filename in ["small_simple", "test_candidate_phrase"]:
+            expected_output_path = os.path.join(ROOT, "tests", "test_output",
+                                                expected_output_filename + ".tsv")
+            actual_output_path = os.path.join(self.tmp_dir, "actual_parallel_output.tsv")
+            pipeline.run(argparse.Namespace(input_file=self.test_files[expected_output_filename]
+                                            ["input"], config=None, full=True,
+                                            output=actual_output_path, version=False,
+                                            bucket=False, no_cache=False, profile=None, jobs=3))
+            with open(actual_output_path, "r") as actual_output_file:
+                actual_output_contents = actual_output_file.read()
+            with open(expected_output_path, "r") as expected_output_file:
+                expected_output_contents = expected_output_file.read()
+            self.assertMultiLineEqual(expected_output_contents, actual_output_contents)
+
+    def test_pipeline_with_jobs_failure(self):
+        """Tests parallel pipeline.run stops its worker processes if
+        mapping fails."""
+        # Pools are kept, so they are not stopped when garbage collected
+        pools = []
+
+        def get_worker_pool(jobs, mapper):
+            pools.append(multiprocessing.pool.Pool(jobs, pipeline.init_worker, (mapper,)))
+            return pools[-1]
+
+        with mock.patch.object(pipeline.Mapper, "map_sample", side_effect=RuntimeError), \
+                mock.patch.object(pipeline, "get_worker_pool", get_worker_pool):
+            with self.assertRaises(RuntimeError):
+                pipeline.run(argparse.Namespace(
+                    input_file=self.test_files["small_simple"]["input"], config=None,
+                    full=True, output=os.path.join(self.tmp_dir, "actual_output.tsv"),
+                    version=False, bucket=False, no_cache=False, profile=None, jobs=2,
+                    slow_log=os.path.join(self.tmp_dir, "slow_samples.jsonl")))
+        self.assertEqual([], multiprocessing.active_children())
+
+    def test_import_pipeline(self):
+        """Tests importing pipeline does not import dependencies only
+        some samples and configs use."""
+        code = ("import sys; sys.path.insert(0, %r); import lexmapr.pipeline; "
+                "print(' '.join(sorted(sys.modules)))" % os.path.dirname(ROOT))
+        # Isolated, so modules imported by site customizations are not
+        # counted
+        modules = subprocess.check_output([sys.executable, "-I", "-c", code],
+                                          universal_newlines=True).split()
+        for module in ["nltk", "rdflib", "lexmapr.ontofetch", "lexmapr.ontostream"]:
+            self.assertNotIn(module, modules)
+
+
+class TestMapper(unittest.TestCase):
+    """Tests in-process mapping with pipeline.Mapper."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mapper = pipeline.Mapper()
+
+    def test_map_sample(self):
+        sample_mapping = self.mapper.map_sample("Frozen Yogurt")
+        self.assertEqual("frozen yogurt", sample_mapping["cleaned_sample"])
+        self.assertEqual(["frozen:PATO_0001985"], sample_mapping["matched_components"])
+        self.assertEqual("Component Match", sample_mapping["macro_status"])
+        self.assertEqual(["{frozen: ['A Direct Match']}"], sample_mapping["micro_status"])
+
+    def test_map_samples(self):
+        samples = ["Chicken Breast", "Baked Potato", "Frozen Yogurt"]
+        expected_sample_mappings = [self.mapper.map_sample(sample) for sample in samples]
+        self.assertEqual(expected_sample_mappings, list(self.mapper.map_samples(samples)))
+        self.assertEqual([], list(self.mapper.map_samples([])))
+
+    def test_map_sample_tokenizer(self):
+        nltk_mapper = pipeline.Mapper(tokenizer="nltk")
+        self.assertRaises(ValueError, pipeline.Mapper, tokenizer="spacy")
+        with mock.patch.object(tokenizer, "nltk_word_tokenize",
+                               wraps=tokenizer.nltk_word_tokenize) as nltk_word_tokenize:
+            sample_mapping = nltk_mapper.map_sample("Frozen Yogurt")
+            self.assertTrue(nltk_word_tokenize.called)
+            nltk_word_tokenize.reset_mock()
+            # Mappers do not change the tokenizer of other mappers
+            self.assertEqual(sample_mapping, self.mapper.map_sample("Frozen Yogurt"))
+            nltk_word_tokenize.assert_not_called()
+
+    def test_map_sample_without_iterating_bags(self):
+        iterated_sections = []
+
+        def record_iteration(iter_method):
+            def __iter__(section):
+                iterated_sections.append(section.name)
+                return iter_method(section)
+            return __iter__
+
+        for storage in table_storage.STORAGE_EXTENSIONS:
+            # Compile the predefined lookup table first
+            pipeline.Mapper(storage=storage)
+            iterated_sections.clear()
+            with mock.patch.object(table_storage.LookupTableSection, "__iter__",
+                                   record_iteration(table_storage.LookupTableSection.__iter__)), \
+                    mock.patch.object(table_storage.SQLiteLookupTableSection, "__iter__",
+                                      record_iteration(
+                                          table_storage.SQLiteLookupTableSection.__iter__)):
+                mapper = pipeline.Mapper(storage=storage)
+                self.assertEqual(self.mapper.map_sample("Chicken Breast"),
+                                 mapper.map_sample("Chicken Breast"))
+            for section_name in ["standard_resource_labels", "standard_resource_label_bags",
+                                 "synonyms", "synonym_bags", "label_bag_index",
+                                 "synonym_bag_index"]:
+                self.assertNotIn(section_name, iterated_sections, storage)
+
+    def test_map_sample_stats(self):
+        stats = pipeline_stats.MappingStats()
+        mapper = pipeline.Mapper(stats=stats)
+        samples = ["Chicken Breast", "Frozen Yogurt"]
+        self.assertEqual([self.mapper.map_sample(sample) for sample in samples],
+                         list(mapper.map_samples(samples)))
+
+        stats_dict = stats.pop()
+        self.assertEqual(pipeline_stats.STAGES, list(stats_dict["timings"]))
+        self.assertEqual({"samples": 2, "tokens": 4, "map_term_probes": 10, "gram_chunks": 2,
+                          "gram_chunks_skipped": 0, "hierarchy_paths": 0},
+                         stats_dict["counters"])
+        self.assertEqual(0, stats.pop()["counters"]["samples"])
+
+    def test_write_slow_sample(self):
+        stats = pipeline_stats.MappingStats()
+        mapper = pipeline.Mapper(stats=stats)
+        mapper.map_sample("Chicken Breast")
+        sample_stats = stats.pop()
+        sample_stats.update({"sample_id": "small_simple1", "sample": "Chicken Breast"})
+
+        fp = io.StringIO()
+        self.assertFalse(pipeline_stats.write_slow_sample(fp, sample_stats, 60))
+        self.assertTrue(pipeline_stats.write_slow_sample(fp, sample_stats, 1e-9))
+        [record] = [json.loads(line) for line in fp.getvalue().splitlines()]
+        self.assertEqual(("small_simple1", "Chicken Breast", 2, 1, 5),
+                         (record["sample_id"], record["sample"], record["tokens"],
+                          record["gram_chunks"], record["map_term_probes"]))
+        self.assertNotIn("setup", record["timings"])
+
+    def test_map_samples_matches_run_output(self):
+        input_path = os.path.join(ROOT, "tests", "test_input", "small_simple.csv")
+        expected_output_path = os.path.join(ROOT, "tests", "test_output", "small_simple.tsv")
+
+        with open(input_path) as fp:
+            rows = [line.strip().split(",", 1) for line in fp.readlines()[1:]]
+        with open(expected_output_path) as fp:
+            expected_rows = fp.read().splitlines()[1:]
+
+        sample_mappings = self.mapper.map_samples([sample for _, sample in rows])
+        actual_rows = [pipeline.get_output_row(sample_id, sample_mapping, True, False)
+                       for (sample_id, _), sample_mapping in zip(rows, sample_mappings)]
+        self.assertEqual(expected_rows, actual_rows)
+
+
+class TestTableStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.compiled_path = os.path.join(self.tmp_dir, "lookup_table.lxt")
+
+        self.lookup_table = pipeline_resources.create_lookup_table_skeleton()
+        self.lookup_table["non_standard_resource_ids"] = {"foo_2": "b\u00e9b\u00e9", "foo_1": "a"}
+        self.lookup_table["parents"] = {"foo_2": ["foo_1", "foo_3"], "foo_1": []}
+        self.lookup_table["suffixes"] = {"food product": "", "product": ""}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dump_and_load(self):
+        for storage in table_storage.STORAGE_EXTENSIONS:
+            compiled_path = os.path.join(self.tmp_dir, "lookup_table_" + storage)
+            table_storage.dump(self.lookup_table, compiled_path, storage)
+            compiled_lookup_table = table_storage.load(compiled_path, storage)
+
+            self.assertEqual(list(self.lookup_table), list(compiled_lookup_table))
+            for key, section in self.lookup_table.items():
+                self.assertEqual(list(section.items()), list(compiled_lookup_table[key].items()))
+
+            compiled_parents = compiled_lookup_table["parents"]
+            self.assertIn("foo_2", compiled_parents)
+            self.assertNotIn("foo_3", compiled_parents)
+            self.assertNotIn(None, compiled_parents)
+            self.assertRaises(KeyError, compiled_parents.__getitem__, "foo_3")
+            self.assertEqual(2, len(compiled_parents))
+
+            self.assertEqual(["foo_1", "foo_3"],
+                             pickle.loads(pickle.dumps(compiled_parents))["foo_2"])
+
+    def test_load_invalid_file(self):
+        table_storage.dump(self.lookup_table, self.compiled_path)
+        with open(self.compiled_path, "r+b") as fp:
+            fp.seek(-1, os.SEEK_END)
+            fp.write(b"\xff")
+        self.assertRaises(table_storage.LookupTableFileError, table_storage.LookupTableFile,
+                          self.compiled_path, verify=True)
+
+        with open(self.compiled_path, "wb") as fp:
+            fp.write(b"{}")
+        self.assertRaises(table_storage.LookupTableFileError, table_storage.load,
+                          self.compiled_path)
+        self.assertRaises(table_storage.LookupTableFileError, table_storage.load,
+                          self.compiled_path, "sqlite")
+
+    def test_verify_once(self):
+        with mock.patch.object(table_storage.zlib, "crc32",
+                               wraps=table_storage.zlib.crc32) as crc32:
+            # Memory-mapped files are verified, not hashed keys
+            def get_verification_count():
+                return sum(isinstance(call.args[0], memoryview)
+                           for call in crc32.call_args_list)
+
+            table_storage.dump(self.lookup_table, self.compiled_path)
+            self.assertEqual(1, get_verification_count())
+
+            compiled_parents = table_storage.load(self.compiled_path)["parents"]
+            self.assertEqual(["foo_1", "foo_3"],
+                             pickle.loads(pickle.dumps(compiled_parents))["foo_2"])
+            self.assertEqual(1, get_verification_count())
+
+        with mock.patch.object(table_storage, "_dump_compiled") as dump_compiled:
+            dump_compiled.side_effect = lambda _, path: shutil.copy(self.compiled_path, path)
+            with open(self.compiled_path, "r+b") as fp:
+                fp.seek(-1, os.SEEK_END)
+                fp.write(b"\xff")
+            compiled_path = os.path.join(self.tmp_dir, "corrupted_lookup_table.lxt")
+            self.assertRaises(table_storage.LookupTableFileError, table_storage.dump,
+                              self.lookup_table, compiled_path)
+            self.assertEqual([], glob.glob(compiled_path + "*"))
+
+    def test_load_lookup_table(self):
+        lookup_table_path = os.path.join(self.tmp_dir, "lookup_table.json")
+        with open(lookup_table_path, "w") as fp:
+            json.dump(self.lookup_table, fp)
+
+        lookup_table = pipeline_resources.load_lookup_table(lookup_table_path)
+        self.assertTrue(os.path.exists(self.compiled_path))
+        self.assertIsInstance(lookup_table["suffixes"], table_storage.LookupTableSection)
+
+        merged_lookup_table = pipeline_helpers.merge_lookup_tables(
+            lookup_table, {k: {} for k in lookup_table} | {"suffixes": {"egg": "", "product": ""}}
+        )
+        self.assertEqual(["food product", "product", "egg"],
+                         list(merged_lookup_table["suffixes"]))
+
 
 class TestOntologyMapping(unittest.TestCase):
     """Test fetching and use of resources from online ontologies."""
@@ -568,6 +1122,183 @@ class TestOntologyMapping(unittest.TestCase):
         bfo_process_fetched_ontology = self.get_fetched_ontology("bfo.json")
         self.assertEqual(3, len(bfo_process_fetched_ontology["specifications"]))
 
+    def test_fetch_ontology_listed_twice(self):
+        self.run_pipeline_with_args(config_file_name="bfo_process_and_material_entity.json")
+        # The first entry in the config file is kept
+        bfo_process_fetched_ontology = self.get_fetched_ontology("bfo.json")
+        self.assertEqual(3, len(bfo_process_fetched_ontology["specifications"]))
+
+        fetched_ontologies_dir_path = os.path.join(ROOT, "resources", "fetched_ontologies")
+        self.assertFalse([file_name for file_name in os.listdir(fetched_ontologies_dir_path)
+                          if os.path.isdir(os.path.join(fetched_ontologies_dir_path, file_name))])
+
+    def test_fetch_ontology_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache_dir_path = os.path.join(tmp_dir, "cache")
+        os.mkdir(cache_dir_path)
+        bfo_path = os.path.join(ROOT, "tests", "test_ontologies", "bfo.owl")
+        bfo_process_iri = "http://purl.obolibrary.org/obo/BFO_0000015"
+
+        for output_dir_name in ["first", "second"]:
+            output_dir_path = os.path.join(tmp_dir, output_dir_name)
+            os.mkdir(output_dir_path)
+            with mock.patch.object(ontofetch, "Ontology", wraps=ontofetch.Ontology) as ontology:
+                fetched_ontology_path, _ = pipeline_resources.fetch_ontology(
+                    bfo_path, bfo_process_iri, output_dir_path, cache_dir_path)
+            # Ontology is only parsed the first time
+            self.assertEqual(output_dir_name == "first", ontology.called)
+            with open(fetched_ontology_path) as fp:
+                self.assertEqual(3, len(json.load(fp)["specifications"]))
+
+        # Different roots are cached separately
+        output_dir_path = os.path.join(tmp_dir, "third")
+        os.mkdir(output_dir_path)
+        fetched_ontology_path, _ =\
+            pipeline_resources.fetch_ontology(bfo_path, "", output_dir_path, cache_dir_path)
+        with open(fetched_ontology_path) as fp:
+            self.assertEqual(36, len(json.load(fp)["specifications"]))
+
+    def test_fetch_ontology_online(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache_dir_path = os.path.join(tmp_dir, "cache")
+        os.mkdir(cache_dir_path)
+        bfo_path = os.path.join(ROOT, "tests", "test_ontologies", "bfo.owl")
+        bfo_url = "http://purl.obolibrary.org/obo/bfo.owl"
+        bfo_process_iri = "http://purl.obolibrary.org/obo/BFO_0000015"
+        with open(bfo_path, "rb") as fp:
+            bfo_bytes = fp.read()
+
+        def urlopen(url):
+            response = mock.MagicMock()
+            response.__enter__.return_value = response
+            response.read = io.BytesIO(bfo_bytes).read
+            response.geturl.return_value = url
+            return response
+
+        for output_dir_name in ["first", "second"]:
+            output_dir_path = os.path.join(tmp_dir, output_dir_name)
+            os.mkdir(output_dir_path)
+            with mock.patch("urllib.request.urlopen", side_effect=urlopen) as url_opener,\
+                    mock.patch.object(ontofetch, "Ontology", wraps=ontofetch.Ontology) as ontology:
+                fetched_ontology_path, ontology_hash = pipeline_resources.fetch_ontology(
+                    bfo_url, bfo_process_iri, output_dir_path, cache_dir_path)
+            # Ontology is downloaded once per fetch, and the downloaded
+            # file is hashed and parsed.
+            self.assertEqual(1, url_opener.call_count)
+            self.assertEqual(output_dir_name == "first", ontology.called)
+            self.assertEqual(
+                pipeline_resources.get_ontology_hash(bfo_path, bfo_process_iri), ontology_hash)
+            self.assertEqual(["bfo.json", "bfo.tsv"], sorted(os.listdir(output_dir_path)))
+            with open(fetched_ontology_path) as fp:
+                self.assertEqual(3, len(json.load(fp)["specifications"]))
+
+    def test_fetch_ontology_with_imports(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache_dir_path = os.path.join(tmp_dir, "cache")
+        os.mkdir(cache_dir_path)
+        os.mkdir(os.path.join(tmp_dir, "imports"))
+        ontology_path = os.path.join(tmp_dir, "main.owl")
+        with open(ontology_path, "w") as fp:
+            fp.write(ONTOLOGY_TEMPLATE % (
+                '<owl:Ontology rdf:about="http://example.org/main.owl">'
+                '<owl:imports rdf:resource="http://example.org/imported.owl"/></owl:Ontology>'
+                '<owl:Class rdf:about="http://example.org/A"><rdfs:label>a</rdfs:label>'
+                '</owl:Class>'))
+
+        for engine in ["graph", "stream"]:
+            for label in ["b", "c"]:
+                # Imported ontology changes, but not the ontology file
+                with open(os.path.join(tmp_dir, "imports", "imported.owl"), "w") as fp:
+                    fp.write(ONTOLOGY_TEMPLATE % (
+                        '<owl:Class rdf:about="http://example.org/B"><rdfs:label>%s</rdfs:label>'
+                        '<rdfs:subClassOf rdf:resource="http://example.org/A"/></owl:Class>'
+                        % label))
+                output_dir_path = os.path.join(tmp_dir, engine + label)
+                os.mkdir(output_dir_path)
+                fetched_ontology_path, ontology_hash = pipeline_resources.fetch_ontology(
+                    ontology_path, "http://example.org/A", output_dir_path, cache_dir_path,
+                    engine)
+
+                self.assertIsNone(ontology_hash)
+                self.assertEqual([], os.listdir(cache_dir_path))
+                with open(fetched_ontology_path) as fp:
+                    specifications = json.load(fp)["specifications"]
+                self.assertEqual(label, specifications["example.org:B"]["label"])
+
+    def test_fetch_ontology_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        pizza_path = os.path.join(ROOT, "tests", "test_ontologies", "pizza.owl")
+        pizza_iri = "http://www.co-ode.org/ontologies/pizza/pizza.owl#Pizza"
+
+        fetched_ontologies = {}
+        for engine in ["graph", "stream"]:
+            output_dir_path = os.path.join(tmp_dir, engine)
+            os.mkdir(output_dir_path)
+            fetched_ontology_path, _ = pipeline_resources.fetch_ontology(
+                pizza_path, pizza_iri, output_dir_path, engine=engine)
+            with open(fetched_ontology_path) as fp:
+                fetched_ontologies[engine] = json.load(fp)
+
+        self.assertEqual(fetched_ontologies["graph"], fetched_ontologies["stream"])
+
+    def test_iter_triples_relative_type(self):
+        base = "http://example.org/ontology.owl"
+        ontology = ONTOLOGY_TEMPLATE % (
+            '<rdf:Description rdf:about="#a" rdf:type="#A">'
+            '<rdfs:seeAlso rdf:type="#B" rdfs:label="b"/></rdf:Description>')
+        # Property attributes describe a node element, but rdflib only
+        # resolves a relative ``rdf:type`` in node elements
+        node_element_ontology = ONTOLOGY_TEMPLATE % (
+            '<rdf:Description rdf:about="#a" rdf:type="#A"><rdfs:seeAlso>'
+            '<rdf:Description rdf:type="#B" rdfs:label="b"/></rdfs:seeAlso></rdf:Description>')
+        graph = rdflib.Graph()
+        graph.parse(data=node_element_ontology, format="xml", publicID=base)
+
+        def normalize_triple(triple):
+            # Blank nodes differ between parses
+            return tuple(None if isinstance(t, rdflib.BNode) else
+                         t if isinstance(t, rdflib.Literal) else str(t) for t in triple)
+
+        stream_triples = [normalize_triple(triple) for triple in
+                          ontostream.iter_triples(io.BytesIO(ontology.encode("utf-8")), base)]
+        self.assertCountEqual([normalize_triple(triple) for triple in graph], stream_triples)
+        self.assertIn((None, str(rdflib.RDF.type), base + "#B"), stream_triples)
+
+    def test_lookup_table_fragment(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        cache_dir_path = os.path.join(tmp_dir, "cache")
+        fragments_dir_path = os.path.join(tmp_dir, "fragments")
+        os.mkdir(cache_dir_path)
+        os.mkdir(fragments_dir_path)
+        bfo_path = os.path.join(ROOT, "tests", "test_ontologies", "bfo.owl")
+        bfo_process_iri = "http://purl.obolibrary.org/obo/BFO_0000015"
+
+        for output_dir_name in ["first", "second"]:
+            output_dir_path = os.path.join(tmp_dir, output_dir_name)
+            os.mkdir(output_dir_path)
+            with mock.patch.object(
+                    pipeline_resources, "add_fetched_ontology_to_lookup_table",
+                    wraps=pipeline_resources.add_fetched_ontology_to_lookup_table) as add:
+                fetched_ontology_path, fragment_path =\
+                    pipeline_resources.get_lookup_table_fragment(
+                        bfo_path, bfo_process_iri, output_dir_path, cache_dir_path,
+                        fragments_dir_path)
+            # Fragment is only created the first time
+            self.assertEqual(output_dir_name == "first", add.called)
+
+        with open(fetched_ontology_path) as fp:
+            expected = pipeline_resources.add_fetched_ontology_to_lookup_table(
+                pipeline_resources.create_lookup_table_skeleton(), json.load(fp))
+        with open(fragment_path) as fp:
+            actual = pipeline_resources.add_fragment_to_lookup_table(
+                pipeline_resources.create_lookup_table_skeleton(), json.load(fp))
+        self.assertDictEqual(expected, actual)
+
     def test_ontology_table_creation(self):
         self.assertFalse(os.path.exists(os.path.join(
             ROOT, "resources", "ontology_lookup_tables","lookup_bfo.json")
@@ -591,9 +1322,11 @@ class TestOntologyMapping(unittest.TestCase):
         ontology_lookup_table = self.get_ontology_lookup_table("lookup_bfo.json")
 
         expected_keys = ["non_standard_resource_ids", "standard_resource_labels",
-                         "standard_resource_label_permutations", "synonyms", "abbreviations",
-                         "non_english_words", "spelling_mistakes", "inflection_exceptions",
-                         "stop_words", "suffixes", "parents", "buckets_ifsactop",
+                         "standard_resource_label_bags", "synonyms", "synonym_bags",
+                         "label_bag_index", "synonym_bag_index", "abbreviations", "non_english_words", "spelling_mistakes",
+                         "inflection_exceptions", "stop_words", "suffixes", "parents", "ancestors",
+                         "nearest_buckets_lexmapr", "nearest_buckets_ifsactop", "buckets_hashes",
+                         "buckets_ifsactop",
                          "buckets_lexmapr", "ifsac_labels", "ifsac_refinement", "ifsac_default"]
 
         self.assertCountEqual(expected_keys, ontology_lookup_table.keys())
@@ -603,9 +1336,11 @@ class TestOntologyMapping(unittest.TestCase):
         ontology_lookup_table = self.get_ontology_lookup_table("lookup_bfo_and_pizza.json")
 
         expected_keys = ["non_standard_resource_ids", "standard_resource_labels",
-                         "standard_resource_label_permutations", "synonyms", "abbreviations",
-                         "non_english_words", "spelling_mistakes", "inflection_exceptions",
-                         "stop_words", "suffixes", "parents", "buckets_ifsactop",
+                         "standard_resource_label_bags", "synonyms", "synonym_bags",
+                         "label_bag_index", "synonym_bag_index", "abbreviations", "non_english_words", "spelling_mistakes",
+                         "inflection_exceptions", "stop_words", "suffixes", "parents", "ancestors",
+                         "nearest_buckets_lexmapr", "nearest_buckets_ifsactop", "buckets_hashes",
+                         "buckets_ifsactop",
                          "buckets_lexmapr", "ifsac_labels", "ifsac_refinement", "ifsac_default"]
 
         self.assertCountEqual(expected_keys, ontology_lookup_table.keys())
@@ -884,25 +1619,17 @@ class TestOntologyMapping(unittest.TestCase):
 
         self.assertDictEqual(sorted_expected_parents, sorted_actual_parents)
 
-    def test_ontology_table_resource_label_permutations(self):
+    def test_ontology_table_resource_label_bags(self):
         self.run_pipeline_with_args(config_file_name="bfo_material_entity.json")
         ontology_lookup_table = self.get_ontology_lookup_table("lookup_bfo_material_entity.json")
 
-        expected_resource_label_permutations = {
-           "fiat object part": "bfo_0000024",
-            "fiat part object": "bfo_0000024",
-            "object fiat part": "bfo_0000024",
-            "object part fiat": "bfo_0000024",
-            "part fiat object": "bfo_0000024",
-            "part object fiat": "bfo_0000024",
-            "object aggregate": "bfo_0000027",
+        expected_resource_label_bags = {
+            "fiat object part": "bfo_0000024",
             "aggregate object": "bfo_0000027",
             "object": "bfo_0000030"
         }
-        actual_resource_label_permutations =\
-            ontology_lookup_table["standard_resource_label_permutations"]
-        self.assertDictEqual(expected_resource_label_permutations,
-                             actual_resource_label_permutations)
+        actual_resource_label_bags = ontology_lookup_table["standard_resource_label_bags"]
+        self.assertDictEqual(expected_resource_label_bags, actual_resource_label_bags)
 
     def test_ontology_table_resource_labels_prioritisation_pizza_first(self):
         config_file_name = "pizza_spiciness_and_pizza_two_spiciness.json"
@@ -974,13 +1701,24 @@ class TestClassification(unittest.TestCase):
         classification_table = self.get_classification_lookup_table()
 
         expected_keys = ["non_standard_resource_ids", "standard_resource_labels",
-                         "standard_resource_label_permutations", "synonyms", "abbreviations",
-                         "non_english_words", "spelling_mistakes", "inflection_exceptions",
-                         "stop_words", "suffixes", "parents", "buckets_ifsactop",
+                         "standard_resource_label_bags", "synonyms", "synonym_bags",
+                         "label_bag_index", "synonym_bag_index", "abbreviations", "non_english_words", "spelling_mistakes",
+                         "inflection_exceptions", "stop_words", "suffixes", "parents", "ancestors",
+                         "nearest_buckets_lexmapr", "nearest_buckets_ifsactop", "buckets_hashes",
+                         "buckets_ifsactop",
                          "buckets_lexmapr", "ifsac_labels", "ifsac_refinement", "ifsac_default"]
 
         self.assertCountEqual(expected_keys, classification_table.keys())
 
+    def test_classification_table_bucket_labels(self):
+        classification_table = pipeline_resources.get_classification_resources()
+
+        for bucket_label, bucket_id in classification_table["buckets_lexmapr"].items():
+            self.assertEqual(bucket_label,
+                             classification_table["bucket_labels_lexmapr"][bucket_id])
+        self.assertCountEqual(set(classification_table["buckets_ifsactop"].values()),
+                              classification_table["bucket_labels_ifsactop"].keys())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+"""Tokenize text like ``nltk.word_tokenize``, with a single regex.
+
+``nltk.word_tokenize`` splits text into sentences with Punkt, and then
+applies the ~30 regex substitutions of the Treebank tokenizer to each
+sentence. On the lowercase, punctuation-treated text lexmapr tokenizes,
+almost none of these substitutions apply, so the same tokens are found
+by ``TOKEN_REGEX`` alone. Text that some other substitution, or a Punkt
+sentence break, could apply to is tokenized by NLTK instead.
+
+Likewise, ``detokenize`` joins plain tokens without the Treebank
+detokenizer. NLTK is slow to import, so it is only imported once text
+needs it.
+"""
+
+import re
+
+# Names of tokenizers ``word_tokenize`` and ``detokenize`` can use:
+# ``lexmapr`` to tokenize with ``TOKEN_REGEX`` where possible, or
+# ``nltk`` to always use NLTK
+TOKENIZERS = ["lexmapr", "nltk"]
+
+# Characters the Treebank tokenizer always makes tokens of
+SYMBOLS = "&*#$%"
+
+# Tokens of text that ``UNSUPPORTED_REGEX`` does not match: symbols,
+# a final period, and runs of other non-whitespace characters.
+TOKEN_REGEX = re.compile(r"[%s]|(?:[^\s%s.]+|\.(?!\s*$))+|\." % (SYMBOLS, SYMBOLS))
+
+# Text ``TOKEN_REGEX`` does not tokenize like ``nltk.word_tokenize``:
+#
+# * characters with substitutions of their own, like quotes, brackets,
+#   ``?``, ``!`` and ``,``, and double dashes
+# * periods that may end a sentence before the end of the text, and
+#   ellipses
+UNSUPPORTED_REGEX = re.compile(r"[^\w\s.+=^~|/\-%s]|--|\.(?:\.|\*|\s+\S)" % SYMBOLS)
+
+# Words the Treebank tokenizer splits in two. Text containing them,
+# even within other words, is tokenized by NLTK, as substrings are
+# faster to check for than whole words.
+SPLIT_WORDS = ["cannot", "gimme", "gonna", "gotta", "lemme", "wanna"]
+
+# Tokens that are tokenized as themselves wherever they are in text,
+# except for ``SPLIT_WORDS``: words with periods only between other
+# characters, and without symbols
+PLAIN_TOKEN_REGEX = re.compile(r"[\w+=^~|]+(?:\.[\w+=^~|]+)*")
+
+# Tokens the Treebank detokenizer joins to their neighbours with single
+# spaces: words that do not start with a period, possibly in the braces
+# of annotated scientific names
+DETOKENIZE_TOKEN_REGEX = re.compile(r"\{?[\w+=^~|][\w+=^~|.]*\}?")
+
+# Adjacent tokens the Treebank detokenizer joins into one word. Text
+# containing them is detokenized by NLTK.
+JOINED_WORDS_REGEX = re.compile(r"(?:can\snot|gim\sme|gon\sna|got\sta|lem\sme|wan\sna)",
+                                re.IGNORECASE)
+
+def nltk_word_tokenize(text):
+    """Tokenize ``text`` with ``nltk.word_tokenize``.
+
+    :param str text: Text to tokenize
+    :rtype: list[str]
+    """
+    from nltk.tokenize import word_tokenize as nltk_word_tokenize
+    return nltk_word_tokenize(text)
+
+
+def nltk_detokenize(tokens):
+    """Join ``tokens`` with ``nltk``'s Treebank detokenizer.
+
+    :param list[str] tokens: Tokens to join
+    :rtype: str
+    """
+    from nltk.tokenize.treebank import TreebankWordDetokenizer
+    return TreebankWordDetokenizer().detokenize(tokens)
+
+
+def word_tokenize(text, tokenizer="lexmapr"):
+    """Tokenize ``text`` like ``nltk.word_tokenize``.
+
+    :param str text: Text to tokenize
+    :param str tokenizer: One of ``TOKENIZERS``
+    :returns: Tokens of ``text``
+    :rtype: list[str]
+    """
+    if tokenizer == "nltk" or UNSUPPORTED_REGEX.search(text):
+        return nltk_word_tokenize(text)
+    lowercase_text = text.lower()
+    if any(word in lowercase_text for word in SPLIT_WORDS):
+        return nltk_word_tokenize(text)
+    return TOKEN_REGEX.findall(text)
+
+
+def is_plain_token(token):
+    """Determine whether ``token`` is tokenized as itself in any text.
+
+    Text made of plain tokens separated by single spaces is tokenized
+    into those tokens by ``word_tokenize``, with either tokenizer, so
+    tokens that are joined for dictionary probes need not be tokenized
+    again.
+
+    :param str token: Token from ``word_tokenize``
+    :rtype: bool
+    """
+    if not PLAIN_TOKEN_REGEX.fullmatch(token):
+        return False
+    lowercase_token = token.lower()
+    return not any(word in lowercase_token for word in SPLIT_WORDS)
+
+
+def detokenize(tokens, tokenizer="lexmapr"):
+    """Join ``tokens`` like ``nltk``'s Treebank detokenizer.
+
+    Tokens matching ``DETOKENIZE_TOKEN_REGEX``, and empty tokens, are
+    joined by single spaces, unless some of them form a word the
+    Treebank tokenizer splits.
+
+    :param list[str] tokens: Tokens to join
+    :param str tokenizer: One of ``TOKENIZERS``
+    :rtype: str
+    """
+    if tokenizer == "nltk":
+        return nltk_detokenize(tokens)
+    for token in tokens:
+        if token and not DETOKENIZE_TOKEN_REGEX.fullmatch(token):
+            return nltk_detokenize(tokens)
+    text = " ".join(tokens)
+    if JOINED_WORDS_REGEX.search(text):
+        return nltk_detokenize(tokens)
+    return text.strip()